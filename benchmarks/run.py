@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ingestion benchmarks on synthetic Who's On First data.
+
+Measures records/sec and peak memory (tracemalloc, in a separate
+pass, so that it doesn't slow down the timed one) of:
+
+- extract    - Place fields from properties (`elastic.EXTRACTOR`);
+- countries  - country names of features (`country_name`);
+- parse      - decoding GeoJSON files;
+- prepare    - features into bulk actions (`transform_feature`);
+- transform  - files into bulk actions (`transform_file`);
+- archive    - the same, reading files from a repository ZIP;
+- index      - sending prepared actions with the bulk API;
+- register   - `GazetteerCollector.register` (prepare + index).
+
+Indexing goes to a local stand-in of Elasticsearch
+(`geoometa.core.standin`, with optional latency and rejections of
+bulk items), to an in-process sink (`--sink`, client side only) or
+to a cluster (`--host`). Results are saved as JSON, and can be
+compared with a previous run:
+
+    python -m benchmarks.run --count 5000 --compare results/old.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+from elasticsearch.serializer import JSONSerializer
+
+from geoometa.conf import settings
+from geoometa.conf.connections import create_client, set_client
+from geoometa.core import integrators
+from geoometa.core.archives import iter_archive
+from geoometa.core.standin import StandIn
+from geoometa.core.utils import country_name
+from geoometa.schema import elastic
+
+from benchmarks.synthetic import SyntheticWOF, PLACETYPES
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "results")
+INDEX = "geoo-benchmark"
+REPO = {
+    "name": "whosonfirst-data-synthetic",
+    "html_url": "https://github.com/whosonfirst-data/whosonfirst-data-synthetic",
+    "default_branch": "master",
+    "pushed_at": "2021-01-01T00:00:00Z"
+    }
+
+
+class _Transport:
+    serializer = JSONSerializer()
+
+
+class SinkClient:
+    """
+    Client accepting bulk requests without sending them anywhere:
+    measures everything on the client side (serialization,
+    chunking, results handling).
+    """
+
+    transport = _Transport()
+
+    def bulk(self, body, *args, **kwargs):
+        lines = body.splitlines()
+        items = []
+        for line in lines[::2]:
+            action = json.loads(line)
+            op_type, meta = action.popitem()
+            items.append({op_type: {"_id": meta.get("_id"), "status": 201}})
+
+        return {"took": 0, "errors": False, "items": items}
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.generator = SyntheticWOF(
+            seed=args.seed, name_keys=args.name_keys,
+            vertices=args.vertices, placetypes=args.placetypes)
+        self.files = list(self.generator.files(args.count))
+        self.features = [json.loads(raw) for _, raw in self.files]
+        self.actions = [action for action, _, _ in (
+            integrators.transform_feature(f) for f in self.features)
+                        if action is not None]
+        self.tmpdir = tempfile.mkdtemp(prefix="geoo-benchmark-")
+        self.archive = self.generator.write_archive(
+            os.path.join(self.tmpdir, REPO["name"] + ".zip"), args.count)
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    # Stages: return the number of processed records.
+
+    def stage_extract(self):
+        count = 0
+        for feature in self.features:
+            elastic.EXTRACTOR.extract(feature["properties"])
+            count += 1
+        return count
+
+    def stage_countries(self):
+        count = 0
+        for feature in self.features:
+            country_name(feature["properties"]["iso:country"])
+            count += 1
+        return count
+
+    def stage_parse(self):
+        count = 0
+        for _, raw in self.files:
+            count += len(integrators.decode_geojson(raw))
+        return count
+
+    def stage_prepare(self):
+        count = 0
+        for feature in self.features:
+            action, _, _ = integrators.transform_feature(feature)
+            count += action is not None
+        return count
+
+    def stage_transform(self):
+        count = 0
+        for name, raw in self.files:
+            count += len(integrators.transform_file(name, raw))
+        return count
+
+    def stage_archive(self):
+        count = 0
+        for name, raw in iter_archive(self.archive):
+            count += len(integrators.transform_file(name, raw))
+        return count
+
+    def collector(self):
+        return integrators.GazetteerCollector(
+            None, repos=[dict(REPO)], chunk_size=self.args.chunk_size,
+            threads=self.args.threads)
+
+    def stage_index(self):
+        collector = self.collector()
+        collector.index(dict(action, _source=dict(action["_source"]))
+                        for action in self.actions)
+        return collector.stat.success
+
+    def stage_register(self):
+        collector = self.collector()
+        collector.register(iter(self.features))
+        return collector.stat.success
+
+    def measure(self, name):
+        stage = getattr(self, "stage_" + name)
+        best, records = None, 0
+        for _ in range(self.args.repeat):
+            started = time.perf_counter()
+            records = stage()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        result = {
+            "records": records,
+            "seconds": best,
+            "records_per_sec": records / best if best else None
+            }
+        if self.args.memory:
+            tracemalloc.start()
+            try:
+                stage()
+                result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path, "r") as fp:
+        previous = json.load(fp)
+
+    print("\nCompared to {} ({}):".format(
+        path, previous["meta"].get("revision")))
+    for name, stage in results["stages"].items():
+        try:
+            before = previous["stages"][name]["records_per_sec"]
+        except KeyError:
+            continue
+        now = stage["records_per_sec"]
+        if before and now:
+            print("  {:10s} {:+7.1f}%".format(name, (now / before - 1) * 100))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Ingestion benchmarks on synthetic WOF data.")
+    parser.add_argument("--count", type=int, default=2000,
+                        help="number of features")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--name-keys", type=int, default=10,
+                        help="name:* keys per feature")
+    parser.add_argument("--vertices", type=int, default=100,
+                        help="positions per polygon (0 - points)")
+    parser.add_argument("--placetypes", nargs="+", default=list(PLACETYPES))
+    parser.add_argument("--stages", nargs="+", default=[
+        "extract", "countries", "parse", "prepare", "transform", "archive",
+        "index", "register"])
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per stage (the best one counts)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip measuring peak memory")
+    parser.add_argument("--chunk-size", type=int,
+                        default=settings.ES_BULK_CHUNK_SIZE)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--host", help="Elasticsearch URL to index into "
+                        "(documents go to --index there)")
+    parser.add_argument("--sink", action="store_true",
+                        help="don't send bulk requests anywhere")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="seconds added to every stand-in request")
+    parser.add_argument("--jitter", type=float, default=0.,
+                        help="max random seconds added to the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.,
+                        help="share of stand-in requests failed with 503")
+    parser.add_argument("--item-failure-rate", type=float, default=0.,
+                        help="share of bulk items rejected with 429")
+    parser.add_argument("--index", default=INDEX)
+    parser.add_argument("--output", help="results file (default: "
+                        "results/<timestamp>.json)")
+    parser.add_argument("--compare", help="previous results file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = None
+    if args.host:
+        set_client(create_client(hosts=[args.host]), elastic.ALIAS)
+        target = args.host
+    elif args.sink:
+        set_client(SinkClient(), elastic.ALIAS)
+        target = "sink"
+    else:
+        server = StandIn(latency=args.latency, jitter=args.jitter,
+                         failure_rate=args.failure_rate,
+                         item_failure_rate=args.item_failure_rate,
+                         seed=args.seed).start()
+        set_client(server.client(), elastic.ALIAS)
+        target = "standin"
+
+    # Never touch the real index.
+    elastic.Place._index = elastic.Place._index.clone(name=args.index)
+
+    benchmark = Benchmark(args)
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "target": target,
+            "params": {k: v for k, v in vars(args).items()
+                       if k not in ("output", "compare")}
+            },
+        "stages": {}
+        }
+    try:
+        for name in args.stages:
+            result = benchmark.measure(name)
+            results["stages"][name] = result
+            print("{:10s} {:8d} records {:8.3f} s {:10.1f} rec/s{}".format(
+                name, result["records"], result["seconds"],
+                result["records_per_sec"] or 0,
+                " {:8.1f} MB peak".format(
+                    result["peak_memory_bytes"] / 2 ** 20)
+                if "peak_memory_bytes" in result else ""))
+    finally:
+        benchmark.close()
+        if server is not None:
+            server.stop()
+            results["meta"]["standin"] = dict(server.stats)
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}.json".format(
+        datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(results, fp, indent=4)
+    print("\nResults: {}".format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
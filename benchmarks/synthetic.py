@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic synthetic Who's On First data: features, files and
+repository archives shaped like the real ones (same property keys,
+nesting and archive layout), with configurable number of names,
+polygon vertices and placetypes.
+"""
+
+import json
+import math
+import random
+import zipfile
+
+from geoometa.schema.countries import COUNTRIES
+from geoometa.schema.references import LANG_MAP
+
+
+PLACETYPES = ("country", "region", "county", "locality", "neighbourhood")
+LANGS = tuple(sorted(LANG_MAP))
+SYLLABLES = ("ka", "lo", "mi", "ra", "ne", "to", "vi", "sa", "do", "re",
+             "an", "el", "or", "us", "ix", "ber", "gor", "ton", "ville")
+
+# Noise: keys that are present in real data, but not used.
+EXTRA_KEYS = ("src:geom", "wof:lastmodified", "wof:repo", "mz:is_current",
+              "wof:superseded_by", "wof:supersedes", "edtf:inception",
+              "lbl:latitude", "lbl:longitude", "mps:latitude",
+              "mps:longitude", "wof:concordances", "wof:breaches")
+
+
+class SyntheticWOF:
+    """
+    Generator of WOF-like features, the same `seed` always gives
+    the same data.
+    """
+
+    def __init__(self, seed=0, name_keys=10, vertices=100,
+                 placetypes=PLACETYPES):
+        """
+        :param name_keys: <int> number of "name:<lang>_x_preferred"
+            (and variant) keys per feature.
+        :param vertices: <int> positions in the polygon of a feature
+            (0 - features are points).
+        :param placetypes: <list> of placetypes (features get them
+            in turn).
+        """
+        self.seed = seed
+        self.name_keys = name_keys
+        self.vertices = vertices
+        self.placetypes = tuple(placetypes)
+
+    def name(self, rng):
+        return "".join(rng.choice(SYLLABLES)
+                       for _ in range(rng.randint(2, 4))).title()
+
+    def polygon(self, rng, lon, lat, radius):
+        steps = max(self.vertices - 1, 3)
+        ring = []
+        for n in range(steps):
+            angle = 2 * math.pi * n / steps
+            r = radius * rng.uniform(0.7, 1.0)
+            ring.append([round(lon + r * math.cos(angle), 6),
+                         round(lat + r * math.sin(angle), 6)])
+        ring.append(ring[0])
+        return {"type": "Polygon", "coordinates": [ring]}
+
+    def feature(self, place_id, rng=None):
+        rng = rng or random.Random(self.seed * 1000003 + place_id)
+        placetype = self.placetypes[place_id % len(self.placetypes)]
+        country = rng.choice(COUNTRIES)
+        lon, lat = rng.uniform(-179, 179), rng.uniform(-85, 85)
+        radius = rng.uniform(0.01, 0.5)
+        name = self.name(rng)
+        parent_id = place_id - 1 if place_id % len(self.placetypes) else -1
+
+        props = {
+            "wof:id": place_id,
+            "wof:name": name,
+            "wof:placetype": placetype,
+            "wof:parent_id": parent_id,
+            "wof:belongsto": [i for i in range(
+                place_id - place_id % len(self.placetypes), place_id)],
+            "wof:hierarchy": [{"{}_id".format(placetype): place_id}],
+            "wof:country": country[0],
+            "iso:country": country[0],
+            "wof:geomhash": "{:032x}".format(rng.getrandbits(128)),
+            "wof:population": rng.randint(0, 10 ** 7),
+            "wof:tags": [],
+            "geom:latitude": round(lat, 6),
+            "geom:longitude": round(lon, 6),
+            "geom:area": radius ** 2 * math.pi,
+            "geom:area_square_m": radius ** 2 * math.pi * 1.2e10,
+            "geom:bbox": ",".join(str(round(x, 6)) for x in (
+                lon - radius, lat - radius, lon + radius, lat + radius)),
+            "wof:timezone": "Etc/UTC",
+            }
+        for key in EXTRA_KEYS:
+            props[key] = rng.randint(0, 1000)
+        for n in range(self.name_keys):
+            lang = LANGS[(place_id + n) % len(LANGS)]
+            suffix = "preferred" if n % 2 == 0 else "variant"
+            props["name:{}_x_{}".format(lang, suffix)] = [
+                name if n == 0 else self.name(rng)]
+
+        if self.vertices:
+            geometry = self.polygon(rng, lon, lat, radius)
+        else:
+            geometry = {"type": "Point", "coordinates": [lon, lat]}
+
+        return {
+            "id": place_id,
+            "type": "Feature",
+            "properties": props,
+            "bbox": [lon - radius, lat - radius, lon + radius, lat + radius],
+            "geometry": geometry
+            }
+
+    def features(self, count, start=1):
+        for place_id in range(start, start + count):
+            yield self.feature(place_id)
+
+    def files(self, count, start=1, root="whosonfirst-data-synthetic-master"):
+        """
+        Yields (name, content) of WOF files as they are in a repo
+        archive ("<root>/data/123/456/7/1234567.geojson").
+        """
+        for feature in self.features(count, start):
+            digits = str(feature["id"])
+            parts = [digits[i:i+3] for i in range(0, len(digits), 3)]
+            name = "/".join([root, "data"] + parts + [digits + ".geojson"])
+            yield name, json.dumps(feature).encode("utf-8")
+
+    def write_archive(self, path, count, start=1):
+        """Writes a repository archive (ZIP) of `count` files."""
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zfp:
+            for name, content in self.files(count, start):
+                zfp.writestr(name, content)
+
+        return path
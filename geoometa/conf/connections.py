@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Elasticsearch connections.
+
+Clients are created on first use rather than on import, and
+once per process: a client inherited through `fork` (e.g. by a
+process pool worker) shares sockets with the parent, so the
+child gets its own one.
+"""
+
+import os
+import logging
+import threading
+
+from geoometa.conf import settings
+
+
+LOG = logging.getLogger(settings.LOGGER)
+__clients = {}
+__lock = threading.Lock()
+
+
+def create_client(**kwargs):
+    """
+    New client for `settings.ES_HOST` (or `hosts`), `kwargs`
+    override ES_CONN.
+    """
+    from elasticsearch import Elasticsearch
+
+    hosts = kwargs.pop("hosts", None) or [settings.ES_HOST]
+    conn = dict(settings.ES_CONN, **kwargs)
+    return Elasticsearch(hosts, **conn)
+
+
+def create_async_client(**kwargs):
+    """
+    Same as `create_client`, but `AsyncElasticsearch` (requires
+    aiohttp), to be used and closed within one event loop.
+    """
+    from elasticsearch import AsyncElasticsearch
+
+    hosts = kwargs.pop("hosts", None) or [settings.ES_HOST]
+    conn = dict(settings.ES_CONN, **kwargs)
+    return AsyncElasticsearch(hosts, **conn)
+
+
+def get_client(alias=None):
+    """
+    Returns the client for `alias` (default `settings.ES_ALIAS`)
+    owned by the current process, creating it if necessary. The
+    client is also registered in `elasticsearch_dsl.connections`,
+    so that documents and indices use it.
+    """
+    alias = alias or settings.ES_ALIAS
+    pid = os.getpid()
+    try:
+        owner, client = __clients[alias]
+    except KeyError:
+        owner, client = None, None
+
+    if owner == pid:
+        return client
+
+    with __lock:
+        owner, client = __clients.get(alias, (None, None))
+        if owner != pid:
+            from elasticsearch_dsl.connections import connections
+
+            client = create_client()
+            connections.add_connection(alias=alias, conn=client)
+            __clients[alias] = (pid, client)
+            LOG.debug("Elasticsearch: %s:%s (alias: %s, pid: %d)",
+                      settings.ES_HOST, settings.ES_PORT, alias, pid)
+
+    return client
+
+
+def set_client(client, alias=None):
+    """
+    Makes `client` the one for `alias` in the current process (e.g.
+    a client of a stand-in server in benchmarks).
+    """
+    from elasticsearch_dsl.connections import connections
+
+    alias = alias or settings.ES_ALIAS
+    with __lock:
+        connections.add_connection(alias=alias, conn=client)
+        __clients[alias] = (os.getpid(), client)
@@ -19,49 +19,11 @@ else:
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
-# Printing
-_, COLUMNS = os.popen('stty size', 'r').read().split()
-COLUMNS = int(COLUMNS) - 2 # leave 2 spaces on the right.
-
-
 def __rel(*x):
     """Relative paths inside project directory."""
     return os.path.join(BASE_DIR, *x)
 
 
-def __ensure_dir(path):
-    directory = os.path.dirname(path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    return path
-
-
-def __frame_print(*inputs, **kwargs):
-    """
-    Frame printable lines (useful for headers).
-    If no inputs provided, simply prints a line
-    and exists (useful for summaries).
-    """
-    print("-" * COLUMNS)
-    if not inputs:
-        return
-
-    align = kwargs.get("align", "center")
-    if align not in ("center", "left", "right"):
-        align = "center"
-
-    inside = COLUMNS - 2
-    for line in inputs:
-        if align == "center":
-            print('|{1:^{0}}|'.format(inside, line))
-        elif align == "left":
-            print('|{1:<{0}}|'.format(inside, line))
-        else:
-            print('|{1:>{0}}|'.format(inside, line))
-    print("-" * COLUMNS)
-
-
 # Logging is pure console
 LOGGING = {
     "version": 1,
@@ -112,23 +74,86 @@ LOGGING = {
         }
     }
 }
-config.dictConfig(LOGGING)
 LOGGER = os.environ.get("LOGGER", "root")
+__logging_configured = False
 
-LANG_DEFAULT = "en"
-TIME_ZONE = os.environ.get("TIME_ZONE", "UTC")
 
-DOWNLOAD_DIR = __rel('downloads')
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+def configure_logging():
+    """
+    Applies LOGGING (once per process). Called by entry points
+    (e.g. `GazetteerCollector`) rather than on import, so that
+    importing settings has no side effects.
+    """
+    global __logging_configured
+    if not __logging_configured:
+        config.dictConfig(LOGGING)
+        __logging_configured = True
 
-# Separate connection reports.
-__frame_print("Connections")
+LANG_DEFAULT = "en"
+TIME_ZONE = os.environ.get("TIME_ZONE", "UTC")
 
-# Elasticsearch
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl.connections import connections as elastic_connections
+# Ingestion.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 1))
+INGEST_FILES_PER_TASK = int(os.environ.get("INGEST_FILES_PER_TASK", 64))
+GITHUB_WORKERS = int(os.environ.get("GITHUB_WORKERS", 4))
+# Token for GitHub API requests: 5000 of them per hour instead of 60
+# (unauthenticated), which is less than the number of WOF repos.
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN") or None
+# Asyncio ingestion (see `geoometa.core.aio`): repositories processed
+# at once, and archives downloaded at once among them.
+INGEST_CONCURRENT_REPOS = int(os.environ.get("INGEST_CONCURRENT_REPOS", 4))
+INGEST_CONCURRENT_DOWNLOADS = int(os.environ.get(
+    "INGEST_CONCURRENT_DOWNLOADS", 2))
+# Materialize ancestors of places after ingestion (a full scroll
+# of the index, see `geoometa.core.hierarchy`).
+MATERIALIZE_HIERARCHY = bool(int(os.environ.get("MATERIALIZE_HIERARCHY", 0)))
+
+# Ingestion metrics dumps after every run (not written if empty):
+# JSON summary and Prometheus textfile (e.g. for node exporter).
+METRICS_JSON = os.environ.get("METRICS_JSON") or None
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE") or None
+
+# Errors kept in memory during a run (the last ones, counters are
+# kept for all), and an optional NDJSON file to append every error
+# to (feature ids and messages only).
+ERRORS_KEPT = int(os.environ.get("ERRORS_KEPT", 1000))
+ERROR_LOG_FILE = os.environ.get("ERROR_LOG_FILE") or None
+
+# Geometry simplification before indexing (if enabled): tolerance
+# in degrees per placetype ("default" applies to the rest, the
+# placetypes without tolerance are only quantized) and decimal
+# places kept in coordinates (6 is ~10 cm).
+GEOMETRY_TOLERANCE = {
+    "continent": 0.01,
+    "empire": 0.01,
+    "country": 0.005,
+    "dependency": 0.005,
+    "disputed": 0.005,
+    "macroregion": 0.002,
+    "region": 0.001,
+    "macrocounty": 0.0005,
+    "county": 0.0005,
+    "ocean": 0.01,
+    "marinearea": 0.005
+    }
+GEOMETRY_PRECISION = int(os.environ.get("GEOMETRY_PRECISION", 6))
 
+# Created on demand (see `geoometa.core.utils.ensure_dir`).
+DOWNLOAD_DIR = __rel('downloads')
+SYNC_STATE_FILE = os.path.join(DOWNLOAD_DIR, "sync_state.json")
+HTTP_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "http-cache")
+# Journal of ingestion runs, an interrupted run is resumed by the
+# next one (see `geoometa.core.journal`).
+INGEST_JOURNAL = bool(int(os.environ.get("INGEST_JOURNAL", 1)))
+JOURNAL_FILE = os.environ.get(
+    "JOURNAL_FILE", os.path.join(DOWNLOAD_DIR, "journal.sqlite"))
+ARCHIVE_CACHE = bool(int(os.environ.get("ARCHIVE_CACHE", 1)))
+ARCHIVE_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "archives")
+ARCHIVE_CACHE_MAX_BYTES = int(os.environ.get(
+    "ARCHIVE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
+# Elasticsearch (the client is created on first use, once per
+# process, see `geoometa.conf.connections`).
 ES_ALIAS = os.environ.get("ES_ALIAS", "default")
 ES_INDEX_LOC = os.environ.get("ES_INDEX_LOC", "geoo")
 ES_INDEX_ADM = os.environ.get("ES_INDEX_ADM", "gadm")
@@ -136,10 +161,44 @@ ES_SHARDS = os.environ.get("ES_SHARDS", 1)
 ES_REPLICAS = os.environ.get("ES_REPLICAS", 0)
 ES_HOST = os.environ.get("ES_HOST", "127.0.0.1")
 ES_PORT = int(os.environ.get("ES_PORT", 9200))
-ES_HTTP_AUTH = os.environ.get("ES_CREDENTIALS", "").split(":")
+ES_HTTP_AUTH = os.environ.get("ES_CREDENTIALS", "").split(":") \
+    if os.environ.get("ES_CREDENTIALS") else None
 ES_MAIN_TIMESTAMP_FIELD = "last_updated"
 ES_ADM_TIMESTAMP_FIELD = "created_at"
 ES_MAX_RESULTS = 5000
+ES_BULK_CHUNK_SIZE = int(os.environ.get("ES_BULK_CHUNK_SIZE", 500))
+ES_BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES", 100 * 1024 * 1024))
+ES_BULK_THREADS = int(os.environ.get("ES_BULK_THREADS", 1))
+# Bulk requests in flight at once in asyncio ingestion.
+ES_BULK_CONCURRENCY = int(os.environ.get("ES_BULK_CONCURRENCY", 2))
+# Retries of bulk items rejected with 429 (single-threaded bulk only),
+# with exponential backoff from ES_BULK_BACKOFF seconds.
+ES_BULK_MAX_RETRIES = int(os.environ.get("ES_BULK_MAX_RETRIES", 3))
+ES_BULK_BACKOFF = float(os.environ.get("ES_BULK_BACKOFF", 2))
+# Bulk-load mode of ingestion (see `geoometa.schema.elastic.bulk_load`):
+# no refresh and replicas, rare translog flushes, and optionally a
+# force merge down to ES_FORCE_MERGE_SEGMENTS (0 - no) afterwards.
+# Only applied to an index not serving queries yet (a rebuild, an
+# empty index).
+ES_BULK_LOAD = bool(int(os.environ.get("ES_BULK_LOAD", 0)))
+ES_BULK_LOAD_TRANSLOG_SIZE = os.environ.get(
+    "ES_BULK_LOAD_TRANSLOG_SIZE", "2gb")
+ES_FORCE_MERGE_SEGMENTS = int(os.environ.get("ES_FORCE_MERGE_SEGMENTS", 0))
+# Versioned indices behind the ES_INDEX_LOC alias (see
+# `geoometa.schema.versions`): previous versions kept for a rollback,
+# and parallel slices of `_reindex` ("auto" - a slice per shard).
+ES_INDEX_VERSIONS_KEPT = int(os.environ.get("ES_INDEX_VERSIONS_KEPT", 1))
+ES_REINDEX_SLICES = os.environ.get("ES_REINDEX_SLICES", "auto")
+ES_MSEARCH_BATCH = int(os.environ.get("ES_MSEARCH_BATCH", 100))
+ES_MSEARCH_CONCURRENCY = int(os.environ.get("ES_MSEARCH_CONCURRENCY", 4))
+
+# Cache of gazetteer query results (see `geoometa.schema.queries`),
+# cleared when the index changes (checked every few seconds).
+QUERY_CACHE = bool(int(os.environ.get("QUERY_CACHE", 0)))
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 10000))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", 600))
+QUERY_CACHE_CHECK_INTERVAL = float(os.environ.get(
+    "QUERY_CACHE_CHECK_INTERVAL", 30))
 ES_CONN = {
     "port": ES_PORT,
     "http_auth": ES_HTTP_AUTH,
@@ -147,11 +206,13 @@ ES_CONN = {
     "max_retries": 10,
     "retry_on_timeout": True
     }
-ES_CLIENT = Elasticsearch([ES_HOST], **ES_CONN)
-elastic_connections.add_connection(alias=ES_ALIAS, conn=ES_CLIENT)
-print("\n[>] Elasticsearch: {}:{}".format(ES_HOST, ES_PORT))
-print("Alias: {}".format(ES_ALIAS))
-print("Indices: {}, {}".format(ES_INDEX_LOC, ES_INDEX_ADM))
-
-__frame_print()
-# Separate connection reports - END.
+
+
+def __getattr__(name):
+    """Lazily created settings (PEP 562)."""
+    if name == "ES_CLIENT":
+        from geoometa.conf.connections import get_client
+        return get_client(ES_ALIAS)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
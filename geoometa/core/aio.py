@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio ingestion: `AsyncGazetteerCollector` processes several
+repositories at once, overlapping GitHub API calls, downloads,
+parsing and bulk requests, so that the wall time of a run approaches
+that of the slowest stage rather than the sum of all of them.
+
+- blocking I/O (GitHub API, downloading and reading archives, the
+  journal and sync state) runs in a thread pool;
+- decoding and transformation run in the process pool (`workers`)
+  or in a thread, off the event loop;
+- documents are sent with `AsyncElasticsearch`.
+
+Every stage has its own bound of concurrency, memory stays bounded
+as in `integrators.GazetteerCollector`, results (`stat`, metrics,
+journal, sync state) are the same, only times of stages overlap.
+
+Requires aiohttp (optional dependency of the package).
+"""
+
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+    from elasticsearch.helpers import async_streaming_bulk
+except ImportError:
+    aiohttp = None
+
+from genery.utils import RecordDict
+
+from geoometa.conf import settings
+from geoometa.conf.connections import create_async_client
+from geoometa.core.utils import iter_chunks
+from geoometa.core.metrics import body_size
+from geoometa.core.integrators import GazetteerCollector, iter_repo, \
+     transform_files, source_url, UNPACK_STREAM
+from geoometa.schema import elastic
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+
+def _require_aiohttp():
+    if aiohttp is None:
+        raise ImportError("Asyncio ingestion requires aiohttp "
+                          "(pip install aiohttp)!")
+
+
+class AsyncTimedClient:
+    """
+    `metrics.TimedClient` for `AsyncElasticsearch`: bulk requests
+    wait for `semaphore` (shared by all repositories), so that only
+    so many are in flight, their own time is recorded as the "index"
+    stage of `repo`.
+    """
+
+    def __init__(self, client, metrics, semaphore, repo=None,
+                 histogram="bulk_request_seconds"):
+        self.client = client
+        self.metrics = metrics
+        self.semaphore = semaphore
+        self.repo = repo
+        self.latency = metrics.histogram(histogram)
+
+    async def bulk(self, body, *args, **kwargs):
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                return await self.client.bulk(body, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.latency.observe(elapsed)
+                self.metrics.add("bulk_requests", count=1,
+                                 nbytes=body_size(body))
+                self.metrics.add("index", seconds=elapsed, repo=self.repo)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class AsyncGazetteerCollector(GazetteerCollector):
+    """
+    `GazetteerCollector` processing repositories concurrently on an
+    event loop (see the module). Stages are timed by their own work
+    (threads, requests) or by waiting for it, so the sum of stages
+    exceeds the wall time of the run.
+    """
+
+    def __init__(self, user, **kwargs):
+        """
+        Takes the arguments of `GazetteerCollector` (but `threads`,
+        bulk requests are sent concurrently anyway), and:
+
+        :kwargs concurrent_repos: <int> repositories processed at
+            once (default `settings.INGEST_CONCURRENT_REPOS`).
+        :kwargs downloads: <int> archives downloaded at once (default
+            `settings.INGEST_CONCURRENT_DOWNLOADS`).
+        :kwargs github_workers: <int> GitHub API requests at once
+            (default `settings.GITHUB_WORKERS`).
+        :kwargs bulk_concurrency: <int> bulk requests in flight at
+            once (default `settings.ES_BULK_CONCURRENCY`).
+        :kwargs async_client: `AsyncElasticsearch` to index with
+            (default a new one for the hosts of the client of
+            `elastic.Place`, closed after the run).
+        """
+        _require_aiohttp()
+        self.async_client = kwargs.pop("async_client", None)
+        kwargs["concurrent_repos"] = kwargs.get(
+            "concurrent_repos", settings.INGEST_CONCURRENT_REPOS)
+        kwargs["downloads"] = kwargs.get(
+            "downloads", settings.INGEST_CONCURRENT_DOWNLOADS)
+        kwargs["github_workers"] = kwargs.get(
+            "github_workers", settings.GITHUB_WORKERS)
+        kwargs["bulk_concurrency"] = kwargs.get(
+            "bulk_concurrency", settings.ES_BULK_CONCURRENCY)
+        super().__init__(user, **kwargs)
+
+    def make_client(self):
+        """
+        `AsyncElasticsearch` for the hosts of the client `Place`
+        uses (e.g. that of a stand-in server).
+        """
+        client = elastic.Place._get_connection()
+        hosts = getattr(getattr(client, "transport", None), "hosts", None)
+        return create_async_client(hosts=hosts)
+
+    def _process_repos(self, pool):
+        if not self.params.bulk:
+            LOG.debug("Asyncio ingestion always uses the bulk API")
+        # Wall time of the overlapping stages.
+        with self.metrics.stage("pipeline"):
+            asyncio.run(self.process_repos_async(pool))
+
+    async def process_repos_async(self, pool=None):
+        """
+        Processes `repos` with `concurrent_repos` coroutines taking
+        them in order. The first error stops the rest (as it does in
+        `GazetteerCollector`, the journal lets the next run resume).
+
+        :param pool: executor for `transform_files` (default a thread).
+        """
+        loop = asyncio.get_running_loop()
+        client = self.async_client or self.make_client()
+        run = RecordDict(
+            loop=loop,
+            client=client,
+            cache=self.make_cache(),
+            io=ThreadPoolExecutor(
+                max_workers=self.params.concurrent_repos +
+                self.params.github_workers,
+                thread_name_prefix="ingest-io"),
+            parser=pool or ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="ingest-parse"),
+            github=asyncio.Semaphore(self.params.github_workers),
+            downloads=asyncio.Semaphore(self.params.downloads),
+            parse=asyncio.Semaphore(2 * max(self.params.workers, 1)),
+            bulk=asyncio.Semaphore(self.params.bulk_concurrency))
+
+        records = iter(self.repos)
+        workers = [asyncio.ensure_future(self._worker(records, run))
+                   for _ in range(max(self.params.concurrent_repos, 1))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            run.io.shutdown(wait=False)
+            if run.parser is not pool:
+                run.parser.shutdown(wait=False)
+            if self.async_client is None:
+                await client.close()
+
+    async def _worker(self, records, run):
+        # Records are shared: every worker takes the next one.
+        for record in records:
+            await self.process_repo_async(record, run)
+
+            # Wait if necessary...
+            await asyncio.sleep(self.params.wait)
+
+    async def commit_sha_async(self, record, run):
+        """`commit_sha` in `run.io`, timed as "github" stage."""
+        async with run.github:
+            started = time.perf_counter()
+            sha = await run.loop.run_in_executor(
+                run.io, self.commit_sha, record)
+        self.metrics.add("github", time.perf_counter() - started, 1,
+                         repo=record["name"])
+        return sha
+
+    async def process_repo_async(self, record, run):
+        """
+        Same as a step of `GazetteerCollector._process_repos`: files
+        of the repo are read (in `run.io`) and transformed (in
+        `run.parser`) ahead of bulk requests, chunk by chunk.
+        """
+        name = record["name"]
+        LOG.debug("Processing %s", name)
+        sha = None
+        if run.cache is not None:
+            sha = await self.commit_sha_async(record, run)
+        archive = self.archive_of(record, sha)
+
+        progress = None
+        if self.journal is not None:
+            progress = await run.loop.run_in_executor(
+                run.io, lambda: self.journal.repo(
+                    record[self.html_url],
+                    version=sha or record.get("pushed_at"),
+                    batch_size=self.params.chunk_size, autocommit=False))
+            if progress.done:
+                LOG.debug("Indexed by the interrupted run: %s", name)
+                return
+
+        # Iterated in threads of `run.io`, one pull at a time: "unzip"
+        # (and "download" in it) are timed there, as usual.
+        files = iter_repo(archive.url, archive.filename,
+                          unpack=self.params.unpack, cache=run.cache,
+                          key=archive.key, metrics=self.metrics, repo=name)
+        files = self.metrics.timed("unzip", files, repo=name,
+                                   size=lambda item: len(item[1]))
+        if progress is not None:
+            files = progress.skip_done(
+                files, key=lambda n, url=archive.base_url: source_url(url, n))
+        chunks = iter_chunks(files, self.params.files_per_task)
+
+        errors_before = self.stat.errors.by_repo[name]
+        actions = self.prepare(self.transform_async(
+            chunks, run, base_url=archive.base_url), run, name, progress)
+        results = async_streaming_bulk(
+            AsyncTimedClient(run.client, self.metrics, run.bulk, repo=name),
+            actions,
+            chunk_size=self.params.chunk_size,
+            max_chunk_bytes=self.params.max_chunk_bytes,
+            max_retries=self.params.max_retries,
+            initial_backoff=self.params.initial_backoff,
+            raise_on_error=False,
+            raise_on_exception=False)
+        # `stat` is shared with the other repos in flight.
+        indexed = 0
+        async for ok, item in results:
+            indexed += ok
+            self.count_bulk_result(ok, item, repo=name, progress=progress)
+            if progress is not None and progress.due:
+                await run.loop.run_in_executor(run.io, progress.commit)
+        self.metrics.add("index", repo=name, count=indexed)
+        if progress is not None:
+            await run.loop.run_in_executor(run.io, progress.finish)
+
+        # Only a clean run lets the next one skip the repo.
+        if self.stat.errors.by_repo[name] == errors_before:
+            await run.loop.run_in_executor(
+                run.io, self.save_state, record, sha)
+
+    def save_state(self, record, sha=None):
+        """Records the repo as synced (at commit `sha`)."""
+        self.sync_state.update(record, sha=sha)
+        self.sync_state.save()
+
+    async def transform_async(self, chunks, run, base_url=None):
+        """
+        Yields results of `transform_files` for `chunks` of files in
+        the original order. Chunks are read and submitted to
+        `run.parser` by a separate task, up to 2 * `workers` ahead
+        of the consumer (and of all repos together).
+        """
+        queue = asyncio.Queue(maxsize=2 * max(self.params.workers, 1))
+        producer = asyncio.ensure_future(
+            self._submit(chunks, run, queue, base_url))
+        try:
+            while True:
+                future = await queue.get()
+                if future is None:
+                    return
+                if isinstance(future, Exception):
+                    raise future
+                yield await future
+        finally:
+            producer.cancel()
+
+    async def _submit(self, chunks, run, queue, base_url):
+        # The first pull downloads the archive, a streamed one is
+        # downloaded while read: all of it takes the download slot.
+        downloading = self.params.unpack == UNPACK_STREAM
+        await run.downloads.acquire()
+        try:
+            try:
+                chunk = await run.loop.run_in_executor(
+                    run.io, next, chunks, None)
+            finally:
+                if not downloading:
+                    run.downloads.release()
+            while chunk is not None:
+                await run.parse.acquire()
+                future = run.loop.run_in_executor(
+                    run.parser, transform_files, chunk, base_url,
+                    self.simplifier)
+                future.add_done_callback(lambda _: run.parse.release())
+                await queue.put(future)
+                chunk = await run.loop.run_in_executor(
+                    run.io, next, chunks, None)
+        except Exception as exc:
+            await queue.put(exc)
+            return
+        finally:
+            if downloading:
+                run.downloads.release()
+
+        await queue.put(None)
+
+    async def prepare(self, batches, run, repo, progress=None):
+        """
+        Yields actions of transformed `batches`, without unchanged
+        documents (if `incremental`), tracked by `progress` (if any).
+        Batches hold whole files, so every one is tracked separately.
+        """
+        iterator = batches.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                results = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            actions = list(self.collect_actions(results, repo=repo))
+            self.metrics.add("transform", time.perf_counter() - started,
+                             len(actions), repo=repo)
+
+            if self.params.incremental:
+                actions = await self.skip_unchanged_async(
+                    actions, run, repo=repo)
+            if progress is not None:
+                actions = progress.track(
+                    actions, key=lambda a: a["_source"].get("source_url"))
+            for action in actions:
+                yield action
+
+    async def skip_unchanged_async(self, actions, run, repo=None):
+        """Same as `skip_unchanged`, returns a list of `actions`."""
+        kept = []
+        for chunk in iter_chunks(actions, self.params.chunk_size):
+            started = time.perf_counter()
+            resp = await run.client.mget(
+                body={"ids": [a["_id"] for a in chunk]},
+                index=chunk[0]["_index"], _source_includes=["github_sha"])
+            kept.extend(self.drop_unchanged(chunk, resp))
+            self.metrics.add("diff", time.perf_counter() - started,
+                             len(chunk), repo=repo)
+
+        return kept
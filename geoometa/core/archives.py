@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reading files straight out of ZIP archives, without extracting
+them to disk, and the local cache of downloaded archives.
+"""
+
+import os
+import json
+import zlib
+import glob
+import struct
+import hashlib
+import logging
+import zipfile
+
+from geoometa.conf import settings
+from geoometa.core.exceptions import MalformedValueError, \
+     UnsupportedValueError, RequestFailedError
+from geoometa.core.utils import http_pool, ensure_dir
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+
+GEOJSON_EXT = ".geojson"
+CHUNK_SIZE = 64 * 1024
+
+# ZIP format records (see APPNOTE.TXT, sections 4.3.7 - 4.3.9).
+LOCAL_HEADER_SIG = b"PK\x03\x04"
+DESCRIPTOR_SIG = b"PK\x07\x08"
+# Records that may follow the last member: central directory header,
+# end of central directory (empty archive) and its ZIP64 variant.
+END_SIGS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+FLAG_ENCRYPTED = 0x01
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def iter_archive(path, suffix=GEOJSON_EXT):
+    """
+    Yields (name, content) of every member of the ZIP file
+    at `path` whose name ends with `suffix`. Members are
+    decompressed one at a time, nothing is written to disk.
+
+    :param path: <str> or file-like object (seekable).
+    :param suffix: <str>
+    """
+    with zipfile.ZipFile(path, "r") as zfp:
+        for info in zfp.infolist():
+            if info.is_dir() or not info.filename.endswith(suffix):
+                continue
+
+            with zfp.open(info) as fp:
+                yield info.filename, fp.read()
+
+
+class _Reader:
+    """Buffered reader over a non-seekable stream."""
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b""
+
+    def read_chunk(self):
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b""
+            return chunk
+
+        return self.stream.read(self.chunk_size)
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.stream.read(max(self.chunk_size, size))
+            if not chunk:
+                break
+            self.buffer += chunk
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) < size:
+            raise MalformedValueError("Unexpected end of ZIP stream!")
+
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, self.chunk_size))
+            if not data:
+                raise MalformedValueError("Unexpected end of ZIP stream!")
+            size -= len(data)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def _zip64_sizes(extra, csize, usize):
+    """Real sizes from the ZIP64 extra field (if any)."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack("<HH", extra[pos:pos+4])
+        if tag == ZIP64_EXTRA_ID:
+            values = extra[pos+4:pos+4+size]
+            fields = list(struct.unpack("<%dQ" % (len(values) // 8), values))
+            if usize == ZIP64_LIMIT and fields:
+                usize = fields.pop(0)
+            if csize == ZIP64_LIMIT and fields:
+                csize = fields.pop(0)
+            return csize, usize, True
+
+        pos += 4 + size
+
+    return csize, usize, False
+
+
+def _read_deflated(reader, size):
+    """Inflates exactly `size` compressed bytes."""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = []
+    while size > 0:
+        chunk = reader.read(min(size, reader.chunk_size))
+        if not chunk:
+            raise MalformedValueError("Unexpected end of ZIP stream!")
+        size -= len(chunk)
+        data.append(decompressor.decompress(chunk))
+
+    data.append(decompressor.flush())
+    return b"".join(data)
+
+
+def _read_deflated_until_eof(reader):
+    """
+    Inflates until the end of the deflate stream (used when sizes
+    are only known from the data descriptor after the data).
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = []
+    while not decompressor.eof:
+        chunk = reader.read_chunk()
+        if not chunk:
+            raise MalformedValueError("Unexpected end of ZIP stream!")
+        data.append(decompressor.decompress(chunk))
+
+    reader.unread(decompressor.unused_data)
+    return b"".join(data)
+
+
+def _read_descriptor(reader, zip64):
+    """
+    Reads data descriptor (optional signature, crc32 and sizes),
+    returns crc32.
+    """
+    head = reader.read_exact(4)
+    if head == DESCRIPTOR_SIG:
+        head = reader.read_exact(4)
+    reader.read_exact(16 if zip64 else 8)
+    return struct.unpack("<I", head)[0]
+
+
+def _read_stored_until_descriptor(reader, zip64):
+    """
+    Reads a stored member of unknown size up to its data descriptor,
+    found by its signature and confirmed by the size and crc32 it
+    holds, and by the record following it (the signature is optional
+    in ZIP, but written by the common tools - without it the member
+    can't be streamed).
+
+    :return: <tuple> (content, crc32).
+    """
+    sizes = "QQ" if zip64 else "II"
+    tail = 8 + struct.calcsize("<" + sizes)
+    data = bytearray()
+    start = 0
+    eof = False
+    while True:
+        pos = data.find(DESCRIPTOR_SIG, start)
+        # The next record's signature confirms the descriptor (at
+        # the end of a truncated stream there is none).
+        need = tail if eof else tail + 4
+        if pos >= 0 and len(data) >= pos + need:
+            crc, size, _ = struct.unpack("<I" + sizes, data[pos+4:pos+tail])
+            following = bytes(data[pos+tail:pos+tail+4])
+            if size == pos and zlib.crc32(data[:pos]) == crc and (
+                    eof or following == LOCAL_HEADER_SIG or
+                    following in END_SIGS):
+                reader.unread(bytes(data[pos+tail:]))
+                return bytes(data[:pos]), crc
+
+            # The signature bytes are in the content.
+            start = pos + 1
+            continue
+
+        if eof:
+            raise MalformedValueError(
+                "No data descriptor of a stored ZIP member!")
+        if pos < 0:
+            # The signature might be split between chunks.
+            start = max(len(data) - len(DESCRIPTOR_SIG) + 1, 0)
+        chunk = reader.read_chunk()
+        if chunk:
+            data += chunk
+        else:
+            eof = True
+
+
+def iter_zip_stream(stream, suffix=GEOJSON_EXT, chunk_size=CHUNK_SIZE):
+    """
+    Yields (name, content) of every member whose name ends with
+    `suffix`, reading local file headers of the ZIP sequentially
+    from a non-seekable `stream` (e.g. HTTP response), so that
+    an archive never touches the disk.
+
+    A stream that ends before the central directory (e.g. a broken
+    download) raises MalformedValueError, as does any other garbage
+    in place of a member.
+
+    :param stream: file-like object with `read(size)`.
+    :param suffix: <str>
+    :param chunk_size: <int> bytes to read from the stream at once.
+    """
+    reader = _Reader(stream, chunk_size)
+    while True:
+        sig = reader.read(4)
+        if sig in END_SIGS:
+            # Central directory: no more members.
+            return
+
+        if sig != LOCAL_HEADER_SIG:
+            raise MalformedValueError(
+                "Unexpected end of ZIP stream!" if len(sig) < 4 else
+                "Unexpected record in ZIP stream: {!r}".format(sig))
+
+        (_, flags, method, _, _, crc, csize, usize, name_len, extra_len) = \
+            LOCAL_HEADER.unpack(reader.read_exact(LOCAL_HEADER.size))
+        name = reader.read_exact(name_len)
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        extra = reader.read_exact(extra_len)
+        csize, usize, zip64 = _zip64_sizes(extra, csize, usize)
+
+        if flags & FLAG_ENCRYPTED:
+            raise UnsupportedValueError(
+                "Encrypted ZIP members are not supported: {}".format(name))
+
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise UnsupportedValueError(
+                "Unsupported compression method {} in ZIP member {}"\
+                .format(method, name))
+
+        wanted = name.endswith(suffix) and not name.endswith("/")
+        if not (wanted or flags & FLAG_DESCRIPTOR):
+            reader.skip(csize)
+            continue
+
+        if flags & FLAG_DESCRIPTOR:
+            if method == zipfile.ZIP_DEFLATED:
+                content = _read_deflated_until_eof(reader)
+                crc = _read_descriptor(reader, zip64)
+            elif name.endswith("/"):
+                # Directory entry, no data.
+                content = b""
+                crc = _read_descriptor(reader, zip64)
+            else:
+                content, crc = _read_stored_until_descriptor(reader, zip64)
+
+        elif method == zipfile.ZIP_DEFLATED:
+            content = _read_deflated(reader, csize)
+
+        else:
+            content = reader.read_exact(csize)
+
+        if not wanted:
+            continue
+
+        if zlib.crc32(content) != crc:
+            raise MalformedValueError(
+                "CRC check failed for ZIP member {}".format(name))
+
+        yield name, content
+
+
+class ArchiveCache:
+    """
+    Persistent cache of downloaded archives, content-addressed by
+    a key (e.g. repo name + commit sha), so that re-runs, retries
+    and re-indexing read archives from the local disk.
+
+    - downloads are streamed in chunks into `<key>.zip.part` and
+      resumed with Range requests if interrupted;
+    - size and sha256 of every archive are kept next to it in
+      `<key>.json` and checked before reuse;
+    - the least recently used archives are evicted when the total
+      size exceeds `max_bytes`.
+    """
+
+    def __init__(self, path=None, max_bytes=None, timeout=None):
+        """
+        :param path: <str> directory (default
+            `settings.ARCHIVE_CACHE_DIR`).
+        :param max_bytes: <int> size cap (default
+            `settings.ARCHIVE_CACHE_MAX_BYTES`).
+        :param timeout: <int> seconds.
+        """
+        self.path = path or settings.ARCHIVE_CACHE_DIR
+        self.max_bytes = max_bytes or settings.ARCHIVE_CACHE_MAX_BYTES
+        self.timeout = timeout or 30
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".zip")
+
+    def meta_filename(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key, verify=False):
+        """
+        :param verify: <bool> re-hash the archive (otherwise only
+            its size is checked).
+        :return: <str> path to the archive or None.
+        """
+        path = self.filename(key)
+        try:
+            with open(self.meta_filename(key), "r") as fp:
+                meta = json.load(fp)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+
+        if size != meta["size"] or \
+           (verify and file_sha256(path) != meta["sha256"]):
+            LOG.error("Corrupted archive in cache: %s", path)
+            self.remove(key)
+            return None
+
+        # Mark as recently used.
+        os.utime(path)
+        return path
+
+    def fetch(self, url, key, verify=False):
+        """
+        Returns path to the archive `key`, downloading it from
+        `url` if it isn't in the cache (or is corrupted).
+        """
+        path = self.get(key, verify=verify)
+        if path:
+            LOG.debug("Archive from cache: %s", path)
+            return path
+
+        path = self.download(url, key)
+        self.evict(keep=key)
+        return path
+
+    def download(self, url, key, chunk_size=1024 * 1024):
+        path = ensure_dir(self.filename(key))
+        part = path + ".part"
+        sha = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+            with open(part, "rb") as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b""):
+                    sha.update(chunk)
+
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        LOG.debug("Downloading from %s (from byte %d)", url, offset)
+        resp = http_pool().request("GET", url, headers=headers,
+                                   preload_content=False,
+                                   timeout=self.timeout)
+        try:
+            if resp.status == 416:
+                # Nothing left to download.
+                pass
+            elif resp.status == 206:
+                self._write(resp, part, "ab", sha, chunk_size)
+            elif resp.status == 200:
+                # Range ignored: start over.
+                sha = hashlib.sha256()
+                self._write(resp, part, "wb", sha, chunk_size)
+            else:
+                raise RequestFailedError("GET {} returned {} {}".format(
+                    url, resp.status, resp.reason))
+        finally:
+            resp.release_conn()
+
+        size = os.path.getsize(part)
+        expected = _expected_size(resp)
+        if (expected is not None and size != expected) or \
+           not zipfile.is_zipfile(part):
+            os.remove(part)
+            raise MalformedValueError(
+                "Incomplete or broken archive downloaded from {}".format(url))
+
+        os.replace(part, path)
+        with open(self.meta_filename(key), "w") as fp:
+            json.dump({"url": url, "size": size,
+                       "sha256": sha.hexdigest()}, fp)
+
+        return path
+
+    @staticmethod
+    def _write(resp, path, mode, sha, chunk_size):
+        with open(path, mode) as fp:
+            for chunk in resp.stream(chunk_size):
+                sha.update(chunk)
+                fp.write(chunk)
+
+    def remove(self, key):
+        for path in (self.filename(key), self.meta_filename(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used archives (except `keep`)
+        until the total size fits into `max_bytes`.
+        """
+        archives = []
+        for path in glob.glob(os.path.join(self.path, "*.zip")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            archives.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in archives)
+        for _, size, path in sorted(archives):
+            if total <= self.max_bytes:
+                break
+
+            key = os.path.basename(path)[:-len(".zip")]
+            if key == keep:
+                continue
+
+            LOG.debug("Evicting archive from cache: %s", path)
+            self.remove(key)
+            total -= size
+
+
+def _expected_size(resp):
+    """Total size of the file in response (if known)."""
+    content_range = resp.headers.get("content-range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+
+    if resp.status == 200 and resp.headers.get("content-length"):
+        return int(resp.headers["content-length"])
+
+    return None
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
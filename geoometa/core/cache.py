@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""Caches."""
+
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from genery.utils import RecordDict
+
+from geoometa.conf import settings
+from geoometa.core.utils import ensure_dir, format_error
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+
+class HTTPCache:
+    """
+    On-disk cache of HTTP responses keyed by URL. Keeps validators
+    (ETag, Last-Modified) with the body, so that requests can be
+    made conditional and 304 responses served from the cache.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: <str> directory (default `settings.HTTP_CACHE_DIR`).
+        """
+        self.path = path or settings.HTTP_CACHE_DIR
+
+    def filename(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, url):
+        """
+        :return: <dict> with "url", "headers" and "body" or None.
+        """
+        try:
+            with open(self.filename(url), "r") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        # Hash collisions are improbable, but cheap to rule out.
+        if entry.get("url") != url:
+            return None
+
+        return entry
+
+    def set(self, url, headers, body):
+        """
+        Stores the response (only if it has validators, otherwise
+        it can't be revalidated).
+
+        :param headers: <dict> lower-cased header name -> value.
+        :param body: <str>
+        """
+        if not (headers.get("etag") or headers.get("last-modified")):
+            return
+
+        path = ensure_dir(self.filename(url))
+        tmp = path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump({"url": url, "headers": headers, "body": body}, fp)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def validators(entry):
+        """Request headers making the request conditional."""
+        headers = {}
+        if entry["headers"].get("etag"):
+            headers["If-None-Match"] = entry["headers"]["etag"]
+        if entry["headers"].get("last-modified"):
+            headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+
+        return headers
+
+
+class QueryCache:
+    """
+    In-memory LRU cache of query results with TTL (thread-safe).
+
+    If `generation` is given, it's called (at most every
+    `check_interval` seconds, by one thread at a time, the others
+    serve the cache meanwhile) to get the current generation of the
+    data (e.g. the last update of the index), and the cache is
+    cleared whenever it changes.
+
+    Values are copied in and out, so that callers can change them.
+    """
+
+    def __init__(self, max_size=None, ttl=None, generation=None,
+                 check_interval=None):
+        """
+        :param max_size: <int> max number of entries (default
+            `settings.QUERY_CACHE_SIZE`).
+        :param ttl: <float> seconds (default
+            `settings.QUERY_CACHE_TTL`), 0 - entries never expire.
+        :param generation: callable without arguments.
+        :param check_interval: <float> seconds (default
+            `settings.QUERY_CACHE_CHECK_INTERVAL`).
+        """
+        self.max_size = max_size or settings.QUERY_CACHE_SIZE
+        self.ttl = settings.QUERY_CACHE_TTL if ttl is None else ttl
+        self.generation = generation
+        self.check_interval = settings.QUERY_CACHE_CHECK_INTERVAL \
+            if check_interval is None else check_interval
+        self.current_generation = None
+        self.checked_at = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _check_generation(self, now):
+        if self.generation is None:
+            return
+
+        with self.lock:
+            if self.checked_at is not None and \
+                    now - self.checked_at < self.check_interval:
+                return
+            # Taken by this thread (single flight).
+            self.checked_at = now
+
+        try:
+            generation = self.generation()
+        except Exception as exc:
+            LOG.error("Cannot check data generation: %s", format_error(exc))
+            return
+
+        with self.lock:
+            if generation == self.current_generation:
+                return
+            if self.current_generation is not None:
+                LOG.debug("Data changed (%s), query cache cleared",
+                          generation)
+                self.invalidations += 1
+            self.current_generation = generation
+            self.entries.clear()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        self._check_generation(now)
+        with self.lock:
+            try:
+                expires, value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= now:
+                del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return RecordDict(
+            size=len(self.entries), hits=self.hits, misses=self.misses,
+            hit_rate=self.hits / requests if requests else None,
+            evictions=self.evictions, invalidations=self.invalidations)
@@ -39,6 +39,11 @@ class RequestFailedError(Exception):
     pass
 
 
+class RateLimitedError(RequestFailedError):
+    """Raised when the service refuses requests over its rate limit."""
+    pass
+
+
 class MissingAuthError(Exception):
     """Raised when the request missing authentication data."""
     pass
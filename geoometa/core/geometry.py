@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""
+Geometry simplification and coordinates quantization before
+indexing (GeoJSON-like geometries as produced by
+`elastic.Place.extract_geometry`).
+
+Requires numpy (optional dependency of the package).
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Minimal number of positions for a valid closed ring and a line.
+MIN_RING = 4
+MIN_LINE = 2
+
+# Max size of the (points x edges) matrices in point-in-polygon, and
+# of blocks of edge pairs tested for intersection at once.
+MAX_MATRIX = 4 * 1024 * 1024
+
+# Times tolerance is halved for a polygon that became invalid, before
+# giving up on simplifying it.
+TOLERANCE_RETRIES = 3
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("Geometry simplification requires numpy "
+                          "(pip install numpy)!")
+
+
+def count_positions(coordinates, depth):
+    """
+    Number of positions in `coordinates` nested `depth` levels
+    deep (0 for a single position, 1 for a line, etc.).
+    """
+    if depth == 0:
+        return 1
+
+    if depth == 1:
+        return len(coordinates)
+
+    return sum(count_positions(c, depth - 1) for c in coordinates)
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Douglas-Peucker simplification of the polyline `points`
+    (distances computed vectorized per segment).
+
+    :param points: <numpy.ndarray> of the shape (n, 2+).
+    :param tolerance: <float> max distance of removed points from
+        the simplified line (in the units of coordinates).
+    :return: <numpy.ndarray> of <bool> - points to keep.
+    """
+    size = len(points)
+    keep = np.zeros(size, dtype=bool)
+    keep[0] = keep[-1] = True
+    xs, ys = points[:, 0], points[:, 1]
+    stack = [(0, size - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        seg_x = xs[start+1:end] - xs[start]
+        seg_y = ys[start+1:end] - ys[start]
+        dx, dy = xs[end] - xs[start], ys[end] - ys[start]
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            # Closed ring: distance from the first point.
+            dist = np.hypot(seg_x, seg_y)
+        else:
+            dist = np.abs(dx * seg_y - dy * seg_x) / norm
+
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            idx += start + 1
+            keep[idx] = True
+            stack.append((start, idx))
+            stack.append((idx, end))
+
+    return keep
+
+
+def quantize(points, precision):
+    """
+    Rounds `points` to `precision` decimal places and drops
+    positions that became duplicates of the previous ones.
+    """
+    points = np.round(points, precision)
+    if len(points) < 2:
+        return points
+
+    moved = np.any(points[1:] != points[:-1], axis=1)
+    return points[np.concatenate(([True], moved))]
+
+
+def ring_edges(ring):
+    """
+    :param ring: positions of a ring (closed or not).
+    :return: <numpy.ndarray> of the shape (n, 4) - x1, y1, x2, y2.
+    """
+    points = np.asarray(ring, dtype=float)[:, :2]
+    if len(points) < 3:
+        return np.empty((0, 4))
+
+    if not np.array_equal(points[0], points[-1]):
+        points = np.vstack([points, points[:1]])
+
+    return np.hstack([points[:-1], points[1:]])
+
+
+def points_in_polygon(xs, ys, edges):
+    """
+    Even-odd test of points (`xs`, `ys`) against all `edges` of a
+    polygon (its rings in any order).
+
+    :return: <numpy.ndarray> of <bool>.
+    """
+    inside = np.zeros(len(xs), dtype=bool)
+    if not len(edges):
+        return inside
+
+    x1, y1, x2, y2 = edges.T
+    # Horizontal edges never cross the ray (and would divide by 0).
+    dy = np.where(y1 == y2, 1., y2 - y1)
+    step = max(1, MAX_MATRIX // len(edges))
+    for start in range(0, len(xs), step):
+        px = xs[start:start+step, None]
+        py = ys[start:start+step, None]
+        crosses = ((y1 > py) != (y2 > py)) & \
+            (px < x1 + (py - y1) * (x2 - x1) / dy)
+        inside[start:start+step] = crosses.sum(axis=1) % 2 == 1
+
+    return inside
+
+
+def _orientation(ax, ay, bx, by, cx, cy):
+    """Signs of the turns a -> b -> c (1 - left, -1 - right, 0)."""
+    return np.sign((bx - ax) * (cy - ay) - (by - ay) * (cx - ax))
+
+
+def edges_intersect(rings):
+    """
+    Do any two edges of `rings` cross or touch (except for the
+    neighbours in a ring meeting at their common position)?
+    Candidate pairs come from a sweep over edges sorted by min x
+    (only the edges overlapping along x are compared).
+
+    :param rings: <list> of positions of rings.
+    :return: <bool>
+    """
+    edges, ring_of, index, sizes = [], [], [], []
+    for num, ring in enumerate(rings):
+        ring = ring_edges(ring)
+        edges.append(ring)
+        ring_of.append(np.full(len(ring), num))
+        index.append(np.arange(len(ring)))
+        sizes.append(np.full(len(ring), len(ring)))
+    if not edges:
+        return False
+
+    edges = np.concatenate(edges)
+    x1, y1, x2, y2 = edges.T
+    xmin, xmax = np.minimum(x1, x2), np.maximum(x1, x2)
+    order = np.argsort(xmin, kind="stable")
+    x1, y1, x2, y2, xmin, xmax = (
+        a[order] for a in (x1, y1, x2, y2, xmin, xmax))
+    ymin, ymax = np.minimum(y1, y2), np.maximum(y1, y2)
+    ring_of, index, sizes = (
+        np.concatenate(a)[order] for a in (ring_of, index, sizes))
+
+    # Every edge is compared with the following ones starting
+    # (along x) before it ends.
+    count = len(xmin)
+    following = np.searchsorted(xmin, xmax, side="right") - \
+        np.arange(count) - 1
+    first = 0
+    while first < count:
+        totals = np.cumsum(following[first:])
+        last = first + max(int(np.searchsorted(
+            totals, MAX_MATRIX, side="right")), 1)
+        runs = following[first:last]
+        i = np.repeat(np.arange(first, last), runs)
+        j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(runs) - runs,
+                                                  runs)
+        first = last
+        if not len(i):
+            continue
+
+        o1 = _orientation(x1[i], y1[i], x2[i], y2[i], x1[j], y1[j])
+        o2 = _orientation(x1[i], y1[i], x2[i], y2[i], x2[j], y2[j])
+        o3 = _orientation(x1[j], y1[j], x2[j], y2[j], x1[i], y1[i])
+        o4 = _orientation(x1[j], y1[j], x2[j], y2[j], x2[i], y2[i])
+        gap = np.abs(index[i] - index[j])
+        neighbours = (ring_of[i] == ring_of[j]) & \
+            ((gap == 1) | (gap == sizes[i] - 1))
+        # Neighbours only meet at a position, unless one folds back
+        # along the other.
+        folded = neighbours & (o1 == 0) & (o2 == 0) & (
+            (x2[i] - x1[i]) * (x2[j] - x1[j]) +
+            (y2[i] - y1[i]) * (y2[j] - y1[j]) < 0)
+        meet = (o1 * o2 <= 0) & (o3 * o4 <= 0) & \
+            (ymin[i] <= ymax[j]) & (ymin[j] <= ymax[i])
+        if np.any((meet & ~neighbours) | folded):
+            return True
+
+    return False
+
+
+def polygon_is_valid(rings):
+    """
+    Is the polygon of `rings` (shell first, then holes) fine for a
+    geo_shape: edges don't cross or touch, holes are inside the
+    shell?
+    """
+    rings = [np.asarray(ring, dtype=float) for ring in rings]
+    if not rings or edges_intersect(rings):
+        return False
+
+    # Rings don't cross, so a hole is inside if its position is.
+    shell = ring_edges(rings[0])
+    holes = [ring for ring in rings[1:] if len(ring)]
+    if not holes:
+        return True
+
+    inside = points_in_polygon(np.array([h[0, 0] for h in holes]),
+                               np.array([h[0, 1] for h in holes]), shell)
+    return bool(inside.all())
+
+
+class GeometrySimplifier:
+    """
+    Simplifies geometries with a tolerance depending on placetype
+    and quantizes coordinates. Every ring and line is processed
+    separately, and one that would degenerate (less than 4
+    positions for a ring, 2 for a line) is kept as is, so that
+    polygons never lose rings.
+
+    Topology of polygons is preserved: one that became invalid (see
+    `polygon_is_valid`) is simplified again with a smaller tolerance,
+    then only quantized, and if even that is invalid, kept as is.
+    """
+
+    def __init__(self, tolerance=None, precision=None):
+        """
+        :param tolerance: <dict> placetype -> tolerance (<float>, in
+            degrees), key "default" (if any) applies to the rest;
+            placetypes without tolerance are only quantized.
+        :param precision: <int> decimal places to keep in
+            coordinates (None - keep as is).
+        """
+        _require_numpy()
+        self.tolerance = tolerance or {}
+        self.precision = precision
+
+    def get_tolerance(self, placetype):
+        try:
+            return self.tolerance[placetype]
+        except KeyError:
+            return self.tolerance.get("default")
+
+    def simplify(self, geometry, placetype=None):
+        """
+        :param geometry: <dict> with "type" and "coordinates" (or
+            "geometries" for a collection).
+        :return: <tuple> (new geometry, positions before, after)
+        """
+        tolerance = self.get_tolerance(placetype)
+        type_ = (geometry.get("type") or "").lower()
+        if type_ == "geometrycollection":
+            geometries, before, after = [], 0, 0
+            for geom in geometry.get("geometries", []):
+                geom, geom_before, geom_after = self.simplify(geom, placetype)
+                geometries.append(geom)
+                before += geom_before
+                after += geom_after
+            return dict(geometry, geometries=geometries), before, after
+
+        try:
+            coordinates = geometry["coordinates"]
+        except KeyError:
+            return geometry, 0, 0
+
+        if type_ == "point":
+            coordinates = self._point(coordinates)
+            return dict(geometry, coordinates=coordinates), 1, 1
+
+        if type_ in ("linestring", "multipoint"):
+            depth, handler = 1, self._line
+        elif type_ in ("polygon", "multilinestring"):
+            depth, handler = 2, self._rings
+        elif type_ == "multipolygon":
+            depth, handler = 3, self._polygons
+        else:
+            return geometry, 0, 0
+
+        if type_ == "multipoint":
+            tolerance = None
+        if type_ == "multilinestring":
+            handler = self._lines
+
+        before = count_positions(coordinates, depth)
+        coordinates = handler(coordinates, tolerance)
+        after = count_positions(coordinates, depth)
+        return dict(geometry, coordinates=coordinates), before, after
+
+    def _point(self, position):
+        if self.precision is None:
+            return position
+
+        return [round(x, self.precision) for x in position]
+
+    def _simplify(self, positions, tolerance, min_size):
+        if len(positions) <= min_size:
+            if self.precision is None:
+                return positions
+            return np.round(np.asarray(positions, dtype=float),
+                            self.precision).tolist()
+
+        points = np.asarray(positions, dtype=float)
+        simplified = points
+        if tolerance:
+            simplified = points[douglas_peucker(points, tolerance)]
+        if self.precision is not None:
+            simplified = quantize(simplified, self.precision)
+
+        if len(simplified) < min_size:
+            # Degenerated: keep the original (rounded, if required).
+            if self.precision is None:
+                return positions
+            return np.round(points, self.precision).tolist()
+
+        return simplified.tolist()
+
+    def _line(self, line, tolerance):
+        return self._simplify(line, tolerance, MIN_LINE)
+
+    def _lines(self, lines, tolerance):
+        return [self._line(line, tolerance) for line in lines]
+
+    def _rings(self, rings, tolerance):
+        """Rings of a polygon (see the class)."""
+        tolerances = [tolerance / 2 ** n
+                      for n in range(TOLERANCE_RETRIES + 1)] \
+            if tolerance else []
+        if self.precision is not None:
+            tolerances.append(None)
+        for tol in tolerances:
+            simplified = [self._simplify(ring, tol, MIN_RING)
+                          for ring in rings]
+            if polygon_is_valid(simplified):
+                return simplified
+
+        return rings
+
+    def _polygons(self, polygons, tolerance):
+        return [self._rings(rings, tolerance) for rings in polygons]
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Materialization of the hierarchy of places: after ingestion, every
+document gets its ancestors (ids, names and placetypes, from the
+top down) as plain keyword fields, so that hierarchy queries
+("all localities in region X", breadcrumbs) are single term
+queries instead of nested ones.
+
+Parents are resolved from `parent_id`, and from `belongsto` where
+the chain of parents is broken.
+"""
+
+import sys
+import zlib
+import logging
+
+from elasticsearch.helpers import scan, streaming_bulk
+from genery.utils import RecordDict
+
+from geoometa.conf import settings
+from geoometa.schema import elastic
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+# Who's On First placetypes from the top down (used to order
+# ancestors taken from `belongsto`).
+PLACETYPES = (
+    "planet", "continent", "ocean", "empire", "country", "dependency",
+    "disputed", "marinearea", "macroregion", "region", "macrocounty",
+    "county", "localadmin", "locality", "borough", "macrohood",
+    "neighbourhood", "microhood", "campus", "building", "venue",
+    "address"
+    )
+PLACETYPE_RANK = {p: i for i, p in enumerate(PLACETYPES)}
+UNKNOWN_RANK = len(PLACETYPES)
+
+PATH_SEPARATOR = "/"
+
+# Fields read from the index (the last three - to tell if the
+# materialized ones changed).
+SOURCE_FIELDS = ["parent_id", "belongsto", "name", "placetype",
+                 "ancestors", "ancestor_names", "ancestor_placetypes"]
+
+
+def _as_id(value):
+    """<int> id or None (WOF uses negative ids for unknown)."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    return value if value > 0 else None
+
+
+def _checksum(ids, names, placetypes):
+    data = "\x1f".join(map(str, (ids or []) + (names or []) + \
+                               (placetypes or [])))
+    return zlib.crc32(data.encode("utf-8"))
+
+
+class Node:
+    __slots__ = ("parent", "belongsto", "name", "placetype", "checksum")
+
+    def __init__(self, parent, belongsto, name, placetype, checksum):
+        self.parent = parent
+        self.belongsto = belongsto
+        self.name = name
+        self.placetype = placetype
+        self.checksum = checksum
+
+
+class HierarchyMaterializer:
+    """
+    Loads id -> parent graph of the whole index into memory (one
+    scroll), resolves ancestors of every place and writes them
+    with bulk partial updates (only for documents where they
+    changed):
+
+    - `ancestors` - ids (as keywords) from the top down;
+    - `ancestor_names`, `ancestor_placetypes` - the same levels;
+    - `ancestor_path` - ids joined with "/" (prefix queries for
+      the whole subtree).
+    """
+
+    def __init__(self, index=None, chunk_size=None, scroll_size=None,
+                 client=None):
+        """
+        :param index: <str> (default `elastic.Place` index).
+        :param chunk_size: <int> documents per bulk request (default
+            `settings.ES_BULK_CHUNK_SIZE`).
+        :param scroll_size: <int> documents per scroll page.
+        :param client: `elasticsearch.Elasticsearch` (default the
+            connection of `elastic.Place`).
+        """
+        self.index = index or elastic.Place._index._name
+        self.chunk_size = chunk_size or settings.ES_BULK_CHUNK_SIZE
+        self.scroll_size = scroll_size or 5000
+        self.client = client or elastic.Place._get_connection()
+        self.nodes = {}
+        self.paths = {}
+
+    def load(self):
+        """Reads the graph from the index."""
+        self.nodes, self.paths = {}, {}
+        hits = scan(self.client, index=self.index, size=self.scroll_size,
+                    query={"_source": SOURCE_FIELDS})
+        for hit in hits:
+            place_id = _as_id(hit["_id"])
+            if place_id is None:
+                continue
+
+            src = hit.get("_source", {})
+            belongsto = src.get("belongsto") or []
+            if not isinstance(belongsto, list):
+                belongsto = [belongsto]
+            placetype = src.get("placetype")
+            self.nodes[place_id] = Node(
+                parent=_as_id(src.get("parent_id")),
+                belongsto=tuple(filter(None, map(_as_id, belongsto))),
+                name=src.get("name"),
+                # Only a few dozens distinct values.
+                placetype=sys.intern(placetype) if placetype else None,
+                checksum=_checksum(src.get("ancestors"),
+                                   src.get("ancestor_names"),
+                                   src.get("ancestor_placetypes")))
+
+        LOG.debug("Hierarchy graph: %d places", len(self.nodes))
+        return self.nodes
+
+    def _chain(self, place_id):
+        """
+        Ancestors of `place_id` from the top down, following
+        `parent_id` (paths of places with children are memoized,
+        leaves are the majority and are computed on demand).
+        """
+        walked = []
+        seen = {place_id}
+        current = self.nodes[place_id].parent
+        path = ()
+        while current is not None:
+            if current in self.paths:
+                path = self.paths[current]
+                break
+            if current in seen:
+                # Cycle: the chain is cut, and it's not memoized
+                # (it would be different for every node in it).
+                return tuple(reversed(walked))
+            if current not in self.nodes:
+                # Parent outside the index.
+                break
+            seen.add(current)
+            walked.append(current)
+            current = self.nodes[current].parent
+
+        # Every walked node has a child, so it's worth memoizing.
+        for node_id in reversed(walked):
+            path = path + (node_id,)
+            self.paths[node_id] = path
+
+        return path
+
+    def ancestors(self, place_id):
+        """
+        :return: <tuple> of ancestor ids from the top down.
+        """
+        chain = self._chain(place_id)
+        extra = [i for i in self.nodes[place_id].belongsto
+                 if i not in chain and i != place_id and i in self.nodes]
+        if not extra:
+            return chain
+
+        # Fill the gaps in the chain by placetype (the sort is
+        # stable, the chain keeps its order).
+        return tuple(sorted(chain + tuple(extra), key=self._rank))
+
+    def _rank(self, place_id):
+        return PLACETYPE_RANK.get(self.nodes[place_id].placetype,
+                                  UNKNOWN_RANK)
+
+    def fields(self, place_id):
+        """Materialized hierarchy fields of `place_id`."""
+        ancestors = self.ancestors(place_id)
+        return {
+            "ancestors": [str(i) for i in ancestors],
+            "ancestor_names": [self.nodes[i].name for i in ancestors],
+            "ancestor_placetypes": [self.nodes[i].placetype
+                                    for i in ancestors],
+            "ancestor_path": PATH_SEPARATOR.join(map(str, ancestors))
+            }
+
+    def actions(self, stat):
+        """Yields partial updates for documents that changed."""
+        for place_id, node in self.nodes.items():
+            doc = self.fields(place_id)
+            checksum = _checksum(doc["ancestors"], doc["ancestor_names"],
+                                 doc["ancestor_placetypes"])
+            if checksum == node.checksum:
+                stat.unchanged += 1
+                continue
+
+            yield {
+                "_op_type": "update",
+                "_index": self.index,
+                "_id": place_id,
+                "doc": doc
+                }
+
+    def materialize(self):
+        """
+        :return: <RecordDict> with "updated", "unchanged" and
+            "errors" (count) of documents.
+        """
+        # Fields are new to indices created before, and freshly
+        # indexed documents should be visible.
+        self.client.indices.put_mapping(
+            index=self.index, body=elastic.Place._doc_type.mapping.to_dict())
+        self.client.indices.refresh(index=self.index)
+        self.load()
+
+        stat = RecordDict(updated=0, unchanged=0, errors=0)
+        results = streaming_bulk(self.client, self.actions(stat),
+                                 chunk_size=self.chunk_size,
+                                 raise_on_error=False,
+                                 raise_on_exception=False)
+        for ok, item in results:
+            if ok:
+                stat.updated += 1
+                continue
+
+            _, info = item.popitem()
+            stat.errors += 1
+            LOG.error("Failed to update hierarchy of %s: %s",
+                      info.get("_id"), info.get("error"))
+
+        # The graph can be huge.
+        self.nodes, self.paths = {}, {}
+        LOG.debug("Hierarchy: %d updated, %d unchanged, %d errors",
+                  stat.updated, stat.unchanged, stat.errors)
+        return stat
+
@@ -11,14 +11,31 @@ import urllib
 import shutil
 import zipfile
 import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
+from elasticsearch.helpers import streaming_bulk, parallel_bulk
+from elasticsearch_dsl.exceptions import ValidationException
+from dateutil.parser import isoparse
 from genery.utils import RecordDict, URLNormalizer, \
      ensure_list, runcmd, as_file
 
 from geoometa.conf import settings
-from geoometa.core.exceptions import MissingDataError, UnsupportedValueError
-from geoometa.core.utils import read_github, format_error
+from geoometa.core.exceptions import MissingDataError, UnsupportedValueError, \
+     RequestFailedError, RateLimitedError
+from geoometa.core.utils import iter_github, fetch, format_error, \
+     iter_chunks, imap_ordered, git_blob_sha, ensure_dir
+from geoometa.core.archives import iter_archive, iter_zip_stream, \
+     ArchiveCache
+from geoometa.core.geometry import GeometrySimplifier
+from geoometa.core.cache import HTTPCache
+from geoometa.core.metrics import Metrics, TimedClient, ErrorLog
+from geoometa.core.hierarchy import HierarchyMaterializer
+from geoometa.core.journal import Journal
 from geoometa.schema import elastic
+from geoometa.schema.versions import IndexVersions
 
 
 LOG = logging.getLogger(settings.LOGGER)
@@ -30,58 +47,342 @@ ZIP_CONTENT_TYPE = [
     "application/octet-stream"
     ]
 
+# How repository archives are read:
+# - "extract": unZIP to `settings.DOWNLOAD_DIR` and walk the tree;
+# - "archive": download the ZIP and read members straight from it;
+# - "stream": read members from the HTTP response (nothing on disk).
+UNPACK_EXTRACT = "extract"
+UNPACK_ARCHIVE = "archive"
+UNPACK_STREAM = "stream"
+UNPACK_MODES = (UNPACK_EXTRACT, UNPACK_ARCHIVE, UNPACK_STREAM)
+
+# Stages timed inside `transform_file` (in worker processes too).
+TIMED_STAGES = ("parse", "prepare")
+
+
+def decode_geojson(raw):
+    """Deserializes `raw` GeoJSON into a list of features."""
+    geojson = json.loads(raw)
+    if isinstance(geojson, list):
+        return geojson
+
+    return [geojson]
+
+
+def parse_geojson(name, raw):
+    """
+    Returns a list of features deserialized from `raw` content
+    of the file `name` (empty list if it cannot be decoded).
+    """
+    try:
+        features = decode_geojson(raw)
+    except Exception as exc:
+        LOG.error("%s: %s", name, format_error(exc))
+        return []
+
+    LOG.debug("processed %s", name)
+    return features
+
+
+def feature_id_of(feature):
+    """Id of the (possibly malformed) `feature`, None if unknown."""
+    try:
+        return feature.get("id") or feature["properties"].get("wof:id")
+    except (AttributeError, KeyError):
+        return None
+
+
+def transform_feature(feature, simplifier=None):
+    """
+    Turns WOF `feature` into a ready-to-index bulk action
+    (see `elastic.Place.to_action`).
+
+    :param simplifier: `geometry.GeometrySimplifier` or None.
+    :return: <tuple> (action, None, info) or (None, error, info),
+        where error is (feature id, exception) and info is <dict>
+        of counters for `stat`.
+    """
+    feature_id = feature_id_of(feature)
+    type_ = feature.get("type", "") if isinstance(feature, dict) else None
+    if not isinstance(type_, str) or type_.lower() != "feature":
+        msg = "Only records of the type 'feature' are supported "\
+            "(currently: {}, id: {})".format(type_, feature_id)
+        return None, (feature_id, UnsupportedValueError(msg)), {}
+
+    try:
+        place = elastic.Place(meta={"remap": True}, **feature)
+    except KeyError:
+        msg = "Record doesn't contain 'properties' (id: {})".format(
+            feature_id)
+        return None, (feature_id, MissingDataError(msg)), {}
+
+    except MissingDataError as exc:
+        return None, (feature_id, exc), {}
+
+    try:
+        action = place.to_action()
+    except ValidationException as exc:
+        return None, (feature_id, exc), {}
+
+    if simplifier is None:
+        return action, None, {}
+
+    source = action["_source"]
+    try:
+        geometry = source["geometry"]
+    except KeyError:
+        return action, None, {}
+
+    source["geometry"], before, after = simplifier.simplify(
+        geometry, source.get("placetype"))
+    return action, None, {"vertices": before, "vertices_simplified": after}
+
+
+def source_url(base_url, name):
+    """
+    URL of the file `name` from a repository archive on github.
+
+    :param base_url: <str> e.g.
+        'https://github.com/whosonfirst-data/<repo>/blob/<branch>'
+    :param name: <str> path inside archive, where the first
+        directory is the repo root (e.g. '<repo>-<branch>/data/...')
+    """
+    try:
+        _, path = name.split("/", 1)
+    except ValueError:
+        path = name
+
+    return "/".join([base_url.rstrip("/"), path])
+
+
+def transform_file(name, raw, base_url=None, simplifier=None):
+    """
+    Transforms every feature of the file `name` with `raw`
+    content, see `transform_feature`. Documents are stamped
+    with the git sha of the file (and its URL if `base_url`
+    of the repo is given) to detect changes on the next sync.
+
+    :return: <list> of (action, error, info) tuples.
+    """
+    started = time.perf_counter()
+    try:
+        features = decode_geojson(raw)
+    except Exception as exc:
+        return [(None, (name, exc), {})]
+    parsed = time.perf_counter()
+
+    stamp = {"github_sha": git_blob_sha(raw)}
+    if base_url:
+        stamp["source_url"] = source_url(base_url, name)
+
+    results = []
+    for feature in features:
+        action, error, info = transform_feature(feature, simplifier)
+        if action is not None:
+            action["_source"].update(stamp)
+        results.append((action, error, info))
+
+    # (seconds, count) of the stages, wherever this runs (see
+    # `GazetteerCollector.collect_actions`).
+    if results:
+        results[0][2].update({
+            "parse": (parsed - started, 1),
+            "prepare": (time.perf_counter() - parsed, len(results))
+            })
+
+    return results
+
+
+def transform_files(files, base_url=None, simplifier=None):
+    """
+    Transforms a batch of (name, content) files (a unit of work
+    for a process pool, see `GazetteerCollector.transform`).
+    """
+    results = []
+    for name, raw in files:
+        results.extend(transform_file(name, raw, base_url=base_url,
+                                      simplifier=simplifier))
+
+    return results
 
-def process_tree(path):
-    data = []
-    for filename in glob.iglob(path + '**/**/*.geojson', recursive=True):
-        with open(filename, "r") as fp:
-            try:
-                geojson = json.load(fp)
-            except Exception as exc:
-                LOG.error(format_error(exc))
-            else:
-                if isinstance(geojson, list):
-                    data.extend(geojson)
-                else:
-                    data.append(geojson)
-                LOG.debug("processed %s", filename)
-            fp.close()
 
-    return data
+def iter_tree(path):
+    """Yields (filename, content) of every *.geojson file under `path`."""
+    pattern = os.path.join(path, '**', '*.geojson')
+    for filename in glob.iglob(pattern, recursive=True):
+        with open(filename, "rb") as fp:
+            yield filename, fp.read()
 
 
-def process_repo(url, filename=None):
+def iter_stream(url):
     """
-    - downloads from `url`
-    - unZIPs inside `settings.DOWNLOAD_DIR`
-    - recoursively processes directory tree
-    - cleans up downloaded file and extracted directory
-    - returns deserialized data
+    Yields (name, content) of *.geojson members of the ZIP
+    archive read directly from the response to `url`.
     """
+    with urllib.request.urlopen(url, timeout=TIMEOUT) as resp:
+        content_type = resp.info().get_content_type()
+        if content_type not in ZIP_CONTENT_TYPE:
+            raise UnsupportedValueError(
+                "Only ZIP archives are supported (request returned `{}`)"\
+                .format(content_type))
+
+        yield from iter_zip_stream(resp)
+
+
+def iter_repo(url, filename=None, unpack=UNPACK_ARCHIVE, cache=None,
+              key=None, metrics=None, repo=None):
+    """
+    - downloads from `url` (unless `unpack` is "stream"), or
+      takes the archive `key` from `cache` (`archives.ArchiveCache`)
+    - reads GeoJSON files from the archive (see UNPACK_MODES),
+      only "extract" unZIPs inside `settings.DOWNLOAD_DIR`
+    - yields (name, content) of files one by one
+    - cleans up downloaded file (unless cached) and extracted
+      directory (when exhausted or closed)
+
+    Download is recorded in `metrics` (`metrics.Metrics`) if given.
+    """
+    metrics = metrics or Metrics()
+    if unpack not in UNPACK_MODES:
+        raise UnsupportedValueError(
+            "`unpack` should be one of {} (currently: {})"\
+            .format(", ".join(UNPACK_MODES), unpack))
+
+    if unpack == UNPACK_STREAM:
+        LOG.debug("Streaming from %s", url)
+        yield from iter_stream(url)
+        return
+
     if not filename:
-        filename = filename.split("/")[-1]
+        filename = url.split("/")[-1]
 
-    path_zipfile = os.path.join(settings.DOWNLOAD_DIR, filename)
     path_dir = os.path.join(settings.DOWNLOAD_DIR, filename.rsplit(".", 1)[0])
+    path_zipfile = cache.get(key) if cache is not None and key else None
+    if path_zipfile is None:
+        with metrics.stage("download", repo, count=1):
+            if cache is not None and key:
+                path_zipfile = cache.fetch(url, key)
+            else:
+                path_zipfile = os.path.join(settings.DOWNLOAD_DIR, filename)
+                LOG.debug("Downloading from %s", url)
+                urllib.request.urlretrieve(url, ensure_dir(path_zipfile))
+        metrics.add("download", nbytes=os.path.getsize(path_zipfile),
+                    repo=repo)
 
-    LOG.debug("Downloading from %s", url)
-    urllib.request.urlretrieve(url, path_zipfile)
+    try:
+        if unpack == UNPACK_ARCHIVE:
+            yield from iter_archive(path_zipfile)
+            return
 
-    LOG.debug("Unzipping to %s", path_dir)
-    with zipfile.ZipFile(path_zipfile, "r") as fp:
-        fp.extractall(path_dir)
+        LOG.debug("Unzipping to %s", path_dir)
+        with zipfile.ZipFile(path_zipfile, "r") as fp:
+            fp.extractall(path_dir)
 
-    data = process_tree(path_dir)
+        for name, raw in iter_tree(path_dir):
+            yield os.path.relpath(name, path_dir), raw
 
-    # Cleanup.
-    LOG.debug("Cleaning up %s & %s", path_zipfile, path_dir)
-    os.remove(path_zipfile)
-    try:
-        shutil.rmtree(path_dir)
-    except OSError as err:
-        LOG.error("Cannot delete %s - Error %s", path_dir, err.strerror)
+    finally:
+        # Cleanup.
+        LOG.debug("Cleaning up %s & %s", path_zipfile, path_dir)
+        if cache is None or not key:
+            os.remove(path_zipfile)
+        if os.path.exists(path_dir):
+            try:
+                shutil.rmtree(path_dir)
+            except OSError as err:
+                LOG.error("Cannot delete %s - Error %s", path_dir, err.strerror)
+
+
+def process_tree(path):
+    """
+    Lazily yields features from every *.geojson file under `path`,
+    so that only one file is held in memory at a time.
+    """
+    for name, raw in iter_tree(path):
+        yield from parse_geojson(name, raw)
+
+
+def process_archive(path):
+    """Lazily yields features from *.geojson members of ZIP file."""
+    for name, raw in iter_archive(path):
+        yield from parse_geojson(name, raw)
+
+
+def process_stream(url):
+    """
+    Lazily yields features from *.geojson members of the ZIP
+    archive read directly from the response to `url`.
+    """
+    for name, raw in iter_stream(url):
+        yield from parse_geojson(name, raw)
+
+
+def process_repo(url, filename=None, unpack=UNPACK_ARCHIVE):
+    """
+    Lazily yields deserialized features from the repository
+    archive at `url` (see `iter_repo`).
+    """
+    for name, raw in iter_repo(url, filename, unpack=unpack):
+        yield from parse_geojson(name, raw)
 
-    return data
+
+class SyncState:
+    """
+    Persistent record of repositories seen by the previous runs
+    (stored as JSON in `settings.SYNC_STATE_FILE` by default).
+    Thread-safe.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.SYNC_STATE_FILE
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as fp:
+                self.repos = json.load(fp)["repos"]
+        except FileNotFoundError:
+            self.repos = {}
+
+    def pushed_at(self, url):
+        """Last seen `pushed_at` of the repo at `url` (or None)."""
+        try:
+            return isoparse(self.repos[url]["pushed_at"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def sha(self, record):
+        """
+        Commit sha of the default branch seen by the last run, if
+        the repo `record` was not pushed since (otherwise None).
+        """
+        try:
+            seen = self.repos[record["html_url"]]
+        except KeyError:
+            return None
+
+        if seen.get("pushed_at") and \
+           seen.get("pushed_at") == record.get("pushed_at") and \
+           seen.get("branch") == record.get("default_branch"):
+            return seen.get("sha")
+
+        return None
+
+    def update(self, record, sha=None):
+        with self.lock:
+            self.repos[record["html_url"]] = {
+                "pushed_at": record.get("pushed_at"),
+                "branch": record.get("default_branch"),
+                "sha": sha,
+                "synced_at": datetime.utcnow().isoformat()
+                }
+
+    def save(self):
+        # Write-then-rename, so that a crash doesn't leave a
+        # truncated state behind.
+        with self.lock:
+            tmp = ensure_dir(self.path) + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump({"repos": self.repos}, fp, indent=4)
+            os.replace(tmp, self.path)
 
 
 class GazetteerCollector:
@@ -101,17 +402,145 @@ class GazetteerCollector:
             (if provided)!
         :kwargs wait: <int> seconds after processing one repo
             (necessary only when processing huge amount of repos).
+        :kwargs incremental: <bool> skip repos that were not pushed
+            since the last run, and documents that did not change
+            (by git sha of their file) in the rest (default False,
+            ignored with `rebuild`).
+        :kwargs pushed_after: <datetime> (timezone-aware) skip repos
+            that were not pushed since then.
+        :kwargs state_file: <str> where to keep the last seen state
+            of repos (default `settings.SYNC_STATE_FILE`).
+        :kwargs unpack: <str> how repository archives are read, one
+            of UNPACK_MODES (default "archive").
+        :kwargs cache_archives: <bool> keep downloaded archives
+            (by commit sha) in `archives.ArchiveCache` for re-runs
+            (default `settings.ARCHIVE_CACHE`).
+        :kwargs workers: <int> number of processes decoding and
+            transforming features (default `settings.INGEST_WORKERS`),
+            1 means everything is done in the current process.
+        :kwargs files_per_task: <int> number of files sent to a
+            worker at once (default `settings.INGEST_FILES_PER_TASK`).
+        :kwargs simplify: <bool> simplify geometries before indexing
+            (requires numpy, default False), see
+            `geometry.GeometrySimplifier`.
+        :kwargs tolerance: <dict> placetype -> simplification
+            tolerance (default `settings.GEOMETRY_TOLERANCE`).
+        :kwargs precision: <int> decimal places kept in coordinates
+            when simplifying (default `settings.GEOMETRY_PRECISION`).
+        :kwargs metrics_json: <str> path to dump metrics summary
+            as JSON after `process` (default `settings.METRICS_JSON`).
+        :kwargs metrics_textfile: <str> path to dump metrics in
+            Prometheus text format (default `settings.METRICS_TEXTFILE`).
+        :kwargs errors_kept: <int> number of the last error messages
+            kept in `stat.errors` (default `settings.ERRORS_KEPT`),
+            counters cover all of them.
+        :kwargs error_log: <str> NDJSON file to append every error
+            to (default `settings.ERROR_LOG_FILE`).
+        :kwargs hierarchy: <bool> materialize ancestors of all places
+            after processing (default `settings.MATERIALIZE_HIERARCHY`),
+            see `hierarchy.HierarchyMaterializer`.
+        :kwargs bulk: <bool> index with the bulk API (default True),
+            otherwise every document is saved separately.
+        :kwargs chunk_size: <int> max number of documents in one
+            bulk request (default `settings.ES_BULK_CHUNK_SIZE`).
+        :kwargs max_chunk_bytes: <int> max size of one bulk request
+            in bytes (default `settings.ES_BULK_MAX_BYTES`).
+        :kwargs threads: <int> number of threads sending bulk
+            requests in parallel (default `settings.ES_BULK_THREADS`).
+        :kwargs max_retries: <int> retries of bulk items rejected with
+            429 (default `settings.ES_BULK_MAX_RETRIES`), not done with
+            `threads` > 1.
+        :kwargs initial_backoff: <float> seconds before the first
+            retry, doubled every next one (default
+            `settings.ES_BULK_BACKOFF`).
+        :kwargs bulk_load: <bool> tune the index for bulk indexing
+            while processing (default `settings.ES_BULK_LOAD`), see
+            `elastic.bulk_load`. Only the new version of a `rebuild`
+            or an empty index is tuned, not the one serving queries.
+        :kwargs force_merge: <int> number of segments to merge the
+            index to after a bulk load (default
+            `settings.ES_FORCE_MERGE_SEGMENTS`, 0 - no merge).
+        :kwargs index: <str> index to load documents into (default
+            that of `elastic.Place`).
+        :kwargs rebuild: <bool> load everything into a new version
+            of the index, and swap the alias to it when done (default
+            False), see `versions.IndexVersions`. A legacy plain index
+            named as the alias has to be migrated first.
+        :kwargs journal: <bool> keep the journal of the run, so that
+            the next run resumes it if interrupted (default
+            `settings.INGEST_JOURNAL`), see `journal.Journal`.
+        :kwargs journal_file: <str> default `settings.JOURNAL_FILE`.
+        :kwargs resume: <bool> resume an interrupted run (default
+            True), otherwise start from scratch.
         """
+        settings.configure_logging()
         self.user = user or USER
         self.errors = []
-        self.init_stat()
+
+        # Accumulated over the lifetime of the collector.
+        self.metrics = Metrics()
+        self.stat_lock = threading.Lock()
+        self.journal = None
+        self.progress = None
+        self.github_limited = False
         self.repos_url = "https://api.github.com/users/{}/repos".format(self.user)
 
         patterns = kwargs.pop("patterns", None)
         if patterns:
             kwargs.update({"patterns": ensure_list(patterns)})
+        pushed_after = kwargs.get("pushed_after")
+        if pushed_after is not None and (
+                not isinstance(pushed_after, datetime) or
+                pushed_after.utcoffset() is None):
+            raise UnsupportedValueError(
+                "`pushed_after` should be a timezone-aware <datetime> "
+                "(currently: {!r})".format(pushed_after))
         kwargs["wait"] = kwargs.get("wait", 0)
+        kwargs["unpack"] = kwargs.get("unpack", UNPACK_ARCHIVE)
+        kwargs["rebuild"] = kwargs.get("rebuild", False)
+        kwargs["incremental"] = kwargs.get("incremental", False) and \
+            not kwargs["rebuild"]
+        kwargs["index"] = kwargs.get("index")
+        kwargs["journal"] = kwargs.get("journal", settings.INGEST_JOURNAL)
+        kwargs["journal_file"] = kwargs.get(
+            "journal_file", settings.JOURNAL_FILE)
+        kwargs["resume"] = kwargs.get("resume", True)
+        kwargs["cache_archives"] = kwargs.get(
+            "cache_archives", settings.ARCHIVE_CACHE)
+        kwargs["workers"] = kwargs.get("workers", settings.INGEST_WORKERS)
+        kwargs["files_per_task"] = kwargs.get(
+            "files_per_task", settings.INGEST_FILES_PER_TASK)
+        kwargs["bulk"] = kwargs.get("bulk", True)
+        kwargs["chunk_size"] = kwargs.get(
+            "chunk_size", settings.ES_BULK_CHUNK_SIZE)
+        kwargs["max_chunk_bytes"] = kwargs.get(
+            "max_chunk_bytes", settings.ES_BULK_MAX_BYTES)
+        kwargs["threads"] = kwargs.get("threads", settings.ES_BULK_THREADS)
+        kwargs["max_retries"] = kwargs.get(
+            "max_retries", settings.ES_BULK_MAX_RETRIES)
+        kwargs["initial_backoff"] = kwargs.get(
+            "initial_backoff", settings.ES_BULK_BACKOFF)
+        kwargs["metrics_json"] = kwargs.get(
+            "metrics_json", settings.METRICS_JSON)
+        kwargs["metrics_textfile"] = kwargs.get(
+            "metrics_textfile", settings.METRICS_TEXTFILE)
+        kwargs["hierarchy"] = kwargs.get(
+            "hierarchy", settings.MATERIALIZE_HIERARCHY)
+        kwargs["bulk_load"] = kwargs.get("bulk_load", settings.ES_BULK_LOAD)
+        kwargs["force_merge"] = kwargs.get(
+            "force_merge", settings.ES_FORCE_MERGE_SEGMENTS)
+        kwargs["errors_kept"] = kwargs.get("errors_kept", settings.ERRORS_KEPT)
+        kwargs["error_log"] = kwargs.get("error_log", settings.ERROR_LOG_FILE)
         self.params = RecordDict(**kwargs)
+        self.init_stat()
+        self.simplifier = None
+        if self.params.get("simplify"):
+            self.simplifier = GeometrySimplifier(
+                tolerance=self.params.get(
+                    "tolerance", settings.GEOMETRY_TOLERANCE),
+                precision=self.params.get(
+                    "precision", settings.GEOMETRY_PRECISION))
+        self.sync_state = SyncState(self.params.get("state_file"))
         self.repos = self.collect_repos()
 
     def _validate_url__match(self, url):
@@ -122,8 +551,23 @@ class GazetteerCollector:
             return True
 
     def _validate_repo__pushed(self, repo):
-        #TODO: add "modified_after" condition here
-        # return repo["pushed_at"] >= self.pushed_after
+        try:
+            pushed_at = isoparse(repo["pushed_at"])
+        except (KeyError, TypeError, ValueError):
+            # Unknown - better process it.
+            return True
+
+        pushed_after = self.params.get("pushed_after")
+        if pushed_after and pushed_at <= pushed_after:
+            return False
+
+        if self.params.incremental:
+            seen = self.sync_state.pushed_at(repo[self.html_url])
+            if seen and pushed_at <= seen:
+                LOG.debug("Not pushed since the last sync: %s",
+                          repo[self.html_url])
+                return False
+
         return True
 
     def clean(self, record):
@@ -147,13 +591,10 @@ class GazetteerCollector:
                 .format(self.html_url, json.dumps(record, indent=4)))
             return False
 
-        if self._validate_url__match(url):
+        if self._validate_url__match(url) and \
+           self._validate_repo__pushed(record):
             return self.clean(record)
 
-        #TODO: add "modified_after" condition here
-        # if repo["pushed_at"] <= self.pushed_after:
-        #     continue
-
         return False
 
     def collect_repos(self):
@@ -164,13 +605,16 @@ class GazetteerCollector:
                     "Keyword argument `repos` should be of the type <list>! Currently: <{}>"\
                     .format(type(repos_raw).__name__))
         else:
-            repos_raw = read_github(self.repos_url)
+            repos_raw = iter_github(self.repos_url, cache=HTTPCache(),
+                                    workers=settings.GITHUB_WORKERS)
 
         repos = []
-        for repo in repos_raw:
-            validated = self._validate_repo(repo)
-            if validated:
-                repos.append(validated)
+        with self.metrics.stage("discover"):
+            for repo in repos_raw:
+                validated = self._validate_repo(repo)
+                if validated:
+                    repos.append(validated)
+        self.metrics.add("discover", count=len(repos))
 
         return repos
 
@@ -179,66 +623,505 @@ class GazetteerCollector:
             self.repos = self.collect_repos()
 
     def init_stat(self):
-        self.stat = RecordDict(errors=[], success=[])
+        """
+        Counters of the run, memory doesn't grow with its length:
+        `success` is the number of indexed documents, `errors` is
+        `metrics.ErrorLog`.
+        """
+        stat = getattr(self, "stat", None)
+        if stat is not None:
+            stat.errors.close()
+
+        self.stat = RecordDict(
+            errors=ErrorLog(self.params.errors_kept, self.params.error_log),
+            success=0, skipped=0, vertices=0, vertices_simplified=0)
+
+    def count(self, key, value=1):
+        """
+        Adds `value` to the counter `key` of `stat` (thread-safe:
+        with `threads` > 1 documents are produced in another thread
+        than the results are counted in).
+        """
+        with self.stat_lock:
+            self.stat[key] += value
+
+    def report_error(self, msg, type_=None, repo=None, feature_id=None):
+        LOG.error(msg)
+        self.stat.errors.add(msg, type_=type_, repo=repo,
+                             feature_id=feature_id)
+
+    def log_error(self, exc, repo=None, feature_id=None):
+        self.report_error(format_error(exc), type_=type(exc).__name__,
+                          repo=repo, feature_id=feature_id)
+
+    def collect_actions(self, results, repo=None):
+        """
+        Reports errors and counters from (action, error, info)
+        `results` of transformation, yields actions.
+        """
+        for action, error, info in results:
+            for key, val in info.items():
+                if key in TIMED_STAGES:
+                    self.metrics.add(key, seconds=val[0], count=val[1],
+                                     repo=repo)
+                else:
+                    self.count(key, val)
+
+            if error is None:
+                if self.params.index:
+                    action["_index"] = self.params.index
+                yield action
+            else:
+                feature_id, exc = error
+                self.log_error(exc, repo=repo, feature_id=feature_id)
+
+    def make_pool(self):
+        """Process pool for `transform` (None if not needed)."""
+        if self.params.workers > 1:
+            return ProcessPoolExecutor(max_workers=self.params.workers)
+
+        return None
+
+    def transform(self, files, pool=None, base_url=None, repo=None):
+        """
+        Yields bulk actions made of `files` - (name, content) pairs.
+        If `pool` is given, files are decoded and transformed there
+        in batches of `files_per_task`, but actions (and errors) come
+        out in the original order.
+
+        Time spent on parsing and preparing documents (in workers,
+        if any) is recorded per `repo` as "parse" and "prepare"
+        stages of `metrics`.
+        """
+        if pool is None:
+            batches = (transform_file(name, raw, base_url=base_url,
+                                      simplifier=self.simplifier)
+                       for name, raw in files)
+        else:
+            tasks = ((chunk, base_url, self.simplifier) for chunk in iter_chunks(
+                files, self.params.files_per_task))
+            batches = imap_ordered(pool, transform_files, tasks,
+                                   window=2 * self.params.workers)
+
+        for batch in batches:
+            yield from self.collect_actions(batch, repo=repo)
+
+    def skip_unchanged(self, actions):
+        """
+        Drops actions for documents already indexed with the same
+        `github_sha` (checked with one `_mget` per chunk).
+        """
+        client = elastic.Place._get_connection()
+        for chunk in iter_chunks(actions, self.params.chunk_size):
+            resp = client.mget(body={"ids": [a["_id"] for a in chunk]},
+                               index=chunk[0]["_index"],
+                               _source_includes=["github_sha"])
+            yield from self.drop_unchanged(chunk, resp)
+
+    def drop_unchanged(self, chunk, resp):
+        """
+        Yields actions of `chunk` except for those stored with the
+        same `github_sha` according to `resp` of `_mget`.
+        """
+        stored = {}
+        for doc in resp["docs"]:
+            if doc.get("found"):
+                stored[doc["_id"]] = doc["_source"].get("github_sha")
+
+        for action in chunk:
+            sha = action["_source"].get("github_sha")
+            if sha and stored.get(str(action["_id"])) == sha:
+                self.count("skipped")
+                continue
+            yield action
 
     def register(self, data, stat=None):
+        """
+        :param data: <dict> or iterable of features - consumed
+            lazily, so that a generator keeps memory bounded by the
+            size of a bulk chunk.
+        """
         if isinstance(data, dict):
             data = [data]
 
-        for feature in data:
-            type_ = feature.get("type", "")
-            if type_.lower() != "feature":
-                msg = "Only records of the type 'feature' are supported (currently: {})\n{}"\
-                    .format(type_, json.dumps(feature, indent=4))
-                msg = format_error(UnsupportedValueError(msg))
-                LOG.error(msg)
-                self.stat.errors.append(msg)
-                continue
-
-            try:
-                place = elastic.Place(meta={"remap": True}, **feature)
-            except KeyError:
-                msg = "Record doesn't contain 'properties':\n{}".format(
-                    json.dumps(feature, indent=4))
-                msg = format_error(MissingDataError(msg))
-                LOG.error(msg)
-                self.stat.errors.append(msg)
-                continue
+        results = (transform_feature(feature, self.simplifier)
+                   for feature in data)
+        self.index(self.collect_actions(results))
 
-            except MissingDataError as exc:
-                msg = format_error(exc)
-                LOG.error(msg)
-                self.stat.errors.append(msg)
-                continue
+    def index(self, actions, repo=None):
+        """Errors are reported per `repo` (if given)."""
+        if self.params.bulk:
+            self._index_bulk(actions, repo=repo)
+        else:
+            self._index_each(actions, repo=repo)
 
+    def _index_each(self, actions, repo=None):
+        client = elastic.Place._get_connection()
+        for action in actions:
             try:
-                place.save()
+                client.index(index=action["_index"], id=action["_id"],
+                             body=action["_source"])
             except Exception as exc:
-                msg = format_error(exc)
-                LOG.error(msg)
-                self.stat.errors.append(msg)
+                self.log_error(exc, repo=repo, feature_id=action["_id"])
+                status = getattr(exc, "status_code", None)
+                if isinstance(status, int):
+                    self.acknowledge(action["_id"], status)
             else:
-                LOG.debug("Indexed: %s", place.meta["id"])
-                self.stat.success.append(place.meta["id"])
+                LOG.debug("Indexed: %s", action["_id"])
+                self.count("success")
+                self.acknowledge(action["_id"])
+
+    def _index_bulk(self, actions, repo=None):
+        """
+        Sends documents to the index in chunks of `chunk_size` docs
+        (or `max_chunk_bytes`), failed items don't stop the process,
+        but are reported into `stat.errors`.
+        """
+        client = TimedClient(elastic.Place._get_connection(), self.metrics)
+        params = {
+            "chunk_size": self.params.chunk_size,
+            "max_chunk_bytes": self.params.max_chunk_bytes,
+            "raise_on_error": False,
+            "raise_on_exception": False
+            }
+        if self.params.threads > 1:
+            # Documents are pulled by the task handler thread.
+            actions = self.metrics.handoff(actions)
+            results = parallel_bulk(client, actions,
+                                    thread_count=self.params.threads,
+                                    **params)
+        else:
+            results = streaming_bulk(
+                client, actions, max_retries=self.params.max_retries,
+                initial_backoff=self.params.initial_backoff, **params)
+
+        for ok, item in results:
+            self.count_bulk_result(ok, item, repo=repo)
+
+    def count_bulk_result(self, ok, item, repo=None, progress=None):
+        """
+        Counts an (ok, item) result of a bulk helper in `stat`,
+        acknowledges it to `progress` (default the current one).
+        """
+        _, info = item.popitem()
+        if ok:
+            self.count("success")
+            self.acknowledge(info.get("_id"), progress=progress)
+            return
+
+        # Not for items of a failed request (no "status" or 5xx).
+        status = info.get("status")
+        if isinstance(status, int) and "exception" not in info:
+            self.acknowledge(info.get("_id"), status, progress=progress)
+
+        # Error of ES (e.g. mapper_parsing_exception) as the type.
+        error = info.get("error")
+        type_ = error.get("type") if isinstance(error, dict) else None
+        msg = "Failed to index {}: {}".format(info.get("_id"), error)
+        self.report_error(
+            format_error(RequestFailedError(msg)),
+            type_=type_ or RequestFailedError.__name__,
+            repo=repo, feature_id=info.get("_id"))
 
     def process(self):
         self.ensure_repos()
         self.init_stat()
+        self.github_limited = False
         elastic.setup()
-        for record in self.repos:
-            LOG.debug("Processing %s", record["name"])
-            url_zip = record[self.html_url]
-            if not url_zip.endswith("/"):
-                url_zip += "/"
+        versions = IndexVersions() if self.params.rebuild else None
+        if versions is not None and versions.is_legacy():
+            # The alias could not be created over it after the load.
+            raise UnsupportedValueError(
+                "{} is a plain index created before versioning, migrate "
+                "it before a rebuild: IndexVersions().migrate()"\
+                .format(versions.alias))
+        if self.params.journal:
+            self.start_journal()
+        if versions is not None:
+            resumed = self.journal is not None and \
+                self.journal.run.index_name
+            if resumed and not versions.client.indices.exists(
+                    index=self.journal.run.index_name):
+                LOG.warning("Index %s of the interrupted rebuild is gone, "
+                            "starting over", self.journal.run.index_name)
+                self.journal.start(resume=False)
+                resumed = False
+            if resumed:
+                # Resumed rebuild continues loading into its index.
+                self.params.index = self.journal.run.index_name
+            else:
+                # Versions left by failed rebuilds are not resumed.
+                versions.cleanup(building=[])
+                self.params.index = versions.create()
+                if self.journal is not None:
+                    self.journal.set_index(self.params.index)
+        pool = self.make_pool()
+        try:
+            with self.metrics.run():
+                with self.bulk_load():
+                    self._process_repos(pool)
+                if self.params.hierarchy:
+                    self.materialize_hierarchy()
+
+            complete = True
+            if versions is not None:
+                # Only a complete rebuild goes live.
+                complete = self.swap_rebuilt(versions)
+            if self.journal is not None and complete:
+                self.journal.finish()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.stat.errors.close()
+            self.dump_metrics()
+
+        LOG.debug("Done.\n\tTotal indexed: %d", self.stat.success)
+        if self.stat.skipped:
+            LOG.debug("\tTotal unchanged: %d", self.stat.skipped)
+        if self.simplifier is not None:
+            LOG.debug("\tVertices: %d (simplified to %d)",
+                      self.stat.vertices, self.stat.vertices_simplified)
+        if self.stat.errors:
+            LOG.debug("\tTotal errors: %d", len(self.stat.errors))
+            for type_, count in self.stat.errors.by_type.most_common():
+                LOG.debug("\t\t%s: %d", type_, count)
+        self.log_metrics()
+
+    def swap_rebuilt(self, versions):
+        """
+        Points the alias to the rebuilt index and deletes old versions
+        if the run is clean. Otherwise the new version is left as is,
+        unaliased, for the next run to resume (if `journal`) or to
+        delete (see `versions.IndexVersions.cleanup`).
+
+        :return: <bool> is the alias moved?
+        """
+        if self.stat.errors:
+            LOG.error("Rebuild into %s failed for %d documents, the alias "
+                      "is left as is", self.params.index,
+                      len(self.stat.errors))
+            return False
+
+        versions.swap(self.params.index)
+        versions.cleanup(building=[])
+        return True
+
+    def start_journal(self):
+        """
+        Opens the journal and resumes the interrupted run (if any
+        and `resume`) or starts a new one.
+        """
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = Journal(self.params.journal_file)
+        run = self.journal.start(resume=self.params.resume)
+        if run.resumed and bool(run.index_name) != bool(self.params.rebuild):
+            # Progress of a rebuild is that of another index.
+            run = self.journal.start(resume=False)
+
+        return run
+
+    def acknowledge(self, doc_id, status=None, progress=None):
+        """
+        Document `doc_id` is done with: indexed or rejected for good
+        (by `status` 4xx, but 429) - as opposed to not sent or
+        failed for the time being.
+
+        :param progress: `journal.RepoProgress` (default the one of
+            the repo being indexed).
+        """
+        progress = self.progress if progress is None else progress
+        if progress is None:
+            return
+        if status is None or (400 <= status < 500 and status != 429):
+            progress.ack(doc_id)
+
+    @contextmanager
+    def bulk_load(self):
+        """
+        Context of indexing: `elastic.bulk_load` if `bulk_load`, its
+        own time (changing settings, refresh and merge) is recorded
+        as "bulk_load" stage.
+        """
+        if not self.params.bulk_load:
+            yield
+            return
+        if not self.is_offline():
+            LOG.debug("Index is serving queries, not tuned for bulk load")
+            yield
+            return
+
+        with self.metrics.stage("bulk_load"):
+            with elastic.bulk_load(index=self.params.index,
+                                   max_segments=self.params.force_merge):
+                yield
+
+    def is_offline(self):
+        """
+        Does the index not serve queries yet: is it the new version
+        of a `rebuild` (not aliased until the end) or empty?
+        """
+        if self.params.rebuild:
+            return True
+
+        client = elastic.Place._get_connection()
+        index = self.params.index or elastic.Place._index._name
+        return client.count(index=index)["count"] == 0
+
+    def materialize_hierarchy(self):
+        with self.metrics.stage("hierarchy"):
+            stat = HierarchyMaterializer(
+                index=self.params.index,
+                chunk_size=self.params.chunk_size).materialize()
+        self.metrics.add("hierarchy", count=stat.updated)
+        if stat.errors:
+            self.report_error(
+                "Failed to update hierarchy of {} documents".format(
+                    stat.errors), type_="HierarchyUpdateError")
+
+    def log_metrics(self):
+        summary = self.metrics.summary()
+        LOG.debug("Wall time: %.1f s", summary.wall_time)
+        for name, stage in sorted(summary.stages.items(),
+                                  key=lambda item: -item[1]["seconds"]):
+            LOG.debug("\t%-14s %9.1f s %10d items %12d bytes%s", name,
+                      stage["seconds"], stage["count"], stage["bytes"],
+                      " ({:.1f}/s)".format(stage["per_sec"])
+                      if stage["per_sec"] else "")
+
+    def dump_metrics(self):
+        """Writes metrics to the files given in params (if any)."""
+        try:
+            if self.params.metrics_json:
+                self.metrics.dump_json(self.params.metrics_json)
+            if self.params.metrics_textfile:
+                self.metrics.dump_prometheus(self.params.metrics_textfile)
+        except OSError as exc:
+            LOG.error("Cannot dump metrics: %s", format_error(exc))
+
+    def commit_sha(self, record):
+        """
+        Sha of the last commit to the default branch of the repo
+        (None if it can't be obtained). A repo not pushed since the
+        last run costs no request (see `SyncState.sha`), and once
+        GitHub refuses requests over the rate limit, the rest of
+        repos aren't asked for (set `settings.GITHUB_TOKEN` for a
+        higher limit).
+        """
+        sha = self.sync_state.sha(record)
+        if sha or self.github_limited:
+            return sha
+
+        full_name = record.get("full_name") or "{}/{}".format(
+            self.user, record["name"])
+        url = "https://api.github.com/repos/{}/commits/{}".format(
+            full_name, record["default_branch"])
+        try:
+            _, body = fetch(url, cache=HTTPCache())
+            return json.loads(body)["sha"]
+        except RateLimitedError as exc:
+            self.github_limited = True
+            LOG.error("Archives of the rest of repos are not cached, "
+                      "commits are not known: %s", format_error(exc))
+            return None
+        except Exception as exc:
+            LOG.error("Cannot obtain last commit of %s: %s",
+                      full_name, format_error(exc))
+            return None
+
+    def make_cache(self):
+        """`archives.ArchiveCache` for `_process_repos` (or None)."""
+        if self.params.cache_archives and \
+           self.params.unpack != UNPACK_STREAM:
+            return ArchiveCache()
+
+        return None
+
+    def archive_of(self, record, sha=None):
+        """
+        Archive of the repo `record`: that of the commit `sha` if
+        given (it can be cached, the one of the branch changes over
+        time).
+
+        :return: <RecordDict> url, key (in `archives.ArchiveCache`,
+            None without `sha`), filename, base_url (see `source_url`).
+        """
+        url_zip = record[self.html_url]
+        if not url_zip.endswith("/"):
+            url_zip += "/"
+        if sha:
+            url_zip += "archive/{}.zip".format(sha)
+        else:
             url_zip += "archive/refs/heads/{}.zip".format(
                 record["default_branch"])
-            fname = record["name"] + ".zip"
-            data = process_repo(url_zip, fname)
-            self.register(data)
+
+        return RecordDict(
+            url=url_zip,
+            key="{}-{}".format(record["name"], sha) if sha else None,
+            filename=record["name"] + ".zip",
+            base_url="{}/blob/{}".format(
+                record[self.html_url].rstrip("/"), record["default_branch"]))
+
+    def _process_repos(self, pool):
+        cache = self.make_cache()
+        for record in self.repos:
+            LOG.debug("Processing %s", record["name"])
+            sha = self.commit_sha(record) if cache is not None else None
+            archive = self.archive_of(record, sha)
+            base_url = archive.base_url
+            errors_before = len(self.stat.errors)
+
+            # Files are streamed from the repo through transformation
+            # straight into the index, chunk by chunk.
+            # Every stage pulls from the previous one, and only its
+            # own (exclusive) time is recorded.
+            name = record["name"]
+            progress = None
+            if self.journal is not None:
+                progress = self.journal.repo(
+                    record[self.html_url],
+                    version=sha or record.get("pushed_at"),
+                    batch_size=self.params.chunk_size)
+                if progress.done:
+                    LOG.debug("Indexed by the interrupted run: %s", name)
+                    continue
+
+            files = iter_repo(archive.url, archive.filename,
+                              unpack=self.params.unpack, cache=cache,
+                              key=archive.key, metrics=self.metrics,
+                              repo=name)
+            files = self.metrics.timed("unzip", files, repo=name,
+                                       size=lambda item: len(item[1]))
+            if progress is not None:
+                files = progress.skip_done(
+                    files, key=lambda n, url=base_url: source_url(url, n))
+            actions = self.metrics.timed("transform", self.transform(
+                files, pool, base_url=base_url, repo=name), repo=name)
+            if self.params.incremental:
+                actions = self.metrics.timed(
+                    "diff", self.skip_unchanged(actions), repo=name)
+            if progress is not None:
+                actions = progress.track(
+                    actions, key=lambda a: a["_source"].get("source_url"))
+            indexed_before = self.stat.success
+            self.progress = progress
+            try:
+                with self.metrics.stage("index", repo=name):
+                    self.index(actions, repo=name)
+            finally:
+                self.progress = None
+            self.metrics.add("index", repo=name,
+                             count=self.stat.success - indexed_before)
+            if progress is not None:
+                progress.finish()
+
+            # Only a clean run lets the next one skip the repo.
+            if len(self.stat.errors) == errors_before:
+                self.sync_state.update(record, sha=sha)
+                self.sync_state.save()
 
             # Wait if necessary...
             time.sleep(self.params.wait)
-
-        LOG.debug("Done.\n\tTotal indexed: %d", len(self.stat.success))
-        if self.stat.errors:
-            LOG.debug("\tTotal errors: %d", len(self.stat.errors))
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+Journal of ingestion runs (SQLite), so that a run that died halfway
+(OOM, ES out of retries) is resumed by the next one: repositories
+and files already indexed are skipped, only the unacknowledged tail
+is replayed.
+
+A file is done when all of its documents are acknowledged by ES (as
+indexed or failed - failures are reported anyway). Completions are
+committed once per bulk batch of acknowledged documents, so a crash
+loses at most one batch of progress: those documents are indexed
+again, which is harmless, as their ids stay the same.
+"""
+
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from genery.utils import RecordDict
+
+from geoometa.conf import settings
+from geoometa.core.utils import ensure_dir
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    index_name TEXT
+);
+CREATE TABLE IF NOT EXISTS repos (
+    run_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    version TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    acked INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    PRIMARY KEY (run_id, url)
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL,
+    repo TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (run_id, repo, name)
+) WITHOUT ROWID;
+"""
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+class Journal:
+    """
+    Runs, repositories and files of ingestion, stored in `path`
+    (default `settings.JOURNAL_FILE`). Thread-safe: transactions
+    are serialized by `lock`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.JOURNAL_FILE
+        self.db = sqlite3.connect(ensure_dir(self.path),
+                                  check_same_thread=False)
+        self.lock = threading.RLock()
+        # WAL: a commit is an append, readers don't block.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.run = None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self, resume=True):
+        """
+        Resumes the last run if it didn't finish (and `resume`),
+        otherwise starts a new one, forgetting progress of the
+        previous runs.
+
+        :return: <RecordDict> id, index_name, resumed.
+        """
+        with self.lock:
+            return self._start(resume)
+
+    def _start(self, resume):
+        row = self.db.execute(
+            "SELECT id, index_name, finished_at FROM runs "
+            "ORDER BY id DESC LIMIT 1").fetchone()
+        if resume and row is not None and row[2] is None:
+            self.run = RecordDict(id=row[0], index_name=row[1], resumed=True)
+            LOG.debug("Resuming ingestion run %d", row[0])
+            return self.run
+
+        with self.db:
+            if row is not None and row[2] is None:
+                # Not resumed: closed as is.
+                self.db.execute("UPDATE runs SET finished_at = ? "
+                                "WHERE id = ?", (_now(), row[0]))
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM repos")
+            cursor = self.db.execute(
+                "INSERT INTO runs (started_at) VALUES (?)", (_now(),))
+        self.run = RecordDict(id=cursor.lastrowid, index_name=None,
+                              resumed=False)
+        return self.run
+
+    def set_index(self, name):
+        """Index the run loads into (kept for resuming a rebuild)."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE runs SET index_name = ? WHERE id = ?",
+                            (name, self.run.id))
+        self.run.index_name = name
+
+    def finish(self):
+        with self.lock, self.db:
+            self.db.execute("UPDATE runs SET finished_at = ? WHERE id = ?",
+                            (_now(), self.run.id))
+
+    def repo(self, url, version=None, batch_size=None, autocommit=True):
+        """
+        :param version: <str> of the repo (commit sha or push time),
+            progress of another version is dropped.
+        :param batch_size: <int> acknowledged documents per commit
+            (default `settings.ES_BULK_CHUNK_SIZE`).
+        :param autocommit: <bool> commit every `batch_size` in `ack`,
+            otherwise the caller commits (when `due`).
+        :return: `RepoProgress`
+        """
+        with self.lock:
+            return self._repo(url, version, batch_size, autocommit)
+
+    def _repo(self, url, version, batch_size, autocommit):
+        row = self.db.execute(
+            "SELECT version, done FROM repos WHERE run_id = ? AND url = ?",
+            (self.run.id, url)).fetchone()
+        if row is not None and row[0] != version:
+            LOG.debug("%s changed since the interrupted run", url)
+            with self.db:
+                self.db.execute("DELETE FROM files WHERE run_id = ? AND "
+                                "repo = ?", (self.run.id, url))
+            row = None
+
+        if row is None:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO repos (run_id, url, version, "
+                    "updated_at) VALUES (?, ?, ?, ?)",
+                    (self.run.id, url, version, _now()))
+
+        done_files = {name for (name,) in self.db.execute(
+            "SELECT name FROM files WHERE run_id = ? AND repo = ?",
+            (self.run.id, url))}
+        return RepoProgress(self, url, done=bool(row and row[1]),
+                            done_files=done_files, batch_size=batch_size,
+                            autocommit=autocommit)
+
+
+class RepoProgress:
+    """
+    Progress of one repository: `track` the actions sent to the
+    index, `ack` results as they come. Thread-safe: with `threads`
+    actions are tracked in the thread sending bulk requests while
+    results are acknowledged in the collector's one.
+    """
+
+    def __init__(self, journal, url, done=False, done_files=None,
+                 batch_size=None, autocommit=True):
+        self.journal = journal
+        self.url = url
+        self.done = done
+        self.done_files = done_files or set()
+        self.batch_size = batch_size or settings.ES_BULK_CHUNK_SIZE
+        self.autocommit = autocommit
+        self.pending = {}
+        self.inflight = {}
+        self.emitted = set()
+        self.completed = []
+        self.unsaved = 0
+        self.lock = threading.RLock()
+
+    def skip_done(self, files, key):
+        """
+        Drops (name, content) `files` completed before.
+
+        :param key: function of a file name giving the key it is
+            tracked with (that `track` gets from actions).
+        """
+        skipped = 0
+        for name, raw in files:
+            if key(name) in self.done_files:
+                skipped += 1
+                continue
+            yield name, raw
+
+        if skipped:
+            LOG.debug("%s: %d files done before", self.url, skipped)
+
+    def track(self, actions, key):
+        """
+        Passes actions through, remembering files (by `key` of an
+        action) they come from. Documents of a file come together,
+        so all of them are sent when the next file begins.
+        """
+        current = None
+        for action in actions:
+            name = key(action)
+            with self.lock:
+                if name != current:
+                    self._emitted(current)
+                    current = name
+                self.pending[name] = self.pending.get(name, 0) + 1
+                self.inflight[str(action["_id"])] = name
+            yield action
+
+        with self.lock:
+            self._emitted(current)
+
+    def _emitted(self, name):
+        if name is None:
+            return
+        self.emitted.add(name)
+        self._check(name)
+
+    def _check(self, name):
+        if name in self.emitted and not self.pending.get(name):
+            self.pending.pop(name, None)
+            self.emitted.discard(name)
+            self.completed.append(name)
+
+    def ack(self, doc_id):
+        """Document `doc_id` is acknowledged by ES."""
+        with self.lock:
+            name = self.inflight.pop(str(doc_id), None)
+            if name is None:
+                return
+
+            self.pending[name] -= 1
+            self._check(name)
+            self.unsaved += 1
+            if self.autocommit and self.due:
+                self.commit()
+
+    @property
+    def due(self):
+        """Is a batch of acknowledged documents to be committed?"""
+        return self.unsaved >= self.batch_size
+
+    def commit(self):
+        """Saves files completed so far (as one acknowledged batch)."""
+        with self.lock:
+            if not (self.unsaved or self.completed):
+                return
+
+            db, run_id = self.journal.db, self.journal.run.id
+            with self.journal.lock, db:
+                db.executemany(
+                    "INSERT OR IGNORE INTO files (run_id, repo, name) "
+                    "VALUES (?, ?, ?)",
+                    [(run_id, self.url, name) for name in self.completed])
+                db.execute(
+                    "UPDATE repos SET batches = batches + 1, "
+                    "acked = acked + ?, updated_at = ? "
+                    "WHERE run_id = ? AND url = ?",
+                    (self.unsaved, _now(), run_id, self.url))
+            self.done_files.update(self.completed)
+            self.completed = []
+            self.unsaved = 0
+
+    def finish(self):
+        """
+        The whole repository is sent: it is done, unless some of
+        the documents are not acknowledged (their files are replayed
+        by the next run then).
+        """
+        self.commit()
+        with self.lock:
+            inflight = len(self.inflight)
+        if inflight:
+            LOG.debug("%s: %d documents not acknowledged", self.url,
+                      inflight)
+            return
+
+        db = self.journal.db
+        with self.journal.lock, db:
+            db.execute("UPDATE repos SET done = 1, updated_at = ? "
+                       "WHERE run_id = ? AND url = ?",
+                       (_now(), self.journal.run.id, self.url))
+        self.done = True
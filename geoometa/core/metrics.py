@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ingestion metrics: wall time, counts and bytes per stage (and per
+repository), latency histograms, and their dumps as JSON or in
+Prometheus textfile format. Bounded accounting of errors.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from datetime import datetime, timezone
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from genery.utils import RecordDict
+
+from geoometa.core.utils import ensure_dir
+
+
+# Upper bounds of latency histogram buckets (seconds).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+PROMETHEUS_PREFIX = "geoometa_ingest"
+
+# Longer error messages are truncated (in memory and on disk).
+MAX_MESSAGE = 1000
+
+
+class Histogram:
+    """Cumulative histogram of observed values (thread-safe)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.total += value
+            self.count += 1
+
+    def summary(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "buckets": buckets
+            }
+
+
+class _Stage:
+    __slots__ = ("seconds", "count", "bytes")
+
+    def __init__(self):
+        self.seconds = 0.
+        self.count = 0
+        self.bytes = 0
+
+    def summary(self):
+        return {
+            "seconds": self.seconds,
+            "count": self.count,
+            "bytes": self.bytes,
+            "per_sec": self.count / self.seconds if self.seconds else None,
+            "bytes_per_sec": self.bytes / self.seconds if self.seconds else None
+            }
+
+
+class Metrics:
+    """
+    Records time spent in every stage of the ingestion. Stages
+    nest (e.g. "index" pulls documents from "transform", which
+    pulls files from "unzip"), and only exclusive time counts for
+    each of them, so that the stage times add up to the total and
+    show where the bottleneck is.
+
+    Stages recorded with `add` only (e.g. "parse" and "prepare",
+    measured inside worker processes) are not nested and break
+    down the time of the stage that waits for them.
+
+    Stages nest per thread. An iterable consumed by another thread
+    (e.g. documents pulled by the task handler of `parallel_bulk`)
+    is wrapped with `handoff`, so that time spent producing its
+    elements is still nested in the stage that handed it off.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.repos = {}
+        self.histograms = {}
+        self.wall_time = 0.
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def add(self, name, seconds=0., count=0, nbytes=0, repo=None):
+        """Adds to the stage `name` (and `repo`, if given)."""
+        with self.lock:
+            targets = [self.stages]
+            if repo:
+                targets.append(self.repos.setdefault(repo, {}))
+            for stages in targets:
+                try:
+                    stage = stages[name]
+                except KeyError:
+                    stage = stages[name] = _Stage()
+                stage.seconds += seconds
+                stage.count += count
+                stage.bytes += nbytes
+
+    def _enter(self):
+        # Time of nested stages (a cell: `handoff` adds to it from
+        # other threads).
+        self._stack().append([0.])
+        return time.perf_counter()
+
+    def _exit(self, started):
+        """:return: <float> exclusive time since `started`."""
+        elapsed = time.perf_counter() - started
+        stack = self._stack()
+        with self.lock:
+            nested = stack.pop()[0]
+            if stack:
+                stack[-1][0] += elapsed
+        return max(elapsed - nested, 0.)
+
+    @contextmanager
+    def stage(self, name, repo=None, count=0, nbytes=0):
+        started = self._enter()
+        try:
+            yield
+        finally:
+            self.add(name, self._exit(started), count, nbytes, repo)
+
+    def timed(self, name, iterable, repo=None, size=None):
+        """
+        Wraps `iterable`, so that time spent producing elements is
+        recorded as the stage `name` (elements are counted, their
+        bytes too if `size` function is given).
+        """
+        iterator = iter(iterable)
+        while True:
+            started = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, self._exit(started), repo=repo)
+                return
+            except BaseException:
+                self._exit(started)
+                raise
+
+            nbytes = size(item) if size else 0
+            self.add(name, self._exit(started), 1, nbytes, repo)
+            yield item
+
+    def handoff(self, iterable):
+        """
+        Wraps `iterable` to be consumed by another thread: time
+        spent producing its elements there is nested in the stage
+        current here (if any), as if it was consumed here. Stages
+        timed while producing them are recorded as usual.
+        """
+        # Not a generator itself: the stage is taken from this thread.
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        return self._handed_off(iterable, parent)
+
+    def _handed_off(self, iterable, parent):
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                if parent is not None:
+                    with self.lock:
+                        parent[0] += time.perf_counter() - started
+            yield item
+
+    def histogram(self, name):
+        with self.lock:
+            try:
+                return self.histograms[name]
+            except KeyError:
+                hist = self.histograms[name] = Histogram()
+                return hist
+
+    @contextmanager
+    def run(self):
+        """Measures wall time of the whole run."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall_time += time.perf_counter() - started
+
+    def summary(self):
+        """
+        :return: <RecordDict> with "wall_time", "stages", "repos"
+            (stages per repository) and "histograms".
+        """
+        return RecordDict(
+            wall_time=self.wall_time,
+            stages={k: v.summary() for k, v in self.stages.items()},
+            repos={repo: {k: v.summary() for k, v in stages.items()}
+                   for repo, stages in self.repos.items()},
+            histograms={k: v.summary() for k, v in self.histograms.items()}
+            )
+
+    def dump_json(self, path):
+        _write(path, json.dumps(self.summary(), indent=4))
+
+    def dump_prometheus(self, path, prefix=PROMETHEUS_PREFIX):
+        """
+        Writes metrics in Prometheus text format (e.g. for the node
+        exporter's textfile collector).
+        """
+        summary = self.summary()
+        lines = [
+            "# TYPE {}_wall_seconds gauge".format(prefix),
+            "{}_wall_seconds {}".format(prefix, summary["wall_time"])
+            ]
+        for metric in ("seconds", "count", "bytes"):
+            lines.append("# TYPE {}_stage_{} gauge".format(prefix, metric))
+            for name, stage in sorted(summary["stages"].items()):
+                lines.append('{}_stage_{}{{stage="{}"}} {}'.format(
+                    prefix, metric, name, stage[metric]))
+            for repo, stages in sorted(summary["repos"].items()):
+                for name, stage in sorted(stages.items()):
+                    lines.append('{}_stage_{}{{stage="{}",repo="{}"}} {}'.format(
+                        prefix, metric, name, repo, stage[metric]))
+
+        for name, hist in sorted(summary["histograms"].items()):
+            metric = "{}_{}".format(prefix, name)
+            lines.append("# TYPE {} histogram".format(metric))
+            for bound, count in hist["buckets"].items():
+                lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    metric, bound, count))
+            lines.append("{}_sum {}".format(metric, hist["sum"]))
+            lines.append("{}_count {}".format(metric, hist["count"]))
+
+        _write(path, "\n".join(lines) + "\n")
+
+
+def body_size(body):
+    """Bytes of a request `body` as sent (<str> is sent as UTF-8)."""
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+
+    return len(body)
+
+
+class TimedClient:
+    """
+    Elasticsearch client proxy recording latency and size of bulk
+    requests (everything else is passed to the client as is).
+    """
+
+    def __init__(self, client, metrics, histogram="bulk_request_seconds"):
+        self.client = client
+        self.metrics = metrics
+        self.latency = metrics.histogram(histogram)
+
+    def bulk(self, body, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.client.bulk(body, *args, **kwargs)
+        finally:
+            self.latency.observe(time.perf_counter() - started)
+            self.metrics.add("bulk_requests", count=1,
+                             nbytes=body_size(body))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class ErrorLog:
+    """
+    Errors of a run in constant memory: total count, counts per
+    error type and per repository, the first message of every
+    type, and the last `capacity` messages. Optionally every error
+    (feature id, type, repo and message, never the feature itself)
+    is appended to an NDJSON file at `path`. Thread-safe.
+    """
+
+    def __init__(self, capacity=1000, path=None):
+        self.count = 0
+        self.by_type = Counter()
+        self.by_repo = Counter()
+        self.examples = {}
+        self.recent = deque(maxlen=capacity)
+        self.path = path
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.recent)
+
+    def add(self, message, type_=None, repo=None, feature_id=None):
+        """
+        :param message: <str>
+        :param type_: <str> error class (e.g. exception name).
+        :param repo: <str> repository name.
+        :param feature_id: id of the feature (or file name).
+        """
+        message = message[:MAX_MESSAGE]
+        type_ = type_ or "Error"
+        with self.lock:
+            self.count += 1
+            self.by_type[type_] += 1
+            if repo:
+                self.by_repo[repo] += 1
+            self.examples.setdefault(type_, message)
+            self.recent.append(message)
+
+            if self.path:
+                self._spill({
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "id": feature_id,
+                    "type": type_,
+                    "repo": repo,
+                    "message": message
+                    })
+
+    def _spill(self, record):
+        if self.fp is None:
+            self.fp = open(ensure_dir(self.path), "a", buffering=1)
+        self.fp.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+    def summary(self):
+        with self.lock:
+            return RecordDict(
+                count=self.count,
+                by_type=dict(self.by_type),
+                by_repo=dict(self.by_repo),
+                examples=dict(self.examples),
+                recent=list(self.recent)
+                )
+
+
+def _write(path, content):
+    # Write-then-rename: collectors never see partial files.
+    tmp = ensure_dir(path) + ".tmp"
+    with open(tmp, "w") as fp:
+        fp.write(content)
+    os.replace(tmp, path)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact name index of the gazetteer for lookups without
+Elasticsearch (e.g. candidate places for a geoparser).
+
+Names of places (as produced by `elastic.Place.prepare`) are
+kept twice: normalized (exact lookups) and case/diacritic-folded
+(folded and prefix lookups). Every name points to a packed list
+of places, best ranked first (by population, then placetype).
+
+The index is written to a single file and read via mmap, so
+loading it is instant and the pages are shared between processes.
+"""
+
+import os
+import sys
+import json
+import mmap
+import heapq
+import struct
+import unicodedata
+from array import array
+from collections import namedtuple
+
+from elasticsearch.helpers import scan
+
+from geoometa.core.exceptions import MalformedValueError, \
+     UnsupportedValueError
+from geoometa.core.hierarchy import PLACETYPE_RANK, UNKNOWN_RANK
+from geoometa.core.utils import ensure_dir
+
+
+MAGIC = b"GEONIDX1"
+
+# Letters that don't decompose into base + combining mark.
+FOLD_TABLE = str.maketrans({
+    "ø": "o", "đ": "d", "ð": "d", "ł": "l", "ı": "i", "ħ": "h",
+    "æ": "ae", "œ": "oe", "þ": "th"
+    })
+
+# Sections of the file (in this order), arrays are in the native
+# byte order (recorded in the header).
+SECTIONS = (
+    ("ids", "q"),
+    ("populations", "q"),
+    ("placetypes", "H"),
+    ("placetype_names", None),
+    ("exact_key_offsets", "Q"),
+    ("exact_keys", None),
+    ("exact_posting_offsets", "Q"),
+    ("exact_postings", "I"),
+    ("folded_key_offsets", "Q"),
+    ("folded_keys", None),
+    ("folded_posting_offsets", "Q"),
+    ("folded_postings", "I"),
+    )
+HEADER = struct.Struct("<8sc7x" + "QQ" * len(SECTIONS))
+ALIGN = 8
+
+Match = namedtuple("Match", ["id", "placetype", "population"])
+
+
+def normalize(name):
+    """Unicode (NFC) normalized `name` with collapsed whitespace."""
+    return " ".join(unicodedata.normalize("NFC", name).split())
+
+
+def fold(name):
+    """Case and diacritic insensitive form of `name`."""
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(name.casefold().translate(FOLD_TABLE).split())
+
+
+def rank_key(place_id, placetype, population):
+    """Places with bigger population (then higher placetype) first."""
+    return (-(population or 0),
+            PLACETYPE_RANK.get(placetype, UNKNOWN_RANK),
+            place_id)
+
+
+class NameIndexBuilder:
+    """Collects names of places and writes `NameIndex` files."""
+
+    def __init__(self):
+        self.places = {}
+        self.exact = {}
+        self.folded = {}
+
+    def add(self, place_id, names, placetype=None, population=None):
+        """
+        :param place_id: <int>
+        :param names: <list> of <str>
+        :param placetype: <str>
+        :param population: <int> or None
+        """
+        place_id = int(place_id)
+        self.places[place_id] = (placetype, population)
+        for name in names:
+            if not isinstance(name, str) or not name.strip():
+                continue
+            self.exact.setdefault(normalize(name), set()).add(place_id)
+            self.folded.setdefault(fold(name), set()).add(place_id)
+
+    def add_document(self, place_id, doc):
+        """
+        :param doc: <dict> of Place fields, e.g. the output of
+            `elastic.Place.prepare` or `_source` of a document.
+        """
+        names = list(doc.get("names") or [])
+        if doc.get("name"):
+            names.append(doc["name"])
+
+        try:
+            population = int(doc.get("population") or 0)
+        except (TypeError, ValueError):
+            population = 0
+
+        self.add(place_id, names, doc.get("placetype"), population)
+
+    def add_from_index(self, client, index, scroll_size=5000):
+        """Adds every document of the `index`."""
+        hits = scan(client, index=index, size=scroll_size, query={
+            "_source": ["name", "names", "placetype", "population"]})
+        for hit in hits:
+            self.add_document(hit["_id"], hit.get("_source", {}))
+
+    def write(self, path):
+        """Writes the index file (atomically)."""
+        order = sorted(self.places, key=lambda i: rank_key(
+            i, *self.places[i]))
+        position = {place_id: n for n, place_id in enumerate(order)}
+        placetype_names = sorted({pt or "" for pt, _ in self.places.values()})
+        codes = {name: n for n, name in enumerate(placetype_names)}
+
+        data = {
+            "ids": array("q", order),
+            "populations": array("q", (self.places[i][1] or 0
+                                       for i in order)),
+            "placetypes": array("H", (codes[self.places[i][0] or ""]
+                                      for i in order)),
+            "placetype_names": json.dumps(placetype_names).encode("utf-8")
+            }
+        for section, names in (("exact", self.exact),
+                               ("folded", self.folded)):
+            data.update(_pack_keys(section, names, position))
+
+        tmp = ensure_dir(path) + ".tmp"
+        with open(tmp, "wb") as fp:
+            fp.write(b"\0" * HEADER.size)
+            table = []
+            for name, _ in SECTIONS:
+                fp.write(b"\0" * (-fp.tell() % ALIGN))
+                blob = data[name]
+                blob = blob.tobytes() if isinstance(blob, array) else blob
+                table.extend((fp.tell(), len(blob)))
+                fp.write(blob)
+
+            fp.seek(0)
+            byteorder = b"L" if sys.byteorder == "little" else b"B"
+            fp.write(HEADER.pack(MAGIC, byteorder, *table))
+
+        os.replace(tmp, path)
+        return path
+
+
+def _pack_keys(section, names, position):
+    """Sorted keys and postings (ranked) of one section."""
+    encoded = sorted((key.encode("utf-8"), ids) for key, ids in names.items())
+    key_offsets, post_offsets = array("Q", [0]), array("Q", [0])
+    keys, postings = bytearray(), array("I")
+    for key, ids in encoded:
+        keys += key
+        key_offsets.append(len(keys))
+        postings.extend(sorted(position[i] for i in ids))
+        post_offsets.append(len(postings))
+
+    return {
+        section + "_key_offsets": key_offsets,
+        section + "_keys": bytes(keys),
+        section + "_posting_offsets": post_offsets,
+        section + "_postings": postings
+        }
+
+
+class _Section:
+    """Sorted keys with postings, on top of the mapped file."""
+
+    def __init__(self, data, base, key_offsets, postings, posting_offsets):
+        """
+        :param data: mmap, keys start at `base` offset in it.
+        """
+        self.data = data
+        self.base = base
+        self.key_offsets = key_offsets
+        self.postings = postings
+        self.posting_offsets = posting_offsets
+        self.size = len(key_offsets) - 1
+
+    def key(self, n):
+        base = self.base
+        return self.data[base+self.key_offsets[n]:base+self.key_offsets[n+1]]
+
+    def bisect(self, key):
+        """Position of the first key >= `key`."""
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def find(self, key):
+        n = self.bisect(key)
+        if n < self.size and self.key(n) == key:
+            return self.posting(n)
+        return ()
+
+    def posting(self, n):
+        return self.postings[self.posting_offsets[n]:
+                             self.posting_offsets[n+1]]
+
+    def prefixed(self, prefix):
+        """Postings of all keys starting with `prefix`."""
+        n = self.bisect(prefix)
+        while n < self.size:
+            if not self.key(n).startswith(prefix):
+                break
+            yield self.posting(n)
+            n += 1
+
+
+class NameIndex:
+    """
+    Read-only name index mapped from the file written by
+    `NameIndexBuilder` (see the module docstring).
+
+    Lookups return lists of `Match` (id, placetype, population),
+    best ranked first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.fp.close()
+            raise MalformedValueError("Empty name index file: {}".format(path))
+
+        try:
+            self._load()
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self):
+        if len(self.mm) < HEADER.size:
+            raise MalformedValueError(
+                "Not a name index file: {}".format(self.path))
+
+        header = HEADER.unpack_from(self.mm)
+        if header[0] != MAGIC:
+            raise MalformedValueError(
+                "Not a name index file: {}".format(self.path))
+
+        byteorder = "little" if header[1] == b"L" else "big"
+        if byteorder != sys.byteorder:
+            raise UnsupportedValueError(
+                "Name index {} was written on a {}-endian machine".format(
+                    self.path, byteorder))
+
+        view = memoryview(self.mm)
+        self.views = [view]
+        sections, offsets = {}, {}
+        for n, (name, fmt) in enumerate(SECTIONS):
+            offset, length = header[2 + 2*n], header[3 + 2*n]
+            if offset + length > len(self.mm):
+                raise MalformedValueError(
+                    "Truncated name index file: {}".format(self.path))
+            offsets[name] = offset
+            section = view[offset:offset+length]
+            sections[name] = section.cast(fmt) if fmt else section
+            self.views.extend((section, sections[name]))
+
+        self.ids = sections["ids"]
+        self.populations = sections["populations"]
+        self.placetypes = sections["placetypes"]
+        self.placetype_names = json.loads(
+            bytes(sections["placetype_names"]).decode("utf-8"))
+        self.exact_keys, self.folded_keys = [
+            _Section(self.mm, offsets[s + "_keys"],
+                     sections[s + "_key_offsets"],
+                     sections[s + "_postings"],
+                     sections[s + "_posting_offsets"])
+            for s in ("exact", "folded")]
+
+    def close(self):
+        # Views have to be released before the map is closed.
+        for view in reversed(getattr(self, "views", [])):
+            view.release()
+        self.views = []
+        self.mm.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _match(self, n):
+        placetype = self.placetype_names[self.placetypes[n]] or None
+        return Match(self.ids[n], placetype, self.populations[n] or None)
+
+    def _matches(self, positions, limit):
+        if limit is not None:
+            positions = positions[:limit]
+        return [self._match(n) for n in positions]
+
+    def exact(self, name, limit=None):
+        """Places named exactly `name` (up to unicode normalization)."""
+        positions = self.exact_keys.find(normalize(name).encode("utf-8"))
+        return self._matches(positions, limit)
+
+    def folded(self, name, limit=None):
+        """Places named `name`, case and diacritics ignored."""
+        positions = self.folded_keys.find(fold(name).encode("utf-8"))
+        return self._matches(positions, limit)
+
+    def prefix(self, prefix, limit=10):
+        """
+        Places with a name starting with `prefix` (case and
+        diacritics ignored), best ranked first.
+
+        :param limit: <int> (None - all, can be a lot).
+        """
+        prefix = fold(prefix).encode("utf-8")
+        if not prefix:
+            return []
+
+        # Postings are sorted by rank: merge them and stop as soon
+        # as there are enough distinct places.
+        merged = heapq.merge(*self.folded_keys.prefixed(prefix))
+        matches, last = [], None
+        for n in merged:
+            if n == last:
+                continue
+            last = n
+            matches.append(self._match(n))
+            if limit is not None and len(matches) >= limit:
+                break
+
+        return matches
+
+    def lookup(self, name, limit=None):
+        """Exact matches if any, folded otherwise."""
+        return self.exact(name, limit) or self.folded(name, limit)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local reverse geocoding: which places contain a point, answered
+without Elasticsearch.
+
+Polygons of places are kept as packed arrays of edges, bboxes of
+places are put into a regular grid, and points are processed in
+batches: grouped by grid cell, filtered by bboxes of candidate
+places and tested with vectorized point-in-polygon (even-odd rule,
+so holes and multipolygons need no special handling).
+
+Requires numpy (optional dependency of the package).
+"""
+
+import math
+import logging
+
+from elasticsearch.helpers import scan
+
+from geoometa.conf import settings
+from geoometa.core.geometry import np, _require_numpy, ring_edges, \
+     points_in_polygon
+from geoometa.core.hierarchy import PLACETYPE_RANK, UNKNOWN_RANK
+from geoometa.core.utils import ensure_dir
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+# Grid cell size (degrees).
+CELL_SIZE = 1.0
+
+
+def _rings(geometry):
+    """Rings of a (multi)polygon as lists of positions."""
+    type_ = (geometry.get("type") or "").lower()
+    coordinates = geometry.get("coordinates") or []
+    if type_ == "polygon":
+        return list(coordinates)
+    if type_ == "multipolygon":
+        return [ring for polygon in coordinates for ring in polygon]
+    if type_ == "geometrycollection":
+        return [ring for geom in geometry.get("geometries", [])
+                for ring in _rings(geom)]
+    return []
+
+
+class ReverseGeocoderBuilder:
+    """Collects polygons of places and builds `ReverseGeocoder`."""
+
+    def __init__(self):
+        _require_numpy()
+        self.ids = []
+        self.placetypes = []
+        self.edges = []
+
+    def add(self, place_id, geometry, placetype=None):
+        """
+        :param geometry: <dict> GeoJSON-like, places without
+            (multi)polygons are ignored.
+        :return: <bool> added or not.
+        """
+        rings = [ring_edges(ring) for ring in _rings(geometry or {})]
+        rings = [edges for edges in rings if len(edges)]
+        if not rings:
+            return False
+
+        self.ids.append(int(place_id))
+        self.placetypes.append(placetype or "")
+        self.edges.append(np.vstack(rings))
+        return True
+
+    def add_document(self, place_id, doc):
+        """
+        :param doc: <dict> of Place fields (e.g. `_source` of a
+            document or the output of `elastic.Place.prepare`).
+        """
+        return self.add(place_id, doc.get("geometry"), doc.get("placetype"))
+
+    def add_from_index(self, client, index, scroll_size=500):
+        """Adds every place of the `index` that has a polygon."""
+        hits = scan(client, index=index, size=scroll_size,
+                    query={"_source": ["geometry", "placetype"]})
+        for hit in hits:
+            self.add_document(hit["_id"], hit.get("_source", {}))
+
+    def build(self, cell_size=CELL_SIZE):
+        placetype_names = sorted(set(self.placetypes))
+        codes = {name: n for n, name in enumerate(placetype_names)}
+        sizes = [len(edges) for edges in self.edges]
+        edges = np.vstack(self.edges) if self.edges else np.empty((0, 4))
+        edge_offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=edge_offsets[1:])
+
+        bboxes = np.empty((len(sizes), 4))
+        for n, place_edges in enumerate(self.edges):
+            bboxes[n] = (place_edges[:, 0].min(), place_edges[:, 1].min(),
+                         place_edges[:, 0].max(), place_edges[:, 1].max())
+
+        geocoder = ReverseGeocoder(
+            ids=np.asarray(self.ids, dtype=np.int64),
+            placetypes=np.asarray([codes[p] for p in self.placetypes],
+                                  dtype=np.uint16),
+            placetype_names=np.asarray(placetype_names, dtype=str),
+            edges=edges, edge_offsets=edge_offsets, bboxes=bboxes,
+            cell_size=cell_size)
+        LOG.debug("Reverse geocoder: %d places, %d edges",
+                  len(self.ids), len(edges))
+        return geocoder
+
+
+class ReverseGeocoder:
+    """
+    Finds places containing points (see the module docstring),
+    build it with `ReverseGeocoderBuilder` or `load` a saved one.
+    """
+
+    def __init__(self, ids, placetypes, placetype_names, edges,
+                 edge_offsets, bboxes, cell_size=CELL_SIZE,
+                 cell_offsets=None, cell_items=None):
+        _require_numpy()
+        self.ids = ids
+        self.placetypes = placetypes
+        self.placetype_names = [str(p) for p in placetype_names]
+        self.edges = edges
+        self.edge_offsets = edge_offsets
+        self.bboxes = bboxes
+        self.cell_size = float(cell_size)
+        self.columns = int(math.ceil(360 / self.cell_size))
+        self.rows = int(math.ceil(180 / self.cell_size))
+        if cell_offsets is None:
+            cell_offsets, cell_items = self._grid()
+        self.cell_offsets = cell_offsets
+        self.cell_items = cell_items
+
+        # Top down order of places containing a point.
+        type_rank = np.asarray([PLACETYPE_RANK.get(p, UNKNOWN_RANK)
+                                for p in self.placetype_names] or [0])
+        self.ranks = type_rank[placetypes] if len(placetypes) \
+            else np.empty(0, dtype=int)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _column(self, xs):
+        return np.clip(((xs + 180) // self.cell_size).astype(np.int64),
+                       0, self.columns - 1)
+
+    def _row(self, ys):
+        return np.clip(((ys + 90) // self.cell_size).astype(np.int64),
+                       0, self.rows - 1)
+
+    def _grid(self):
+        """Places per grid cell (CSR: offsets and items)."""
+        col0, col1 = self._column(self.bboxes[:, 0]), \
+            self._column(self.bboxes[:, 2])
+        row0, row1 = self._row(self.bboxes[:, 1]), self._row(self.bboxes[:, 3])
+        cells, items = [], []
+        for place in range(len(self.ids)):
+            rows = np.arange(row0[place], row1[place] + 1)
+            cols = np.arange(col0[place], col1[place] + 1)
+            place_cells = (rows[:, None] * self.columns + cols).ravel()
+            cells.append(place_cells)
+            items.append(np.full(len(place_cells), place, dtype=np.int64))
+
+        cells = np.concatenate(cells) if cells else np.empty(0, np.int64)
+        items = np.concatenate(items) if items else np.empty(0, np.int64)
+        order = np.argsort(cells, kind="stable")
+        offsets = np.zeros(self.rows * self.columns + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.rows * self.columns),
+                  out=offsets[1:])
+        return offsets, items[order]
+
+    def contains(self, lats, lons, placetypes=None):
+        """
+        Batch reverse geocoding.
+
+        :param lats: array-like of latitudes.
+        :param lons: array-like of longitudes.
+        :param placetypes: <list> of placetypes to look for (None -
+            all).
+        :return: <tuple> of two <numpy.ndarray> - indices of points
+            and ids of places containing them, ordered by point,
+            and then from the top down by placetype.
+        """
+        lats = np.asarray(lats, dtype=float).ravel()
+        lons = np.asarray(lons, dtype=float).ravel()
+        allowed = None
+        if placetypes is not None:
+            codes = [n for n, p in enumerate(self.placetype_names)
+                     if p in set(placetypes)]
+            allowed = np.isin(self.placetypes, codes)
+
+        valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+        cells = self._row(lats[valid]) * self.columns + self._column(lons[valid])
+        order = np.argsort(cells, kind="stable")
+        cells, points = cells[order], valid[order]
+        uniq, starts = np.unique(cells, return_index=True)
+        ends = np.append(starts[1:], len(cells))
+
+        found_points, found_places = [], []
+        for cell, start, end in zip(uniq, starts, ends):
+            candidates = self.cell_items[self.cell_offsets[cell]:
+                                         self.cell_offsets[cell+1]]
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            if not len(candidates):
+                continue
+
+            cell_points = points[start:end]
+            xs, ys = lons[cell_points], lats[cell_points]
+            for place in candidates:
+                minx, miny, maxx, maxy = self.bboxes[place]
+                in_bbox = (xs >= minx) & (xs <= maxx) & \
+                    (ys >= miny) & (ys <= maxy)
+                if not in_bbox.any():
+                    continue
+
+                edges = self.edges[self.edge_offsets[place]:
+                                   self.edge_offsets[place+1]]
+                inside = points_in_polygon(xs[in_bbox], ys[in_bbox], edges)
+                hits = cell_points[in_bbox][inside]
+                found_points.append(hits)
+                found_places.append(np.full(len(hits), place))
+
+        if not found_points:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        found_points = np.concatenate(found_points)
+        found_places = np.concatenate(found_places)
+        order = np.lexsort((self.ranks[found_places], found_points))
+        return found_points[order], self.ids[found_places[order]]
+
+    def reverse(self, lats, lons, placetypes=None):
+        """
+        :return: <list> of <list> of place ids (from the top down)
+            per point, see `contains`.
+        """
+        points, ids = self.contains(lats, lons, placetypes)
+        results = [[] for _ in range(np.size(lats))]
+        for point, place_id in zip(points.tolist(), ids.tolist()):
+            results[point].append(place_id)
+
+        return results
+
+    def lookup(self, lat, lon, placetypes=None):
+        """Places containing one point (from the top down)."""
+        return self.reverse([lat], [lon], placetypes)[0]
+
+    def save(self, path):
+        """Saves arrays to `path` (.npz)."""
+        with open(ensure_dir(path), "wb") as fp:
+            np.savez(fp, ids=self.ids, placetypes=self.placetypes,
+                     placetype_names=np.asarray(self.placetype_names,
+                                                dtype=str),
+                     edges=self.edges, edge_offsets=self.edge_offsets,
+                     bboxes=self.bboxes, cell_size=self.cell_size,
+                     cell_offsets=self.cell_offsets,
+                     cell_items=self.cell_items)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(ids=data["ids"], placetypes=data["placetypes"],
+                       placetype_names=data["placetype_names"],
+                       edges=data["edges"], edge_offsets=data["edge_offsets"],
+                       bboxes=data["bboxes"],
+                       cell_size=float(data["cell_size"]),
+                       cell_offsets=data["cell_offsets"],
+                       cell_items=data["cell_items"])
@@ -0,0 +1,898 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for Elasticsearch: a small HTTP server in the
+current process implementing the subset of the API the package
+uses, to exercise and profile ingestion and queries without a
+cluster:
+
+- indices: exists, create, delete, settings, mapping, refresh,
+  aliases, `_reindex` (done synchronously, tasks are completed
+  right away);
+- documents: index, get, `_bulk`, `_mget`;
+- search: `_search` (with scroll), `_count`, `_msearch`, with the
+  basic queries (bool, term(s), ids, match, multi_match,
+  match_phrase, prefix, exists, range, geo_shape by bbox) and
+  min/max aggregations.
+
+Artificial latency and failures (of whole requests and of bulk
+items) can be injected, reproducibly with a `seed`.
+
+    with StandIn(latency=0.005, item_failure_rate=0.01) as server:
+        set_client(server.client())
+        ...
+
+Documents are searchable right away (refresh is a no-op).
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import socket
+import logging
+import fnmatch
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from geoometa.conf import settings
+from geoometa.core.utils import format_error
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+SCROLL_SIZE = 10
+
+# Requests are sent to the stand-in as they are (no retries, which
+# would distort measurements).
+CLIENT_CONN = {"max_retries": 0, "retry_on_timeout": False}
+
+
+class StandInError(Exception):
+    """Error returned to the client as ES does it."""
+
+    def __init__(self, status, type_, reason):
+        super().__init__(reason)
+        self.status = status
+        self.type = type_
+        self.reason = reason
+
+    def body(self):
+        return {
+            "error": {"type": self.type, "reason": self.reason,
+                      "root_cause": [{"type": self.type,
+                                      "reason": self.reason}]},
+            "status": self.status
+            }
+
+
+def _field_values(source, path):
+    """Values of the field `path` (dotted) in `source`, flattened."""
+    values = [source]
+    for part in path.split("."):
+        found = []
+        for val in values:
+            if isinstance(val, dict) and part in val:
+                found.append(val[part])
+        if not found:
+            return []
+        values = []
+        for val in found:
+            values.extend(val if isinstance(val, list) else [val])
+
+    return values
+
+
+def _values(source, path):
+    values = _field_values(source, path)
+    if not values and "." in path:
+        # Sub-field of a multi-field (e.g. "names.en").
+        values = _field_values(source, path.rsplit(".", 1)[0])
+    return values
+
+
+def _tokens(text):
+    return re.findall(r"\w+", str(text).lower())
+
+
+def _equal(value, expected):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return float(value) == float(expected)
+        except (TypeError, ValueError):
+            return False
+    return str(value) == str(expected)
+
+
+def _field_arg(clause):
+    """(field, argument) of a clause like {"field": ...}."""
+    ((field, arg),) = [(k, v) for k, v in clause.items()
+                       if k not in ("boost", "_name")]
+    return field, arg
+
+
+def matches(query, doc_id, source):
+    """Does the document match the (basic) `query`?"""
+    if not query:
+        return True
+
+    ((kind, clause),) = query.items()
+    if kind == "match_all":
+        return True
+
+    if kind == "bool":
+        for key in ("must", "filter"):
+            if not all(matches(q, doc_id, source)
+                       for q in _as_list(clause.get(key))):
+                return False
+        if any(matches(q, doc_id, source)
+               for q in _as_list(clause.get("must_not"))):
+            return False
+        should = _as_list(clause.get("should"))
+        required = clause.get("minimum_should_match")
+        if required is None:
+            required = 0 if (clause.get("must") or clause.get("filter")) \
+                else 1
+        return not should or \
+            sum(matches(q, doc_id, source) for q in should) >= int(required)
+
+    if kind == "ids":
+        return doc_id in [str(i) for i in clause.get("values", [])]
+
+    if kind == "exists":
+        return bool(_values(source, clause["field"]))
+
+    if kind == "multi_match":
+        query_tokens = _tokens(clause["query"])
+        check = all if clause.get("operator", "or").lower() == "and" \
+            else any
+        for field in clause.get("fields", []):
+            field = field.split("^")[0].rstrip("*").rstrip(".")
+            tokens = set()
+            for val in _values(source, field):
+                tokens.update(_tokens(val))
+            if query_tokens and check(t in tokens for t in query_tokens):
+                return True
+        return False
+
+    field, arg = _field_arg(clause)
+    values = _values(source, field)
+    if kind == "term":
+        expected = arg.get("value") if isinstance(arg, dict) else arg
+        return any(_equal(v, expected) for v in values)
+
+    if kind == "terms":
+        return any(_equal(v, e) for v in values for e in arg)
+
+    if kind == "prefix":
+        expected = arg.get("value") if isinstance(arg, dict) else arg
+        return any(str(v).startswith(str(expected)) for v in values)
+
+    if kind in ("match", "match_phrase"):
+        text = arg.get("query") if isinstance(arg, dict) else arg
+        if kind == "match_phrase":
+            phrase = " ".join(_tokens(text))
+            return any(phrase in " ".join(_tokens(v)) for v in values)
+        query_tokens = _tokens(text)
+        operator = arg.get("operator", "or") if isinstance(arg, dict) \
+            else "or"
+        tokens = set()
+        for val in values:
+            tokens.update(_tokens(val))
+        check = all if operator.lower() == "and" else any
+        return bool(query_tokens) and check(t in tokens for t in query_tokens)
+
+    if kind == "range":
+        for op, bound in arg.items():
+            check = {"gt": lambda v: v > bound, "gte": lambda v: v >= bound,
+                     "lt": lambda v: v < bound, "lte": lambda v: v <= bound}
+            if op in check and not any(_compare(check[op], v)
+                                       for v in values):
+                return False
+        return True
+
+    if kind == "geo_shape":
+        # Bbox of the document is the shape (good enough here).
+        lon, lat = arg["shape"]["coordinates"][:2]
+        bbox = source.get("bbox") or []
+        return len(bbox) == 4 and \
+            bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+    raise StandInError(400, "parsing_exception",
+                       "Query [{}] is not supported by the stand-in"\
+                       .format(kind))
+
+
+def _compare(check, value):
+    try:
+        return check(value)
+    except TypeError:
+        return False
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _filter_source(source, includes=None, excludes=None):
+    if includes:
+        source = {k: v for k, v in source.items()
+                  if any(k == i or k.startswith(i + ".") or
+                         i.startswith(k + ".") for i in includes)}
+    if excludes:
+        source = {k: v for k, v in source.items() if k not in excludes}
+    return source
+
+
+class Store:
+    """Indices and documents of the stand-in (thread-safe)."""
+
+    def __init__(self):
+        self.indices = {}
+        self.scrolls = {}
+        self.tasks = {}
+        self.lock = threading.RLock()
+
+    def index(self, name, create=False):
+        try:
+            return self.indices[name]
+        except KeyError:
+            if not create:
+                raise StandInError(404, "index_not_found_exception",
+                                   "no such index [{}]".format(name))
+
+        index = self.indices[name] = {
+            "settings": {"index": {"number_of_shards": "1",
+                                   "number_of_replicas": "1"}},
+            "mappings": {"properties": {}},
+            "aliases": {},
+            "docs": {}
+            }
+        return index
+
+    def resolve(self, names):
+        """Index names for (comma separated) names or aliases."""
+        if names in (None, "", "_all", "*"):
+            return list(self.indices)
+
+        if isinstance(names, str):
+            names = names.split(",")
+        resolved = []
+        for name in names:
+            if name in self.indices:
+                resolved.append(name)
+                continue
+            if "*" in name:
+                # Wildcards match nothing without an error.
+                resolved.extend(i for i in self.indices
+                                if fnmatch.fnmatchcase(i, name))
+                continue
+            aliased = [i for i, index in self.indices.items()
+                       if name in index["aliases"]]
+            if not aliased:
+                raise StandInError(404, "index_not_found_exception",
+                                   "no such index [{}]".format(name))
+            resolved.extend(aliased)
+
+        return resolved
+
+    def write_index(self, name):
+        """Index to write into for `name` (created if necessary)."""
+        indices = [i for i, index in self.indices.items()
+                   if name in index["aliases"]]
+        if len(indices) == 1:
+            return indices[0]
+        writable = [i for i in indices if self.indices[i]["aliases"][name]\
+                    .get("is_write_index")]
+        if writable:
+            return writable[0]
+        if indices:
+            raise StandInError(
+                400, "illegal_argument_exception",
+                "no write index is defined for alias [{}]".format(name))
+        self.index(name, create=True)
+        return name
+
+
+class StandIn:
+    """Stand-in server (see the module docstring)."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0., jitter=0.,
+                 failure_rate=0., item_failure_rate=0., seed=None):
+        """
+        :param port: <int> 0 - any free port.
+        :param latency: <float> seconds added to every request.
+        :param jitter: <float> max random seconds added on top.
+        :param failure_rate: <float> share of requests answered with
+            503 (any request except HEAD).
+        :param item_failure_rate: <float> share of bulk items
+            rejected with 429 (as when the write queue is full).
+        :param seed: random seed for jitter and failures.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.item_failure_rate = item_failure_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.store = Store()
+        self.stats = Counter()
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        LOG.debug("Elasticsearch stand-in at %s", self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def client(self, **kwargs):
+        """Client of the stand-in (`kwargs` override ES_CONN)."""
+        from geoometa.conf.connections import create_client
+
+        return create_client(hosts=[self.url], **dict(CLIENT_CONN, **kwargs))
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        if not (self.latency or self.jitter):
+            return
+        with self.random_lock:
+            extra = self.random.uniform(0, self.jitter) if self.jitter else 0
+        time.sleep(self.latency + extra)
+
+    # API.
+
+    def route(self, method, path, params, body):
+        """:return: (status, response body)."""
+        parts = [unquote(p) for p in path.split("/") if p]
+        if not parts:
+            return 200, {"name": "standin", "cluster_name": "standin",
+                         "version": {"number": "7.12.0"},
+                         "tagline": "You Know, for Search"}
+
+        if parts[0] in ("_bulk", "_mget", "_msearch", "_search", "_count",
+                        "_refresh", "_alias", "_aliases", "_reindex",
+                        "_tasks"):
+            parts.insert(0, None)
+
+        index, endpoint, rest = parts[0], (parts[1:2] or [None])[0], parts[2:]
+        handler = getattr(self, "api_" + (endpoint or "index").lstrip("_"),
+                          None)
+        if handler is None:
+            raise StandInError(400, "unsupported_operation_exception",
+                               "{} {} is not supported by the stand-in"\
+                               .format(method, path))
+
+        with self.store.lock:
+            self.stats[endpoint or method + " index"] += 1
+            return handler(method, index, rest, params, body)
+
+    def api_index(self, method, index, rest, params, body):
+        store = self.store
+        if method == "HEAD":
+            try:
+                store.resolve(index)
+            except StandInError:
+                return 404, None
+            return 200, None
+
+        if method == "PUT":
+            if index in store.indices:
+                raise StandInError(
+                    400, "resource_already_exists_exception",
+                    "index [{}] already exists".format(index))
+            created = store.index(index, create=True)
+            body = body or {}
+            created["settings"]["index"].update(
+                _flat_settings(body.get("settings", {})))
+            created["mappings"].update(body.get("mappings", {}))
+            created["aliases"].update(body.get("aliases", {}))
+            return 200, {"acknowledged": True, "shards_acknowledged": True,
+                         "index": index}
+
+        if method == "DELETE":
+            for name in store.resolve(index):
+                del store.indices[name]
+            return 200, {"acknowledged": True}
+
+        names = store.resolve(index)
+        return 200, {name: {k: store.indices[name][k]
+                            for k in ("aliases", "mappings", "settings")}
+                     for name in names}
+
+    def api_settings(self, method, index, rest, params, body):
+        names = self.store.resolve(index)
+        if method == "PUT":
+            for name in names:
+                current = self.store.indices[name]["settings"]["index"]
+                for key, val in _flat_settings(body or {}).items():
+                    # null resets a setting to the default.
+                    if val is None:
+                        current.pop(key, None)
+                    else:
+                        current[key] = val
+            return 200, {"acknowledged": True}
+
+        flat = params.get("flat_settings") == "true"
+        resp = {}
+        for name in names:
+            index_settings = self.store.indices[name]["settings"]
+            if flat:
+                index_settings = {"index." + k: v for k, v
+                                  in index_settings["index"].items()}
+            resp[name] = {"settings": index_settings}
+        return 200, resp
+
+    def api_mapping(self, method, index, rest, params, body):
+        names = self.store.resolve(index)
+        if method == "PUT":
+            for name in names:
+                self.store.indices[name]["mappings"].setdefault(
+                    "properties", {}).update((body or {}).get("properties", {}))
+            return 200, {"acknowledged": True}
+
+        return 200, {name: {"mappings": self.store.indices[name]["mappings"]}
+                     for name in names}
+
+    def api_refresh(self, method, index, rest, params, body):
+        self.store.resolve(index)
+        return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+
+    api_flush = api_refresh
+    api_forcemerge = api_refresh
+
+    def api_alias(self, method, index, rest, params, body):
+        store = self.store
+        alias = rest[0] if rest else None
+        found = {}
+        for name in store.resolve(index):
+            aliases = {a: dict(spec) for a, spec
+                       in store.indices[name]["aliases"].items()
+                       if alias is None or fnmatch.fnmatchcase(a, alias)}
+            if aliases or alias is None:
+                found[name] = {"aliases": aliases}
+
+        if alias is not None and not found:
+            if method == "HEAD":
+                return 404, None
+            return 404, {"error": "alias [{}] missing".format(alias),
+                         "status": 404}
+
+        return 200, None if method == "HEAD" else found
+
+    def api_aliases(self, method, index, rest, params, body):
+        """Atomic: all actions are checked before any is applied."""
+        store = self.store
+        actions = []
+        for action in (body or {}).get("actions", []):
+            ((kind, spec),) = action.items()
+            names = store.resolve(spec.get("indices") or spec["index"])
+            actions.append((kind, names, spec))
+
+        removed = {name for kind, names, _ in actions
+                   if kind == "remove_index" for name in names}
+        for kind, names, spec in actions:
+            if kind == "add" and spec["alias"] in store.indices and \
+                    spec["alias"] not in removed:
+                raise StandInError(
+                    400, "invalid_alias_name_exception",
+                    "Invalid alias name [{}]: an index or data stream "
+                    "exists with the same name as the alias"\
+                    .format(spec["alias"]))
+            if kind == "remove":
+                for name in names:
+                    if spec["alias"] not in store.indices[name]["aliases"]:
+                        raise StandInError(
+                            404, "aliases_not_found_exception",
+                            "aliases [{}] missing".format(spec["alias"]))
+            elif kind not in ("add", "remove_index"):
+                raise StandInError(400, "parsing_exception",
+                                   "Unknown action [{}]".format(kind))
+
+        for kind, names, spec in actions:
+            for name in names:
+                if kind == "remove_index":
+                    store.indices.pop(name, None)
+                elif kind == "remove":
+                    store.indices[name]["aliases"].pop(spec["alias"], None)
+                else:
+                    store.indices[name]["aliases"][spec["alias"]] = {
+                        k: v for k, v in spec.items()
+                        if k not in ("index", "indices", "alias")}
+
+        return 200, {"acknowledged": True}
+
+    def api_reindex(self, method, index, rest, params, body):
+        started = time.perf_counter()
+        source, dest = body["source"], body["dest"]["index"]
+        created = updated = total = 0
+        for name in self.store.resolve(source["index"]):
+            for doc_id, (_, doc) in list(
+                    self.store.indices[name]["docs"].items()):
+                if not matches(source.get("query"), doc_id, doc):
+                    continue
+                total += 1
+                item = self._write("index", self.store.write_index(dest),
+                                   doc_id, dict(doc))
+                created += item["status"] == 201
+                updated += item["status"] == 200
+
+        result = {"took": int((time.perf_counter() - started) * 1000),
+                  "timed_out": False, "total": total, "created": created,
+                  "updated": updated, "deleted": 0, "batches": 1,
+                  "failures": []}
+        if params.get("wait_for_completion") == "false":
+            task_id = "standin:{}".format(len(self.store.tasks) + 1)
+            self.store.tasks[task_id] = result
+            return 200, {"task": task_id}
+
+        return 200, result
+
+    def api_tasks(self, method, index, rest, params, body):
+        # Tasks are done synchronously, so they are always completed.
+        task_id = rest[0] if rest else None
+        try:
+            result = self.store.tasks[task_id]
+        except KeyError:
+            raise StandInError(404, "resource_not_found_exception",
+                               "task [{}] isn't found".format(task_id))
+
+        return 200, {"completed": True, "task": {"id": task_id},
+                     "response": result}
+
+    def api_doc(self, method, index, rest, params, body):
+        doc_id = rest[0] if rest else uuid.uuid4().hex
+        if method in ("PUT", "POST"):
+            result = self._write("index", self.store.write_index(index),
+                                 doc_id, body)
+            return result["status"], result
+
+        for name in self.store.resolve(index):
+            docs = self.store.indices[name]["docs"]
+            if doc_id in docs:
+                return 200, {"_index": name, "_id": doc_id, "found": True,
+                             "_version": docs[doc_id][0],
+                             "_source": docs[doc_id][1]}
+        return 404, {"_index": index, "_id": doc_id, "found": False}
+
+    def _write(self, op_type, index, doc_id, source):
+        docs = self.store.index(index, create=True)["docs"]
+        doc_id = str(doc_id)
+        version, current = docs.get(doc_id, (0, None))
+        if op_type == "create" and current is not None:
+            return _item(index, doc_id, 409, error=(
+                "version_conflict_engine_exception",
+                "[{}]: version conflict, document already exists"\
+                .format(doc_id)))
+
+        if op_type == "delete":
+            if current is None:
+                return _item(index, doc_id, 404, result="not_found")
+            del docs[doc_id]
+            return _item(index, doc_id, 200, version + 1, "deleted")
+
+        if op_type == "update":
+            if current is None and not source.get("doc_as_upsert"):
+                return _item(index, doc_id, 404, error=(
+                    "document_missing_exception",
+                    "[_doc][{}]: document missing".format(doc_id)))
+            source = dict(current or {}, **source.get("doc", {}))
+
+        docs[doc_id] = (version + 1, source)
+        return _item(index, doc_id, 200 if current is not None else 201,
+                     version + 1, "updated" if current is not None \
+                         else "created")
+
+    def api_bulk(self, method, index, rest, params, body):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items, errors, pos = [], False, 0
+        started = time.perf_counter()
+        while pos < len(lines):
+            ((op_type, meta),) = lines[pos].items()
+            pos += 1
+            source = None
+            if op_type != "delete":
+                source = lines[pos]
+                pos += 1
+
+            target = meta.get("_index") or index
+            doc_id = meta.get("_id") or uuid.uuid4().hex
+            if self.chance(self.item_failure_rate):
+                item = _item(target, doc_id, 429, error=(
+                    "es_rejected_execution_exception",
+                    "rejected execution (queue capacity reached)"))
+                self.stats["bulk_items_rejected"] += 1
+            else:
+                item = self._write(op_type, self.store.write_index(target),
+                                   doc_id, source)
+            errors = errors or "error" in item
+            items.append({op_type: item})
+
+        self.stats["bulk_items"] += len(items)
+        return 200, {"took": int((time.perf_counter() - started) * 1000),
+                     "errors": errors, "items": items}
+
+    def api_mget(self, method, index, rest, params, body):
+        body = body or {}
+        requested = body.get("docs") or [{"_id": i} for i in body.get("ids", [])]
+        includes = _split(params.get("_source_includes"))
+        excludes = _split(params.get("_source_excludes"))
+        docs = []
+        for req in requested:
+            target, doc_id = req.get("_index") or index, str(req["_id"])
+            found = None
+            for name in self.store.resolve(target):
+                if doc_id in self.store.indices[name]["docs"]:
+                    found = name, self.store.indices[name]["docs"][doc_id]
+                    break
+            if found is None:
+                docs.append({"_index": target, "_id": doc_id, "found": False})
+                continue
+            name, (version, source) = found
+            docs.append({"_index": name, "_id": doc_id, "found": True,
+                         "_version": version,
+                         "_source": _filter_source(source, includes, excludes)})
+
+        return 200, {"docs": docs}
+
+    def _search(self, index, params, body):
+        body = body or {}
+        hits = []
+        for name in self.store.resolve(index):
+            for doc_id, (_, source) in self.store.indices[name]["docs"].items():
+                if matches(body.get("query"), doc_id, source):
+                    hits.append((name, doc_id, source))
+
+        for sort in reversed(_as_list(body.get("sort"))):
+            if isinstance(sort, str):
+                sort = {sort: {"order": "asc"}}
+            ((field, order),) = sort.items()
+            if field in ("_doc", "_score"):
+                continue
+            desc = (order if isinstance(order, str)
+                    else order.get("order", "asc")) == "desc"
+            hits.sort(key=lambda hit: _sort_key(_values(hit[2], field)),
+                      reverse=desc)
+
+        includes, excludes = _source_filter(body.get("_source"), params)
+        total = len(hits)
+        aggregations = {name: _aggregate(agg, hits)
+                        for name, agg in body.get("aggs", {}).items()}
+        formatted = [{"_index": name, "_type": "_doc", "_id": doc_id,
+                      "_score": 1.0,
+                      "_source": _filter_source(source, includes, excludes)}
+                     for name, doc_id, source in hits]
+
+        response = {"took": 0, "timed_out": False,
+                    "_shards": {"total": 1, "successful": 1, "failed": 0},
+                    "hits": {"total": {"value": total, "relation": "eq"},
+                             "max_score": 1.0 if total else None}}
+        if aggregations:
+            response["aggregations"] = aggregations
+
+        start = int(body.get("from", params.get("from", 0)))
+        size = int(body.get("size", params.get("size", SCROLL_SIZE)))
+        if params.get("scroll"):
+            scroll_id = uuid.uuid4().hex
+            self.store.scrolls[scroll_id] = (formatted[start+size:], size)
+            response["_scroll_id"] = scroll_id
+
+        response["hits"]["hits"] = formatted[start:start+size]
+        return response
+
+    def api_search(self, method, index, rest, params, body):
+        if rest and rest[0] == "scroll":
+            return self._scroll(method, params, body)
+
+        return 200, self._search(index, params, body)
+
+    def _scroll(self, method, params, body):
+        body = body or {}
+        scroll_ids = _as_list(body.get("scroll_id") or params.get("scroll_id"))
+        if method == "DELETE":
+            for scroll_id in scroll_ids:
+                self.store.scrolls.pop(scroll_id, None)
+            return 200, {"succeeded": True, "num_freed": len(scroll_ids)}
+
+        scroll_id = scroll_ids[0]
+        try:
+            remaining, size = self.store.scrolls[scroll_id]
+        except KeyError:
+            raise StandInError(404, "search_context_missing_exception",
+                               "No search context found for id [{}]"\
+                               .format(scroll_id))
+
+        self.store.scrolls[scroll_id] = (remaining[size:], size)
+        return 200, {"_scroll_id": scroll_id, "took": 0, "timed_out": False,
+                     "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                                 "failed": 0},
+                     "hits": {"total": {"value": len(remaining),
+                                        "relation": "eq"},
+                              "hits": remaining[:size]}}
+
+    def api_count(self, method, index, rest, params, body):
+        body = {"query": (body or {}).get("query"), "size": 0}
+        resp = self._search(index, params, body)
+        return 200, {"count": resp["hits"]["total"]["value"]}
+
+    def api_msearch(self, method, index, rest, params, body):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, search in zip(lines[::2], lines[1::2]):
+            try:
+                resp = self._search(header.get("index") or index, {}, search)
+            except StandInError as exc:
+                resp = exc.body()
+            else:
+                resp["status"] = 200
+            responses.append(resp)
+
+        return 200, {"took": 0, "responses": responses}
+
+
+def _item(index, doc_id, status, version=None, result=None, error=None):
+    item = {"_index": index, "_type": "_doc", "_id": doc_id,
+            "status": status}
+    if version is not None:
+        item["_version"] = version
+    if result is not None:
+        item["result"] = result
+    if error is not None:
+        item["error"] = {"type": error[0], "reason": error[1]}
+    return item
+
+
+def _flat_settings(body):
+    """{"index": {"refresh_interval": ...}} -> {"refresh_interval": ...}"""
+    flat = {}
+    for key, val in body.items():
+        if key == "index" and isinstance(val, dict):
+            flat.update(_flat_settings(val))
+        elif isinstance(val, dict):
+            flat.update({"{}.{}".format(key, k): v
+                         for k, v in _flat_settings(val).items()})
+        else:
+            flat[key[len("index."):] if key.startswith("index.") else key] = \
+                val if val is None else str(val)
+    return flat
+
+
+def _split(value):
+    if not value:
+        return None
+    return value.split(",") if isinstance(value, str) else value
+
+
+def _source_filter(source, params):
+    includes = _split(params.get("_source_includes"))
+    excludes = _split(params.get("_source_excludes"))
+    if isinstance(source, (list, str)):
+        includes = _split(source)
+    elif isinstance(source, dict):
+        includes = _split(source.get("includes")) or includes
+        excludes = _split(source.get("excludes")) or excludes
+    return includes, excludes
+
+
+def _sort_key(values):
+    # Documents without the field go last.
+    return (0, values[0]) if values else (1, 0)
+
+
+def _aggregate(agg, hits):
+    ((kind, spec),) = agg.items()
+    values = [v for _, _, source in hits
+              for v in _values(source, spec["field"])]
+    if kind in ("max", "min"):
+        if not values:
+            return {"value": None}
+        value = max(values) if kind == "max" else min(values)
+        return {"value": value, "value_as_string": str(value)}
+    if kind == "value_count":
+        return {"value": len(values)}
+
+    raise StandInError(400, "parsing_exception",
+                       "Aggregation [{}] is not supported by the stand-in"\
+                       .format(kind))
+
+
+def _handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately: without this,
+            # Nagle's algorithm adds ~40ms to keep-alive requests.
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            LOG.debug("stand-in: " + format, *args)
+
+        def _handle(self, method):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length).decode("utf-8") if length else ""
+
+            standin.delay()
+            with standin.store.lock:
+                standin.stats["requests"] += 1
+            try:
+                if method != "HEAD" and standin.chance(standin.failure_rate):
+                    with standin.store.lock:
+                        standin.stats["failures_injected"] += 1
+                    raise StandInError(503, "unavailable_shards_exception",
+                                       "injected failure")
+
+                body = raw
+                if raw and not url.path.rstrip("/").endswith(
+                        ("_bulk", "_msearch")):
+                    body = json.loads(raw)
+                status, response = standin.route(
+                    method, url.path, params, body)
+            except StandInError as exc:
+                status, response = exc.status, exc.body()
+            except (ValueError, KeyError, TypeError) as exc:
+                status, response = 400, StandInError(
+                    400, "parse_exception", str(exc)).body()
+            except Exception as exc:
+                LOG.exception("Stand-in failed on %s %s", method, self.path)
+                status, response = 500, StandInError(
+                    500, "exception", format_error(exc)).body()
+
+            payload = b"" if response is None else \
+                json.dumps(response, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if method != "HEAD":
+                self.wfile.write(payload)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PUT(self):
+            self._handle("PUT")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+        def do_HEAD(self):
+            self._handle("HEAD")
+
+    return Handler
@@ -2,12 +2,22 @@
 
 """Project-wide utils."""
 
+import re
+import os
 import json
-from urllib.request import urlopen
+import hashlib
+import itertools
+import threading
+from collections import deque
+from email.message import Message
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-import pycountry
+from types import MappingProxyType
 
-from geoometa.core.exceptions import UnsupportedValueError
+from geoometa.conf import settings
+from geoometa.core.exceptions import UnsupportedValueError, \
+     MissingDataError, RequestFailedError, RateLimitedError
 
 
 TIMEOUT = 30
@@ -22,73 +32,352 @@ def clean_url(url):
     return url
 
 
-def _read_github_recursive(url, timeout, collected):
+# Response headers worth keeping (with the body) in HTTP cache.
+CACHED_HEADERS = ("content-type", "link", "etag", "last-modified")
+USER_AGENT = "geoometa"
+HTTP_POOL_SIZE = 10
+GITHUB_API_HOST = "api.github.com"
+
+LINK_RE = re.compile(r'<([^>]*)>\s*((?:;\s*[^;,]+)*)')
+LINK_PARAM_RE = re.compile(r';\s*([^=;\s]+)\s*=\s*"?([^";]*)"?')
+
+__http_pools = {}
+__http_pools_lock = threading.Lock()
+
+
+def http_pool():
+    """
+    Keep-alive connection pool for HTTP(S) requests, one per
+    process (thread-safe).
     """
-    Recoursively read url until pagintion is exhausted.
+    pid = os.getpid()
+    try:
+        return __http_pools[pid]
+    except KeyError:
+        pass
 
-    :param collected: <list> - elements collected so far.
+    import certifi
+    import urllib3
+
+    with __http_pools_lock:
+        try:
+            return __http_pools[pid]
+        except KeyError:
+            pass
+
+        pool = urllib3.PoolManager(
+            maxsize=HTTP_POOL_SIZE,
+            headers={"User-Agent": USER_AGENT},
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where())
+        __http_pools.clear()
+        __http_pools[pid] = pool
+        return pool
+
+
+def parse_link_header(value):
+    """
+    Parses `Link` header (RFC 8288) into <dict> rel -> URL.
     """
-    resp = urlopen(url, timeout=timeout)
-    info = resp.info()
-    content_type = info.get_content_type()
+    links = {}
+    for match in LINK_RE.finditer(value or ""):
+        url, params = match.groups()
+        for name, param in LINK_PARAM_RE.findall(params):
+            if name.lower() == "rel":
+                for rel in param.split():
+                    links[rel] = clean_url(url)
+
+    return links
+
+
+def _content_type(value):
+    msg = Message()
+    msg["content-type"] = value or "application/octet-stream"
+    return msg.get_content_type(), msg.get_content_charset()
+
+
+def fetch(url, timeout=TIMEOUT, cache=None, headers=None):
+    """
+    GET `url` over the pooled keep-alive connection. If `cache`
+    (see `geoometa.core.cache.HTTPCache`) has the response, the
+    request is made conditional, and the cached response is
+    returned if the server says 304. Requests to GitHub API are
+    authenticated with `settings.GITHUB_TOKEN` (if any), refusals
+    over the rate limit raise `RateLimitedError`.
+
+    :return: <tuple> (headers, body), where headers is <dict>
+        of CACHED_HEADERS (lower-cased), body is <str>.
+    """
+    request_headers = dict(headers or {})
+    if settings.GITHUB_TOKEN and urlsplit(url).hostname == GITHUB_API_HOST:
+        request_headers.setdefault(
+            "Authorization", "token {}".format(settings.GITHUB_TOKEN))
+    entry = cache.get(url) if cache is not None else None
+    if entry:
+        request_headers.update(cache.validators(entry))
+
+    resp = http_pool().request("GET", url, headers=request_headers,
+                               timeout=timeout)
+    if resp.status == 304:
+        if entry:
+            return entry["headers"], entry["body"]
+        # E.g. validators came in `headers`: there is no body to return.
+        raise RequestFailedError(
+            "GET {} returned 304 Not Modified, but nothing is cached"\
+            .format(url))
+
+    if resp.status in (403, 429) and \
+       resp.headers.get("x-ratelimit-remaining") == "0":
+        raise RateLimitedError(
+            "GET {} refused over the rate limit (reset at {})".format(
+                url, resp.headers.get("x-ratelimit-reset")))
+
+    if resp.status >= 400:
+        raise RequestFailedError("GET {} returned {} {}".format(
+            url, resp.status, resp.reason))
+
+    content_type, charset = _content_type(resp.headers.get("content-type"))
+    body = resp.data.decode(charset or "utf-8")
+    headers = {}
+    for name in CACHED_HEADERS:
+        value = resp.headers.get(name)
+        if value is not None:
+            headers[name] = value
+    headers["content-type"] = content_type
+
+    if cache is not None:
+        cache.set(url, headers, body)
+
+    return headers, body
+
+
+def _read_github_page(url, timeout, cache):
+    """
+    :return: <tuple> (<list> of elements, <dict> of links).
+    """
+    headers, raw = fetch(url, timeout=timeout, cache=cache)
+    content_type = headers["content-type"]
     if 'application/json' not in content_type:
         raise UnsupportedValueError(
             "Only JSON responses are supported (request returned `{}`)"\
             .format(content_type)
             )
 
-    charset = info.get_content_charset()
-    raw = resp.read().decode(charset)
     serialized = json.loads(raw)
-    if isinstance(serialized, list):
-        collected.extend(serialized)
-    else:
-        collected.append(serialized)
-
-    # Pagination.
-    headers = resp.getheaders()
-    headers = dict(h for h in headers)
+    if not isinstance(serialized, list):
+        serialized = [serialized]
+
+    return serialized, parse_link_header(headers.get("link"))
+
+
+def _page_urls(last_url):
+    """URLs of pages 2..N, given URL of the last (N-th) page."""
+    parts = urlsplit(last_url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
     try:
-        pages = [x.strip() for x in headers['Link'].split(",")]
-    except (AttributeError, KeyError):
-        return collected
+        last = int(dict(query)["page"])
+    except (KeyError, ValueError):
+        return None
+
+    urls = []
+    for page in range(2, last + 1):
+        page_query = [(k, str(page) if k == "page" else v) for k, v in query]
+        urls.append(urlunsplit(parts._replace(query=urlencode(page_query))))
+
+    return urls
+
+
+def iter_github(url, timeout=TIMEOUT, cache=None, workers=None):
+    """
+    Lazily yields elements from all pages of `url`. Once the
+    first page tells the number of the last one, the rest are
+    fetched concurrently by `workers` threads (elements come in
+    the order pages arrive); otherwise `next` links are followed
+    one by one.
 
-    for page in pages:
-        url, rel = [p.strip() for p in page.split(";")]
-        if rel == 'rel="next"':
-            url = clean_url(url)
-            collected = _read_github_recursive(url, timeout, collected)
+    :param url: <str>
+    :param timeout: <int>
+    :param cache: `geoometa.core.cache.HTTPCache` or None - pages
+        not modified since cached are not downloaded again (and
+        don't count against github rate limit).
+    :param workers: <int> (default `settings.GITHUB_WORKERS`).
+    """
+    elements, links = _read_github_page(url, timeout, cache)
+    yield from elements
 
-    return collected
+    urls = _page_urls(links["last"]) if "last" in links else None
+    if urls is None:
+        # No idea how many pages are there: go sequentially.
+        while "next" in links:
+            elements, links = _read_github_page(links["next"], timeout, cache)
+            yield from elements
+        return
 
+    if workers is None:
+        workers = settings.GITHUB_WORKERS
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_read_github_page, page_url, timeout, cache)
+                   for page_url in urls]
+        for future in as_completed(futures):
+            elements, _ = future.result()
+            yield from elements
 
-def read_github(url, timeout=TIMEOUT):
+
+def read_github(url, timeout=TIMEOUT, cache=None, workers=None):
     """
     :param url: <str> - only the meaningful part of the URL
         (e.g. 'users/whosonfirst-data').
     :param timeout: <int>
+    :param cache: see `iter_github`.
+    :param workers: <int> pages fetched concurrently (default
+        `settings.GITHUB_WORKERS`).
+    :return: <list> elements from all pages.
+    """
+    return list(iter_github(url, timeout=timeout, cache=cache,
+                            workers=workers))
+
+
+def iter_chunks(iterable, size):
+    """
+    Lazily splits `iterable` into lists of `size` elements
+    (the last one can be shorter).
     """
-    collected = []
-    return _read_github_recursive(url, timeout, collected)
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_ordered(executor, func, iterable, window):
+    """
+    Similar to `executor.map(func, ...)`, but only keeps `window`
+    tasks in flight instead of submitting the whole `iterable` at
+    once, so that memory stays bounded. Results are yielded in
+    the order of `iterable`.
+
+    :param iterable: iterable of argument tuples for `func`.
+    """
+    pending = deque()
+    for args in iterable:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def git_blob_sha(content):
+    """
+    SHA-1 of `content` (<bytes>) as git computes it for a blob,
+    i.e. the same sha github reports for a file.
+    """
+    sha = hashlib.sha1(b"blob %d\0" % len(content))
+    sha.update(content)
+    return sha.hexdigest()
+
+
+def ensure_dir(path):
+    """Creates parent directory of `path` if necessary."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    return path
 
 
 def format_error(err):
     return "%s (%s)" % (err, type(err).__name__)
 
 
+def country_table():
+    """
+    Returns <tuple> of (alpha_2, alpha_3, numeric, name) for all
+    countries from pycountry (see `dump_country_table`).
+    """
+    import pycountry
+
+    return tuple((c.alpha_2, c.alpha_3, c.numeric, c.name)
+                 for c in pycountry.countries)
+
+
+def dump_country_table(path):
+    """
+    Writes `country_table` as a python module to `path` (e.g.
+    'geoometa/schema/countries.py'), so that pycountry database
+    isn't loaded at runtime.
+    """
+    import pycountry
+
+    with open(path, "w") as fp:
+        fp.write('# -*- coding: utf-8 -*-\n\n')
+        fp.write('"""\nISO 3166-1 countries: (alpha_2, alpha_3, numeric, name).\n\n')
+        fp.write('Generated by `geoometa.core.utils.dump_country_table` from\n')
+        fp.write('pycountry {}, do not edit.\n"""\n\n'.format(
+            getattr(pycountry, "__version__", "(unknown version)")))
+        fp.write("COUNTRIES = (\n")
+        for row in country_table():
+            fp.write("    {!r},\n".format(row))
+        fp.write("    )\n")
+
+
+def _country_names():
+    try:
+        from geoometa.schema.countries import COUNTRIES
+    except ImportError:
+        COUNTRIES = country_table()
+
+    names = {}
+    for alpha_2, alpha_3, numeric, name in COUNTRIES:
+        names.update({alpha_2: name, alpha_3: name, numeric: name})
+
+    return MappingProxyType(names)
+
+
+# Country code (alpha-2, alpha-3, numeric) -> name.
+COUNTRY_NAMES = _country_names()
+
+# Negative cache: codes that are known to be unknown.
+__unknown_countries = set()
+MAX_UNKNOWN_COUNTRIES = 10000
+
+
 def country_name(country_code):
     """
     Return country name by country code.
 
-    :param country_code: <str>
+    :param country_code: <str> ISO 3166-1 alpha-2, alpha-3 or
+        numeric code, or <int> numeric code (e.g. 4 - "004").
     :return: <str>
+    :raise: `UnsupportedValueError` if `country_code` is not a code
+        at all (e.g. None or a list from a malformed record),
+        `MissingDataError` if there is no such country.
     """
-    country_code = country_code.strip()
-    code_length = len(country_code)
-    if code_length > 2:
-        raise UnsupportedValueError("`country_code` can only be 2 or 3 symbols long!")
+    try:
+        return COUNTRY_NAMES[country_code]
+    except (KeyError, TypeError):
+        pass
 
-    alpha_name = "alpha_{}".format(code_length)
-    country = pycountry.countries.get(**{alpha_name: country_code})
+    if isinstance(country_code, bool) or \
+       not isinstance(country_code, (str, int)):
+        raise UnsupportedValueError(
+            "`country_code` must be a str or int (got {!r})".format(
+                country_code))
+
+    if country_code in __unknown_countries:
+        raise MissingDataError("Unknown country code: {}".format(country_code))
 
-    return country.name
+    code = str(country_code).strip().upper()
+    if code.isdigit():
+        code = code.zfill(3)
+    if len(code) not in (2, 3):
+        raise UnsupportedValueError("`country_code` can only be 2 or 3 symbols long!")
+
+    try:
+        return COUNTRY_NAMES[code]
+    except KeyError:
+        if len(__unknown_countries) < MAX_UNKNOWN_COUNTRIES:
+            __unknown_countries.add(country_code)
+        raise MissingDataError("Unknown country code: {}".format(country_code))
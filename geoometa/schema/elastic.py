@@ -11,22 +11,30 @@ https://github.com/whosonfirst-data/
 """
 
 from __future__ import absolute_import
+import logging
 import datetime
+from contextlib import contextmanager
 
-from elasticsearch_dsl import connections, Document, InnerDoc, Nested, \
+from elasticsearch_dsl import Document, InnerDoc, Nested, \
      Keyword, Text, Float, Integer, Date, GeoPoint, GeoShape
 
-from genery.utils import flatten_list, distinct_elements
 from genery.decorators import objectify
 
 from geoometa.conf import settings
+from geoometa.conf.connections import get_client
 from geoometa.core.exceptions import MissingDataError
 from geoometa.core.utils import country_name
-from geoometa.schema.references import LANG_MAP, LANG_FIELDS
+from geoometa.schema.references import LANG_FIELDS
+from geoometa.schema.extractors import PropertyExtractor
 
 
 ALIAS = 'default'
 
+LOG = logging.getLogger(settings.LOGGER)
+
+# Forcing merge of a large index takes a while.
+FORCE_MERGE_TIMEOUT = 3600
+
 
 # Mapping of fields from Whosonfirst data to the Place
 # document in index.
@@ -45,6 +53,7 @@ FIELD_MAP = {
     "wof:placetype": "placetype",
     "wof:tags": "tags"
     }
+EXTRACTOR = PropertyExtractor(FIELD_MAP)
 
 
 class Hierarchy(InnerDoc):
@@ -69,11 +78,18 @@ class Place(Document):
     iso_country = Keyword()
     country = Text()
 
-    #TODO: figure out how to store the whole hierarchy for faster queries
     belongsto = Integer(multi=True)
     hierarchy = Nested(Hierarchy) # ?
     parent_id = Integer()
 
+    # The whole hierarchy for faster queries: ancestors from the
+    # top down (filled after ingestion by
+    # `geoometa.core.hierarchy.HierarchyMaterializer`).
+    ancestors = Keyword(multi=True)
+    ancestor_names = Keyword(multi=True)
+    ancestor_placetypes = Keyword(multi=True)
+    ancestor_path = Keyword()
+
     placetype = Keyword(required=True)
 
     tags = Text(multi=True)
@@ -126,6 +142,11 @@ class Place(Document):
 
         super().__init__(meta, **kwargs)
 
+    @classmethod
+    def _get_connection(cls, using=None):
+        # Per-process client, created on first use.
+        return get_client(cls._get_using(using))
+
     def add_hierarchy(self, **ids):
         self.hierarchy.append(Hierarchy(**ids))
 
@@ -133,29 +154,31 @@ class Place(Document):
         self.last_updated = datetime.datetime.now()
         return super().save(**kwargs)
 
+    def to_action(self, validate=True, **kwargs):
+        """
+        Returns the document as an action for the bulk API
+        (see `elasticsearch.helpers.streaming_bulk`), timestamped
+        and validated the same way as `save` does it.
+
+        :param validate: <bool> raise `ValidationException` if the
+            document is not valid (e.g. without geometry).
+        """
+        self.last_updated = datetime.datetime.now()
+        if validate:
+            self.full_clean()
+        return self.to_dict(include_meta=True, **kwargs)
+
     @objectify
     def get_source(self, **kwargs):
         """Returns kwargs in a <dict> form to wrap them into RecordDict."""
         return kwargs
 
     def prepare(self, source):
-        location = self.extract_location(source)
-        if not location:
+        obj = EXTRACTOR.extract(source.properties)
+        if not obj["location"]:
             raise MissingDataError("Could not find latitude and longitude!")
 
-        obj = {}
-        for src, trg in FIELD_MAP.items():
-            try:
-                obj[trg] = source.properties[src]
-            except KeyError:
-                obj[trg] = None
-
-        timezone = self.extract_timezone(source)
-        obj.update(self.extract_names(source))
         obj.update({
-            "location": location,
-            "timezone": timezone,
-            "population": self.extract_population(source),
             "geometry": self.extract_geometry(source),
             "bbox": self.extract_bbox(source)
             })
@@ -173,107 +196,25 @@ class Place(Document):
 
         return obj
 
-    def extract_timezone(self, source):
-        for field, val in source.properties.items():
-            # Fill in language specific container
-            try:
-                _, tz_fieldname = field.split(":")
-            except Exception:
-                continue
+    # The methods below extract separate fields, `prepare` gets
+    # them all in one pass with EXTRACTOR.
 
-            if tz_fieldname.lower() == "timezone":
-                return val
+    def extract_timezone(self, source):
+        return EXTRACTOR.extract(source.properties)["timezone"]
 
     def extract_names(self, source):
         """Preserve lang-specific names, but pack it in a separate field."""
-        names = []
-        names_lang = {}
-        for field, val in source.properties.items():
-            if not isinstance(val, list):
-                val = [val]
-
-            # General names.
-            if field.endswith(":name"):
-                names.extend(val)
-
-            # Lang-specific names.
-            if field.startswith("name:") and (
-                    field.endswith("_preferred") or
-                    field.endswith("_variant")
-                ):
-
-                # Fill in general container (for search).
-                names.extend(val)
-
-                # Fill in language specific container
-                try:
-                    _, lang = field.split(":")
-                    lang = lang.split("_")[0]
-                except Exception:
-                    continue
-
-                else:
-                    # If target language cannot be found here,
-                    # fieldname is created from the first two
-                    # symbols ("kor" -> "ko").
-                    try:
-                        lang = LANG_MAP[lang]
-                    except KeyError:
-                        lang = lang[:2]
-
-                # NB: val is a list.
-                try:
-                    names_lang[lang].extend(val)
-                except KeyError:
-                    names_lang[lang] = val
-                except Exception:
-                    continue
-
-        # Names can be spelled similarly in different langs.
-        names = distinct_elements(flatten_list(names))
+        obj = EXTRACTOR.extract(source.properties)
         return {
-            "names": names,
-            "names_lang": names_lang
+            "names": obj["names"],
+            "names_lang": obj["names_lang"]
             }
 
     def extract_population(self, source):
-        try:
-            return int(source.properties["wof:population"])
-        except (KeyError, ValueError):
-            pass
-
-        for key, val in source.properties.items():
-            if key.endswith(":population"):
-                try:
-                    return int(val)
-                except ValueError:
-                    continue
-
-        return None
+        return EXTRACTOR.extract(source.properties)["population"]
 
     def extract_location(self, source):
-        try:
-            return {
-                "lat": source.properties["geom:latitude"],
-                "lon": source.properties["geom:longitude"],
-                }
-        except KeyError:
-            pass
-
-        # Try other schemes, but always in pairs.
-        lat_key, lon_key = None, None
-        for key in source.properties.keys():
-            if key.endswith(":latitude"):
-                lat = source.properties[key]
-                schema, _ = key.split(":")
-                try:
-                    lon = source.properties[":".join([schema, "longitude"])]
-                except KeyError:
-                    continue
-                else:
-                    return {"lat": lat, "lon": lon}
-        # No luck...
-        return {}
+        return EXTRACTOR.extract(source.properties)["location"]
 
     def extract_geometry(self, source):
         geometry = {}
@@ -313,7 +254,71 @@ def setup():
     Create the index template in elasticsearch specifying the mappings and any
     settings to be used. This can be run at any time, ideally at every new code
     deploy.
+
+    A new index is created as the first version behind the alias
+    `Place._index` (see `versions.IndexVersions`), ingestion loads
+    documents into it in `bulk_load` mode.
     """
-    connections.create_connection()
+    from geoometa.schema.versions import IndexVersions
+
+    get_client(ALIAS)
     if not Place._index.exists():
-        Place.init()
+        versions = IndexVersions(Place._index._name, ALIAS)
+        versions.swap(versions.create())
+
+
+def bulk_load_settings():
+    """Index settings for the duration of a bulk load."""
+    return {
+        "index.refresh_interval": "-1",
+        "index.number_of_replicas": "0",
+        "index.translog.flush_threshold_size":
+            settings.ES_BULK_LOAD_TRANSLOG_SIZE
+        }
+
+
+@contextmanager
+def bulk_load(index=None, max_segments=None, using=None):
+    """
+    Tunes the `index` (default that of `Place`) for indexing lots of
+    documents: no refresh, no replicas (they are rebuilt by copying
+    segments afterwards, which is faster than indexing every
+    document twice), rare translog flushes.
+
+    On exit (errors included) restores the previous settings,
+    refreshes the index and, if `max_segments`, force merges it.
+    Documents indexed within are not searchable until then (but
+    `get` and `mget` see them).
+
+    :param max_segments: <int> number of segments to merge to.
+    """
+    client = get_client(using or ALIAS)
+    index = index or Place._index._name
+    tuned = bulk_load_settings()
+    current = client.indices.get_settings(index=index, flat_settings=True)
+    previous = {}
+    for name, resp in current.items():
+        index_settings = resp["settings"]
+        # Not set ones (None) are reset to defaults.
+        previous[name] = {key: index_settings.get(key) for key in tuned}
+        if index_settings.get("index.refresh_interval") == "-1":
+            # Left by an interrupted load (these are not restored).
+            LOG.warning("Refresh of %s is off, will be reset to defaults "
+                        "after bulk load", name)
+            previous[name] = dict.fromkeys(tuned)
+            previous[name]["index.number_of_replicas"] = \
+                str(settings.ES_REPLICAS)
+
+    LOG.debug("Bulk load into %s: %s", index, tuned)
+    client.indices.put_settings(index=index, body=tuned)
+    try:
+        yield
+    finally:
+        for name, index_settings in previous.items():
+            client.indices.put_settings(index=name, body=index_settings)
+        client.indices.refresh(index=index)
+        if max_segments:
+            LOG.debug("Merging %s into %d segment(s)", index, max_segments)
+            client.indices.forcemerge(
+                index=index, max_num_segments=max_segments,
+                request_timeout=FORCE_MERGE_TIMEOUT)
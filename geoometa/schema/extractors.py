@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass extraction of Place fields from Who's On First
+feature properties.
+
+Every property key is classified once (what it means for the
+Place: a directly mapped field, a name, a timezone, etc.) and
+the classification is memoized, because the same keys repeat
+across millions of features.
+"""
+
+from geoometa.schema.references import LANG_MAP
+
+
+# Roles of property keys.
+ROLE_FIELD = 0
+ROLE_TIMEZONE = 1
+ROLE_NAME = 2
+ROLE_NAME_LANG = 3
+ROLE_POPULATION = 4
+ROLE_LATITUDE = 5
+
+POPULATION_KEY = "wof:population"
+LATITUDE_KEY = "geom:latitude"
+LONGITUDE_KEY = "geom:longitude"
+
+NOT_FOUND = object()
+
+# Memoized keys limit (WOF has a few thousands distinct keys,
+# this only guards from pathological inputs).
+MAX_KEYS = 100000
+
+
+def lang_code(lang):
+    """
+    ISO 639-1 code for `lang`. If target language cannot be found,
+    it is created from the first two symbols ("kor" -> "ko").
+    """
+    try:
+        return LANG_MAP[lang]
+    except KeyError:
+        return lang[:2]
+
+
+def _flatten(values, target):
+    for val in values:
+        if isinstance(val, list):
+            _flatten(val, target)
+        else:
+            target.append(val)
+
+    return target
+
+
+def _distinct(values):
+    """
+    Distinct elements preserving order, nested lists are
+    flattened.
+    """
+    try:
+        return list(dict.fromkeys(values))
+    except TypeError:
+        # Unhashable elements: nested lists (or worse).
+        distinct = []
+        for val in _flatten(values, []):
+            if val not in distinct:
+                distinct.append(val)
+        return distinct
+
+
+class PropertyExtractor:
+    """
+    Fills all the fields that `elastic.Place` derives from
+    `properties` of a feature in one pass over them.
+    """
+
+    def __init__(self, field_map):
+        """
+        :param field_map: <dict> property key -> Place field for
+            properties which are copied as is.
+        """
+        self.field_map = field_map
+        self.roles = {}
+
+    def classify(self, key):
+        """
+        :return: <tuple> of (role, argument) pairs for `key`.
+        """
+        roles = []
+        if key in self.field_map:
+            roles.append((ROLE_FIELD, self.field_map[key]))
+
+        parts = key.split(":")
+        if len(parts) == 2 and parts[1].lower() == "timezone":
+            roles.append((ROLE_TIMEZONE, None))
+
+        # General names.
+        if key.endswith(":name"):
+            roles.append((ROLE_NAME, None))
+
+        # Lang-specific names (language is None if it can't be
+        # figured out, but the name still counts).
+        if key.startswith("name:") and (
+                key.endswith("_preferred") or key.endswith("_variant")):
+            lang = None
+            if len(parts) == 2:
+                lang = lang_code(parts[1].split("_")[0])
+            roles.append((ROLE_NAME_LANG, lang))
+
+        if key.endswith(":population"):
+            roles.append((ROLE_POPULATION, key == POPULATION_KEY))
+
+        # Coordinates of any scheme, but always in pairs.
+        if key.endswith(":latitude"):
+            schema = key[:-len(":latitude")]
+            roles.append((ROLE_LATITUDE, schema + ":longitude"))
+
+        return tuple(roles)
+
+    def key_roles(self, key):
+        try:
+            return self.roles[key]
+        except KeyError:
+            roles = self.classify(key)
+            if len(self.roles) < MAX_KEYS:
+                self.roles[key] = roles
+            return roles
+
+    def extract(self, properties):
+        """
+        :param properties: <dict> feature properties.
+        :return: <dict> with Place fields from the `field_map`
+            and "names", "names_lang", "timezone", "population",
+            "location" (empty <dict> if coordinates are not found).
+        """
+        obj = dict.fromkeys(self.field_map.values())
+        timezone = NOT_FOUND
+        names = []
+        names_lang = {}
+        population = None
+        population_main = None
+        longitude_keys = []
+
+        memo = self.roles
+        for key, val in properties.items():
+            roles = memo.get(key)
+            if roles is None:
+                roles = self.key_roles(key)
+
+            for role, arg in roles:
+                if role == ROLE_FIELD:
+                    obj[arg] = val
+
+                elif role == ROLE_TIMEZONE:
+                    if timezone is NOT_FOUND:
+                        timezone = val
+
+                elif role == ROLE_NAME or role == ROLE_NAME_LANG:
+                    vals = val if isinstance(val, list) else [val]
+                    names.extend(vals)
+                    if arg is not None:
+                        try:
+                            names_lang[arg].extend(vals)
+                        except KeyError:
+                            names_lang[arg] = list(vals)
+
+                elif role == ROLE_POPULATION:
+                    if arg or population is None:
+                        try:
+                            num = int(val)
+                        except (TypeError, ValueError):
+                            num = None
+                        if num is not None and arg:
+                            population_main = num
+                        if population is None:
+                            population = num
+
+                elif role == ROLE_LATITUDE:
+                    longitude_keys.append((key, arg))
+
+        obj.update({
+            # Names can be spelled similarly in different langs.
+            "names": _distinct(names),
+            "names_lang": names_lang,
+            "timezone": None if timezone is NOT_FOUND else timezone,
+            "population": population if population_main is None \
+                else population_main,
+            "location": self._location(properties, longitude_keys)
+            })
+        return obj
+
+    def _location(self, properties, longitude_keys):
+        try:
+            return {
+                "lat": properties[LATITUDE_KEY],
+                "lon": properties[LONGITUDE_KEY],
+                }
+        except KeyError:
+            pass
+
+        for lat_key, lon_key in longitude_keys:
+            try:
+                return {
+                    "lat": properties[lat_key],
+                    "lon": properties[lon_key]
+                    }
+            except KeyError:
+                continue
+
+        # No luck...
+        return {}
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queries to the gazetteer: forward lookup (name -> places) and
+reverse lookup (point -> places containing it).
+
+Batch variants pack many lookups into `_msearch` requests (sent
+concurrently), and return results aligned with the inputs, e.g.
+all toponyms of a document are resolved with one request.
+
+Results can be cached in the process (see `set_cache`), repeated
+lookups in a batch are sent once anyway.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch_dsl import MultiSearch, Q
+
+from geoometa.conf import settings
+from geoometa.core.cache import QueryCache
+from geoometa.core.hierarchy import PLACETYPE_RANK, UNKNOWN_RANK
+from geoometa.core.utils import iter_chunks, format_error
+from geoometa.schema.elastic import Place
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+SIZE = 10
+
+# Geometries are huge, and rarely needed in results.
+EXCLUDES = ["geometry"]
+
+FORWARD = "forward"
+REVERSE = "reverse"
+
+
+def index_generation():
+    """
+    Generation of the data in the index: the last update and the
+    number of documents (changes on every ingestion).
+    """
+    search = Place.search().extra(size=0, track_total_hits=True)
+    search.aggs.metric("last_updated", "max",
+                       field=settings.ES_MAIN_TIMESTAMP_FIELD)
+    resp = search.execute()
+    return resp.aggregations.last_updated.value, resp.hits.total.value
+
+
+__cache = QueryCache(generation=index_generation) \
+    if settings.QUERY_CACHE else None
+
+
+def set_cache(cache):
+    """
+    Sets `core.cache.QueryCache` for results of lookups (None
+    turns caching off), returns the previous one.
+    """
+    global __cache
+    previous, __cache = __cache, cache
+    return previous
+
+
+def get_cache():
+    return __cache
+
+
+def cache_key(kind, params):
+    """Key of a lookup (normalized, so that "paris " is "Paris")."""
+    items = []
+    for key, val in sorted(params.items()):
+        if val is None:
+            continue
+        if key == "name":
+            val = " ".join(str(val).casefold().split())
+        elif key == "country":
+            val = val.upper()
+        elif key == "placetypes":
+            val = tuple(sorted(val))
+        items.append((key, val))
+
+    return kind, tuple(items)
+
+
+def forward_search(name, country=None, placetypes=None, lang=None,
+                   size=SIZE, geometry=False):
+    """
+    :param name: <str> toponym.
+    :param country: <str> ISO alpha-2 code to filter by.
+    :param placetypes: <list> of placetypes to filter by.
+    :param lang: <str> language of the `name` (e.g. "en"), its
+        analyzed names field is queried too.
+    :param geometry: <bool> include geometry into results.
+    :return: `elasticsearch_dsl.Search`
+    """
+    fields = ["name^3", "names"]
+    if lang:
+        fields.append("names.{}".format(lang))
+
+    query = Q("bool",
+              must=[Q("multi_match", query=name, fields=fields,
+                      operator="and")],
+              should=[Q("match_phrase", name=name)])
+    search = Place.search().query(query)
+    return _filter(search, country, placetypes, size, geometry)
+
+
+def reverse_search(lat, lon, country=None, placetypes=None, size=SIZE,
+                   geometry=False):
+    """
+    Places whose geometry contains the point (`lat`, `lon`).
+
+    :return: `elasticsearch_dsl.Search`
+    """
+    shape = {"type": "point", "coordinates": [lon, lat]}
+    search = Place.search().filter(
+        "geo_shape", geometry={"shape": shape, "relation": "intersects"})
+    return _filter(search, country, placetypes, size, geometry)
+
+
+def _filter(search, country, placetypes, size, geometry):
+    if country:
+        search = search.filter("term", iso_country=country.upper())
+    if placetypes:
+        search = search.filter("terms", placetype=list(placetypes))
+    if not geometry:
+        search = search.source(excludes=EXCLUDES)
+
+    return search[:size]
+
+
+def _hits(response, reverse=False):
+    if response is None:
+        return None
+
+    hits = list(response)
+    if reverse:
+        # From the top down (continent, country, region, ...).
+        hits.sort(key=lambda hit: PLACETYPE_RANK.get(
+            hit.placetype, UNKNOWN_RANK))
+
+    return hits
+
+
+def geocode(name, **kwargs):
+    """
+    :return: <list> of `elastic.Place` (best matches first), see
+        `forward_search` for `kwargs`.
+    """
+    return _lookup(FORWARD, [dict(kwargs, name=name)])[0]
+
+
+def reverse_geocode(lat, lon, **kwargs):
+    """
+    :return: <list> of `elastic.Place` containing the point, from
+        the top down, see `reverse_search` for `kwargs`.
+    """
+    return _lookup(REVERSE, [dict(kwargs, lat=lat, lon=lon)])[0]
+
+
+def _lookup(kind, params, batch_size=None, concurrency=None):
+    """
+    Results of lookups with `params` (<list> of <dict>s), taken
+    from the cache or searched (every distinct lookup once).
+    """
+    build = forward_search if kind == FORWARD else reverse_search
+    cache = __cache
+    results = [None] * len(params)
+    pending = {}
+    for n, lookup in enumerate(params):
+        key = cache_key(kind, lookup)
+        if cache is not None:
+            hits = cache.get(key)
+            if hits is not None:
+                results[n] = list(hits)
+                continue
+
+        try:
+            pending[key][1].append(n)
+        except KeyError:
+            pending[key] = (build(**lookup), [n])
+
+    responses = execute_many([search for search, _ in pending.values()],
+                             batch_size, concurrency)
+    for (key, (_, positions)), resp in zip(pending.items(), responses):
+        hits = _hits(resp, reverse=(kind == REVERSE))
+        if hits is None:
+            continue
+
+        if cache is not None:
+            cache.set(key, tuple(hits))
+        for n in positions:
+            results[n] = list(hits)
+
+    return results
+
+
+def execute_many(searches, batch_size=None, concurrency=None):
+    """
+    Executes `searches` in `_msearch` requests of `batch_size`,
+    up to `concurrency` requests at once.
+
+    :return: <list> of responses aligned with `searches` (None
+        for failed searches).
+    """
+    batch_size = batch_size or settings.ES_MSEARCH_BATCH
+    concurrency = concurrency or settings.ES_MSEARCH_CONCURRENCY
+    batches = list(iter_chunks(searches, batch_size))
+    if len(batches) <= 1 or concurrency == 1:
+        responses = map(_msearch, batches)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(_msearch, batches))
+
+    return [resp for batch in responses for resp in batch]
+
+
+def _msearch(searches):
+    msearch = MultiSearch(using=Place._get_connection(),
+                          index=Place._index._name)
+    for search in searches:
+        msearch = msearch.add(search)
+
+    try:
+        return msearch.execute(raise_on_error=False)
+    except Exception as exc:
+        # The whole request failed: so did all the searches.
+        LOG.error("Multi search failed: %s", format_error(exc))
+        return [None] * len(searches)
+
+
+def _query_kwargs(query, positional, kwargs):
+    """Arguments of one lookup: `query` is a <dict> or a tuple."""
+    if isinstance(query, dict):
+        return dict(kwargs, **query)
+
+    if not isinstance(query, (tuple, list)):
+        query = (query,)
+
+    return dict(kwargs, **dict(zip(positional, query)))
+
+
+def batch_geocode(queries, batch_size=None, concurrency=None, **kwargs):
+    """
+    :param queries: iterable of names (<str>) or <dict>s of
+        `forward_search` arguments (e.g. {"name": "Paris",
+        "country": "FR"}), `kwargs` apply to all of them.
+    :return: <list> of results (as in `geocode`) aligned with
+        `queries`, None for failed lookups.
+    """
+    params = [_query_kwargs(q, ("name",), kwargs) for q in queries]
+    return _lookup(FORWARD, params, batch_size, concurrency)
+
+
+def batch_reverse_geocode(points, batch_size=None, concurrency=None,
+                          **kwargs):
+    """
+    :param points: iterable of (lat, lon) or <dict>s of
+        `reverse_search` arguments, `kwargs` apply to all of them.
+    :return: <list> of results (as in `reverse_geocode`) aligned
+        with `points`, None for failed lookups.
+    """
+    params = [_query_kwargs(p, ("lat", "lon"), kwargs) for p in points]
+    return _lookup(REVERSE, params, batch_size, concurrency)
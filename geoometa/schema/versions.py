@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Versioned indices of places: physical indices "<alias>-v<N>" behind
+the alias `settings.ES_INDEX_LOC`, which `Place` (and so queries)
+use.
+
+A rebuild (e.g. after a change of mappings) creates the next
+version, fills it - by ingestion or with server-side `_reindex`
+from the current version - and then moves the alias to it in one
+atomic request, so queries never see a half-built index, and the
+live one isn't loaded by the rebuild. The previous versions are
+kept for a rollback (`swap` back) until `cleanup`.
+
+    versions = IndexVersions()
+    new = versions.create()
+    versions.reindex(new)
+    versions.swap(new)
+    versions.cleanup()
+"""
+
+import re
+import time
+import logging
+
+from geoometa.conf import settings
+from geoometa.conf.connections import get_client
+from geoometa.core.exceptions import RequestFailedError, \
+     UnsupportedValueError
+from geoometa.schema import elastic
+
+
+LOG = logging.getLogger(settings.LOGGER)
+
+# Long reindex is waited for in requests of this length.
+TASK_POLL_TIMEOUT = "60s"
+
+
+def version_name(alias, version):
+    return "{}-v{}".format(alias, version)
+
+
+def parse_version(alias, name):
+    """Version number of the index `name` (None if it isn't one)."""
+    match = re.match(r"^{}-v(\d+)$".format(re.escape(alias)), name)
+    return int(match.group(1)) if match else None
+
+
+class IndexVersions:
+    """Versions of the index behind the `alias`."""
+
+    def __init__(self, alias=None, using=None):
+        """
+        :param alias: <str> default `settings.ES_INDEX_LOC`.
+        :param using: <str> connection alias (default that of
+            `elastic.Place`).
+        """
+        self.alias = alias or settings.ES_INDEX_LOC
+        self.using = using or elastic.ALIAS
+
+    @property
+    def client(self):
+        return get_client(self.using)
+
+    def versions(self):
+        """:return: <list> of (version, index name), oldest first."""
+        resp = self.client.indices.get_alias(
+            index=version_name(self.alias, "*"))
+        found = []
+        for name in resp:
+            version = parse_version(self.alias, name)
+            if version is not None:
+                found.append((version, name))
+
+        return sorted(found)
+
+    def current(self):
+        """
+        :return: <list> of indices the alias points to (empty if
+            there is no alias, e.g. a legacy unversioned index).
+        """
+        if not self.client.indices.exists_alias(name=self.alias):
+            return []
+
+        return sorted(self.client.indices.get_alias(name=self.alias))
+
+    def is_legacy(self):
+        """Is `alias` a plain index (created before versioning)?"""
+        return not self.current() and \
+            self.client.indices.exists(index=self.alias)
+
+    def create(self):
+        """
+        Creates the next version with the current mappings and
+        settings of `elastic.Place`, not aliased yet.
+
+        :return: <str> name of the new index.
+        """
+        versions = self.versions()
+        name = version_name(self.alias, versions[-1][0] + 1 if versions
+                            else 1)
+        elastic.Place._index.clone(name=name).create(using=self.using)
+        LOG.debug("Created index %s", name)
+        return name
+
+    def reindex(self, dest, source=None, slices=None, query=None):
+        """
+        Copies documents from `source` (default the current index)
+        into `dest` on the server side, in `slices` parallel parts
+        (default `settings.ES_REINDEX_SLICES`), in bulk-load mode.
+        Useful when only mappings changed: nothing is downloaded
+        and transformed again.
+
+        :param query: <dict> to copy only matching documents.
+        :return: <dict> result of the reindex task (counters,
+            "failures").
+        """
+        if source is None:
+            source = self.current() or [self.alias]
+        body = {"source": {"index": source}, "dest": {"index": dest}}
+        if query is not None:
+            body["source"]["query"] = query
+
+        with elastic.bulk_load(index=dest, using=self.using):
+            task = self.client.reindex(
+                body=body, slices=slices or settings.ES_REINDEX_SLICES,
+                wait_for_completion=False)
+            result = self.wait(task["task"])
+
+        if result.get("failures"):
+            LOG.error("Reindex into %s: %d failures, the first one: %s",
+                      dest, len(result["failures"]), result["failures"][0])
+        LOG.debug("Reindexed %s into %s: %d documents", source, dest,
+                  result.get("created", 0) + result.get("updated", 0))
+        return result
+
+    def wait(self, task_id):
+        """Waits for a task to complete, returns its response."""
+        while True:
+            resp = self.client.tasks.get(
+                task_id=task_id, wait_for_completion=True,
+                timeout=TASK_POLL_TIMEOUT)
+            if resp.get("completed"):
+                if resp.get("error"):
+                    raise RequestFailedError("Task {} failed: {}".format(
+                        task_id, resp["error"]))
+                return resp.get("response", {})
+            time.sleep(1)
+
+    def swap(self, name):
+        """
+        Points the alias to `name` only (atomically), it becomes
+        the write index too.
+        """
+        actions = [{"remove": {"index": index, "alias": self.alias}}
+                   for index in self.current() if index != name]
+        actions.append({"add": {"index": name, "alias": self.alias,
+                                "is_write_index": True}})
+        self.client.indices.update_aliases(body={"actions": actions})
+        LOG.debug("Alias %s -> %s", self.alias, name)
+
+    def migrate(self):
+        """
+        Turns a legacy plain index named as the alias into the first
+        version: reindexes it, then deletes it and creates the alias
+        in the same atomic request.
+
+        :return: <str> name of the new index.
+        """
+        if not self.is_legacy():
+            raise UnsupportedValueError(
+                "{} is not a plain index".format(self.alias))
+
+        name = self.create()
+        self.reindex(name, source=self.alias)
+        self.client.indices.update_aliases(body={"actions": [
+            {"remove_index": {"index": self.alias}},
+            {"add": {"index": name, "alias": self.alias,
+                     "is_write_index": True}}
+            ]})
+        LOG.debug("Migrated %s into %s", self.alias, name)
+        return name
+
+    def cleanup(self, keep=None, building=None):
+        """
+        Deletes old versions, except for the current ones and `keep`
+        (default `settings.ES_INDEX_VERSIONS_KEPT`) newest versions
+        older than them. Versions newer than the current one might
+        be being built: they are deleted only if `building` is given
+        and doesn't list them (abandoned by a failed rebuild).
+
+        :param building: <list> of index names being built.
+        :return: <list> of deleted index names.
+        """
+        keep = settings.ES_INDEX_VERSIONS_KEPT if keep is None else keep
+        current = set(self.current())
+        versions = self.versions()
+        newest = max([v for v, name in versions if name in current],
+                     default=None)
+        if newest is None:
+            return []
+
+        older = [name for version, name in versions
+                 if version < newest and name not in current]
+        deleted = older[:max(len(older) - keep, 0)]
+        if building is not None:
+            deleted.extend(name for version, name in versions
+                           if version > newest and name not in building)
+        for name in deleted:
+            self.client.indices.delete(index=name)
+            LOG.debug("Deleted index %s", name)
+
+        return deleted
@@ -18,5 +18,9 @@ setup(
         'elasticsearch-dsl==7.3.0',
         'pycountry==20.7.3'
     ],
+    extras_require={
+        'geometry': ['numpy'],
+        'async': ['aiohttp']
+    },
     zip_safe=False
 )
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fixtures: the Elasticsearch stand-in, a local HTTP server for
+repository archives (and anything else fetched over HTTP), and
+synthetic WOF data. Nothing is written outside of temporary
+directories.
+"""
+
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from geoometa.conf import settings
+from geoometa.conf.connections import set_client
+from geoometa.core.standin import StandIn
+from geoometa.schema import elastic
+
+from benchmarks.synthetic import SyntheticWOF
+
+
+OWNER = "whosonfirst-data"
+
+
+class Resource:
+    """Response of `FileServer` for a path."""
+
+    def __init__(self, body, content_type="application/zip", headers=None):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+class FileServer:
+    """
+    HTTP server of `resources` (path -> `Resource`), answers
+    conditional requests by ETag, keeps the log of requests as
+    (path, request headers, status).
+    """
+
+    def __init__(self):
+        self.resources = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def add(self, path, body, **kwargs):
+        self.resources[path] = Resource(body, **kwargs)
+        return self.url + path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def statuses(self):
+        with self.lock:
+            return [status for _, _, status in self.requests]
+
+
+def _handler(files):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            resource = files.resources.get(self.path)
+            if resource is None:
+                status = 404
+            elif resource.headers.get("ETag") and resource.headers["ETag"] \
+                    == self.headers.get("If-None-Match"):
+                status = 304
+            else:
+                status = 200
+            with files.lock:
+                files.requests.append((self.path, dict(self.headers), status))
+
+            self.send_response(status)
+            body = resource.body if status == 200 else b""
+            if resource is not None:
+                for name, value in resource.headers.items():
+                    self.send_header(name, value)
+                if status == 200:
+                    self.send_header("Content-Type", resource.content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    """Downloads, state, journal and caches go to `tmp_path`."""
+    downloads = str(tmp_path / "downloads")
+    monkeypatch.setattr(settings, "DOWNLOAD_DIR", downloads)
+    monkeypatch.setattr(settings, "SYNC_STATE_FILE",
+                        os.path.join(downloads, "sync_state.json"))
+    monkeypatch.setattr(settings, "HTTP_CACHE_DIR",
+                        os.path.join(downloads, "http-cache"))
+    monkeypatch.setattr(settings, "ARCHIVE_CACHE_DIR",
+                        os.path.join(downloads, "archives"))
+    monkeypatch.setattr(settings, "JOURNAL_FILE",
+                        os.path.join(downloads, "journal.sqlite"))
+    monkeypatch.setattr(settings, "METRICS_JSON", None)
+    monkeypatch.setattr(settings, "METRICS_TEXTFILE", None)
+    monkeypatch.setattr(settings, "ERROR_LOG_FILE", None)
+    return tmp_path
+
+
+@pytest.fixture
+def standin():
+    """Stand-in server, the client of `elastic.Place` uses it."""
+    with StandIn(seed=1) as server:
+        set_client(server.client(), elastic.ALIAS)
+        yield server
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def generator():
+    return SyntheticWOF(seed=1, vertices=5)
+
+
+@pytest.fixture
+def repos(file_server, generator, tmp_path):
+    """
+    Makes `repos(*sizes)`: records of repositories with that many
+    files each (distinct ids), their archives served by
+    `file_server` as GitHub serves them.
+    """
+    def make(*sizes):
+        records, start = [], 1
+        for n, size in enumerate(sizes):
+            name = "whosonfirst-data-test-{}".format(n)
+            path = generator.write_archive(
+                str(tmp_path / (name + ".zip")), size, start=start)
+            with open(path, "rb") as fp:
+                file_server.add("/{}/{}/archive/refs/heads/master.zip"
+                                .format(OWNER, name), fp.read())
+            records.append({
+                "name": name,
+                "html_url": "{}/{}/{}".format(file_server.url, OWNER, name),
+                "default_branch": "master",
+                "pushed_at": "2021-01-01T00:00:00Z",
+                "size": 1
+                })
+            start += size
+
+        return records
+
+    return make
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""`AsyncGazetteerCollector` end to end against the stand-in."""
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from geoometa.core.aio import AsyncGazetteerCollector
+from geoometa.core.integrators import SyncState, UNPACK_MODES
+from geoometa.core.journal import Journal
+from geoometa.conf import settings
+
+
+def collector(records, **kwargs):
+    kwargs.setdefault("journal", False)
+    kwargs.setdefault("cache_archives", False)
+    kwargs.setdefault("hierarchy", False)
+    kwargs.setdefault("chunk_size", 40)
+    kwargs.setdefault("initial_backoff", 0.001)
+    kwargs.setdefault("concurrent_repos", 2)
+    return AsyncGazetteerCollector(None, repos=[dict(r) for r in records],
+                                   **kwargs)
+
+
+def count(standin):
+    return standin.client().count(index="geoo")["count"]
+
+
+@pytest.mark.parametrize("unpack", UNPACK_MODES)
+def test_process(standin, repos, unpack):
+    records = repos(120, 80, 50)
+    gazetteer = collector(records, unpack=unpack, downloads=1)
+    gazetteer.process()
+
+    assert gazetteer.stat.success == 250
+    assert len(gazetteer.stat.errors) == 0
+    assert count(standin) == 250
+    assert standin.stats["bulk_items"] == 250
+    assert sorted(SyncState().repos) == sorted(r["html_url"] for r in records)
+
+    summary = gazetteer.metrics.summary()
+    assert summary.stages["index"]["count"] == 250
+
+
+def test_process_retries_rejected(standin, repos):
+    standin.item_failure_rate = 0.2
+    gazetteer = collector(repos(100, 100), max_retries=10)
+    gazetteer.process()
+
+    rejected = standin.stats["bulk_items_rejected"]
+    assert rejected > 0
+    assert standin.stats["bulk_items"] == 200 + rejected
+    assert gazetteer.stat.success == 200
+    assert count(standin) == 200
+
+
+def test_process_out_of_retries(standin, repos):
+    standin.item_failure_rate = 1.
+    records = repos(20, 30)
+    gazetteer = collector(records, max_retries=1)
+    gazetteer.process()
+
+    assert gazetteer.stat.success == 0
+    assert gazetteer.stat.errors.by_repo == {records[0]["name"]: 20,
+                                             records[1]["name"]: 30}
+    assert SyncState().repos == {}
+
+
+def test_process_journal(standin, repos):
+    records = repos(60, 40)
+    gazetteer = collector(records, journal=True, chunk_size=25)
+    gazetteer.process()
+    assert gazetteer.stat.success == 100
+
+    with Journal(settings.JOURNAL_FILE) as journal:
+        (files,) = journal.db.execute("SELECT COUNT(*) FROM files").fetchone()
+        assert files == 100
+        # The run is finished: the next one is not resumed.
+        assert not journal.start().resumed
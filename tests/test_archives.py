@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""Reading ZIP archives and streams, the archive cache."""
+
+import io
+import os
+import zipfile
+
+import pytest
+
+from geoometa.core.archives import ArchiveCache, iter_archive, \
+     iter_zip_stream, file_sha256
+from geoometa.core.exceptions import MalformedValueError, \
+     RequestFailedError
+
+
+FILES = [
+    ("repo-master/data/1.geojson", b'{"id": 1}' * 100),
+    ("repo-master/README.md", b"# not data"),
+    # Content looking like a data descriptor record.
+    ("repo-master/data/2.geojson", b"PK\x07\x08" + b"\0" * 12 + b"x" * 50),
+    ("repo-master/data/3.geojson", b""),
+    ]
+GEOJSON = [(name, raw) for name, raw in FILES if name.endswith(".geojson")]
+
+
+class Unseekable(io.RawIOBase):
+    """Output that zipfile can't seek: members get data descriptors."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def make_zip(compression=zipfile.ZIP_DEFLATED, seekable=True, files=FILES):
+    out = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(out, "w", compression) as zfp:
+        zfp.writestr("repo-master/data/", b"")
+        for name, raw in files:
+            zfp.writestr(name, raw)
+    return (out if seekable else out.buffer).getvalue()
+
+
+class Trickle(io.RawIOBase):
+    """Stream returning at most `size` bytes per read."""
+
+    def __init__(self, data, size=7):
+        self.data = io.BytesIO(data)
+        self.size = size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(self.size if size < 0 else min(size, self.size))
+
+
+def test_iter_archive(tmp_path):
+    path = tmp_path / "repo.zip"
+    path.write_bytes(make_zip())
+    assert list(iter_archive(str(path))) == GEOJSON
+    assert list(iter_archive(io.BytesIO(make_zip()), suffix=".md")) == \
+        [FILES[1]]
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED,
+                                         zipfile.ZIP_STORED])
+@pytest.mark.parametrize("seekable", [True, False])
+def test_iter_zip_stream(compression, seekable):
+    data = make_zip(compression, seekable)
+    assert list(iter_zip_stream(io.BytesIO(data))) == GEOJSON
+    assert list(iter_zip_stream(Trickle(data), chunk_size=5)) == GEOJSON
+
+
+def test_iter_zip_stream_empty():
+    assert list(iter_zip_stream(io.BytesIO(make_zip(files=[])))) == []
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_iter_zip_stream_truncated(seekable):
+    data = make_zip(zipfile.ZIP_STORED, seekable)
+    # Cut in the middle of the last member.
+    end = data.index(b"PK\x01\x02") - 10
+    with pytest.raises(MalformedValueError):
+        list(iter_zip_stream(io.BytesIO(data[:end])))
+
+    # Nothing after the last member.
+    end = data.index(b"PK\x01\x02")
+    with pytest.raises(MalformedValueError):
+        list(iter_zip_stream(io.BytesIO(data[:end])))
+
+
+def test_iter_zip_stream_garbage():
+    with pytest.raises(MalformedValueError):
+        list(iter_zip_stream(io.BytesIO(b"<html>Not Found</html>")))
+
+
+def test_archive_cache(tmp_path, file_server):
+    data = make_zip()
+    url = file_server.add("/repo.zip", data)
+    cache = ArchiveCache(str(tmp_path / "archives"))
+    assert cache.get("repo-abc") is None
+
+    path = cache.fetch(url, "repo-abc")
+    assert list(iter_archive(path)) == GEOJSON
+    assert cache.fetch(url, "repo-abc", verify=True) == path
+    assert len(file_server.requests) == 1
+
+    # Corrupted: downloaded again.
+    with open(path, "ab") as fp:
+        fp.write(b"x")
+    assert cache.get("repo-abc") is None
+    path = cache.fetch(url, "repo-abc")
+    assert file_sha256(path) == file_sha256_of(data, tmp_path)
+    assert len(file_server.requests) == 2
+
+
+def test_archive_cache_restarts_partial(tmp_path, file_server):
+    # The server ignores Range: the download starts over.
+    data = make_zip()
+    url = file_server.add("/repo.zip", data)
+    cache = ArchiveCache(str(tmp_path / "archives"))
+    part = cache.filename("repo-abc") + ".part"
+    os.makedirs(os.path.dirname(part))
+    with open(part, "wb") as fp:
+        fp.write(data[:100])
+
+    path = cache.fetch(url, "repo-abc")
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+    assert file_server.requests[0][1]["Range"] == "bytes=100-"
+
+
+def test_archive_cache_failures(tmp_path, file_server):
+    cache = ArchiveCache(str(tmp_path / "archives"))
+    with pytest.raises(RequestFailedError):
+        cache.fetch(file_server.url + "/missing.zip", "missing")
+
+    url = file_server.add("/broken.zip", b"not a zip")
+    with pytest.raises(MalformedValueError):
+        cache.fetch(url, "broken")
+    assert os.listdir(cache.path) == []
+
+
+def test_archive_cache_evict(tmp_path, file_server):
+    data = make_zip()
+    cache = ArchiveCache(str(tmp_path / "archives"),
+                         max_bytes=int(len(data) * 2.5))
+    for n in range(4):
+        url = file_server.add("/repo-{}.zip".format(n), data)
+        cache.fetch(url, "repo-{}".format(n))
+        # Distinct modification times.
+        os.utime(cache.filename("repo-{}".format(n)), (n, n))
+
+    cache.evict()
+    assert sorted(os.listdir(cache.path)) == [
+        "repo-2.json", "repo-2.zip", "repo-3.json", "repo-3.zip"]
+
+
+def file_sha256_of(data, tmp_path):
+    path = tmp_path / "expected.zip"
+    path.write_bytes(data)
+    return file_sha256(str(path))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""HTTP cache of GitHub pages, the query cache."""
+
+import json
+import threading
+import time
+
+import pytest
+
+from geoometa.conf import settings
+from geoometa.core import utils
+from geoometa.core.cache import HTTPCache, QueryCache
+from geoometa.core.exceptions import RequestFailedError
+from geoometa.core.utils import fetch, read_github
+
+
+PATH = "/orgs/whosonfirst-data/repos"
+
+
+def serve_pages(file_server, pages=5, per_page=3):
+    """Pages of repos, linked as GitHub links them."""
+    url = "{}{}?per_page={}".format(file_server.url, PATH, per_page)
+    last = "<{}&page={}>; rel=\"last\"".format(url, pages)
+    expected = []
+    for page in range(1, pages + 1):
+        repos = [{"name": "whosonfirst-data-{}-{}".format(page, n)}
+                 for n in range(per_page)]
+        expected.extend(repos)
+        path = "{}?per_page={}".format(PATH, per_page)
+        if page > 1:
+            path += "&page={}".format(page)
+        headers = {"ETag": '"page-{}"'.format(page)}
+        if page < pages:
+            headers["Link"] = "<{}&page={}>; rel=\"next\", {}".format(
+                url, page + 1, last)
+        file_server.add(path, json.dumps(repos).encode("utf-8"),
+                        content_type="application/json", headers=headers)
+
+    return url, expected
+
+
+def test_read_github_revalidates(tmp_path, file_server):
+    # Repeated listings are served by 304s (free of the rate limit).
+    url, expected = serve_pages(file_server)
+    cache = HTTPCache(str(tmp_path / "http"))
+    first = read_github(url, cache=cache)
+    assert sorted(first, key=lambda r: r["name"]) == expected
+    assert file_server.statuses() == [200] * 5
+
+    second = read_github(url, cache=cache)
+    assert sorted(second, key=lambda r: r["name"]) == expected
+    assert file_server.statuses()[5:] == [304] * 5
+    assert all(headers.get("If-None-Match")
+               for _, headers, _ in file_server.requests[5:])
+
+
+def test_read_github_without_cache(file_server):
+    url, expected = serve_pages(file_server, pages=2)
+    assert sorted(read_github(url, workers=1), key=lambda r: r["name"]) == \
+        expected
+    assert file_server.statuses() == [200, 200]
+
+
+def test_not_modified_without_entry(tmp_path, file_server):
+    url = file_server.add("/page", b"[]", content_type="application/json",
+                          headers={"ETag": '"x"'})
+    with pytest.raises(RequestFailedError):
+        fetch(url, cache=HTTPCache(str(tmp_path / "http")),
+              headers={"If-None-Match": '"x"'})
+
+
+def test_http_cache_needs_validators(tmp_path):
+    cache = HTTPCache(str(tmp_path / "http"))
+    cache.set("http://example.com/a", {"content-type": "text/plain"}, "a")
+    assert cache.get("http://example.com/a") is None
+
+    cache.set("http://example.com/b", {"etag": '"b"'}, "b")
+    entry = cache.get("http://example.com/b")
+    assert entry["body"] == "b"
+    assert cache.validators(entry) == {"If-None-Match": '"b"'}
+
+
+def test_read_github_workers(monkeypatch, file_server):
+    # Pages after the first are fetched by settings.GITHUB_WORKERS
+    # threads unless told otherwise.
+    executors = []
+
+    class Executor(utils.ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            executors.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(utils, "ThreadPoolExecutor", Executor)
+    monkeypatch.setattr(settings, "GITHUB_WORKERS", 2)
+    url, expected = serve_pages(file_server, pages=3)
+    assert len(read_github(url)) == len(read_github(url, workers=3)) == \
+        len(expected)
+    assert executors == [2, 3]
+
+
+def test_query_cache_lru_and_ttl():
+    cache = QueryCache(max_size=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" is the least recently used.
+    assert cache.get("b") is None
+    assert cache.stats().evictions == 1
+
+    time.sleep(0.06)
+    assert cache.get("a", "expired") == "expired"
+    assert cache.stats().hits == 1
+
+
+def test_query_cache_copies():
+    cache = QueryCache(max_size=10, ttl=0)
+    value = {"hits": [1, 2]}
+    cache.set("q", value)
+    value["hits"].append(3)
+    hit = cache.get("q")
+    assert hit == {"hits": [1, 2]}
+    hit["hits"].clear()
+    assert cache.get("q") == {"hits": [1, 2]}
+
+
+def test_query_cache_generation():
+    generations = []
+    current = [1]
+    started = threading.Event()
+    release = threading.Event()
+
+    def generation():
+        generations.append(current[0])
+        started.set()
+        release.wait(5)
+        return current[0]
+
+    cache = QueryCache(max_size=10, ttl=0, generation=generation,
+                       check_interval=0)
+    release.set()
+    # The first check learns the generation.
+    assert cache.get("q") is None
+    cache.set("q", "old")
+    assert cache.get("q") == "old"
+
+    # One check at a time: the others serve the cache meanwhile.
+    cache.check_interval = 60
+    cache.checked_at = None
+    release.clear()
+    started.clear()
+    current[0] = 2
+    checking = threading.Thread(target=cache.get, args=("q",))
+    checking.start()
+    started.wait(5)
+    calls = len(generations)
+    results = [cache.get("q") for _ in range(20)]
+    release.set()
+    checking.join()
+
+    assert results == ["old"] * 20
+    assert len(generations) == calls
+    assert cache.get("q") is None
+    assert cache.stats().invalidations == 1
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Index setup and bulk load mode against the stand-in."""
+
+import pytest
+
+from geoometa.conf import settings
+from geoometa.schema import elastic
+
+
+TUNED = ("index.refresh_interval", "index.number_of_replicas",
+         "index.translog.flush_threshold_size")
+
+
+def index_settings(standin, index="geoo"):
+    resp = standin.client().indices.get_settings(index=index,
+                                                 flat_settings=True)
+    ((_, settings),) = resp.items()
+    return {key: settings["settings"].get(key) for key in TUNED}
+
+
+@pytest.fixture
+def index(standin):
+    elastic.setup()
+    standin.client().indices.put_settings(index="geoo", body={
+        "index.refresh_interval": "5s", "index.number_of_replicas": "2"})
+    return {"index.refresh_interval": "5s",
+            "index.number_of_replicas": "2",
+            "index.translog.flush_threshold_size": None}
+
+
+def test_bulk_load(standin, index):
+    with elastic.bulk_load(max_segments=1):
+        assert index_settings(standin) == {
+            "index.refresh_interval": "-1",
+            "index.number_of_replicas": "0",
+            "index.translog.flush_threshold_size": "2gb"}
+        assert standin.stats["_refresh"] == 0
+
+    assert index_settings(standin) == index
+    assert standin.stats["_refresh"] == 1
+    assert standin.stats["_forcemerge"] == 1
+
+
+def test_bulk_load_restores_on_error(standin, index):
+    with pytest.raises(RuntimeError):
+        with elastic.bulk_load():
+            raise RuntimeError("failed load")
+
+    assert index_settings(standin) == index
+    assert standin.stats["_refresh"] == 1
+    # Not merged unless asked to.
+    assert standin.stats["_forcemerge"] == 0
+
+
+def test_bulk_load_after_interrupted(standin, index):
+    # Refresh left off by an interrupted load is reset to default.
+    standin.client().indices.put_settings(
+        index="geoo", body=elastic.bulk_load_settings())
+    with elastic.bulk_load():
+        pass
+
+    assert index_settings(standin) == {
+        "index.refresh_interval": None,
+        "index.number_of_replicas": str(settings.ES_REPLICAS),
+        "index.translog.flush_threshold_size": None}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass `PropertyExtractor` gives the same fields as the
+per-field `extract_*` methods of `elastic.Place` it replaced (copied
+below as the reference).
+"""
+
+import copy
+
+import pytest
+
+from geoometa.schema import elastic
+from geoometa.schema.extractors import PropertyExtractor
+from geoometa.schema.references import LANG_MAP
+
+
+def flatten_list(values):
+    flat = []
+    for val in values:
+        if isinstance(val, list):
+            flat.extend(flatten_list(val))
+        else:
+            flat.append(val)
+    return flat
+
+
+def distinct_elements(values):
+    distinct = []
+    for val in values:
+        if val not in distinct:
+            distinct.append(val)
+    return distinct
+
+
+def reference_timezone(properties):
+    for field, val in properties.items():
+        try:
+            _, tz_fieldname = field.split(":")
+        except Exception:
+            continue
+
+        if tz_fieldname.lower() == "timezone":
+            return val
+
+
+def reference_names(properties):
+    names = []
+    names_lang = {}
+    for field, val in properties.items():
+        if not isinstance(val, list):
+            val = [val]
+
+        if field.endswith(":name"):
+            names.extend(val)
+
+        if field.startswith("name:") and (
+                field.endswith("_preferred") or field.endswith("_variant")):
+            names.extend(val)
+            try:
+                _, lang = field.split(":")
+                lang = lang.split("_")[0]
+            except Exception:
+                continue
+            else:
+                try:
+                    lang = LANG_MAP[lang]
+                except KeyError:
+                    lang = lang[:2]
+
+            try:
+                names_lang[lang].extend(val)
+            except KeyError:
+                names_lang[lang] = val
+            except Exception:
+                continue
+
+    names = distinct_elements(flatten_list(names))
+    return {"names": names, "names_lang": names_lang}
+
+
+def reference_population(properties):
+    try:
+        return int(properties["wof:population"])
+    except (KeyError, ValueError):
+        pass
+
+    for key, val in properties.items():
+        if key.endswith(":population"):
+            try:
+                return int(val)
+            except ValueError:
+                continue
+
+    return None
+
+
+def reference_location(properties):
+    try:
+        return {"lat": properties["geom:latitude"],
+                "lon": properties["geom:longitude"]}
+    except KeyError:
+        pass
+
+    for key in properties.keys():
+        if key.endswith(":latitude"):
+            lat = properties[key]
+            schema, _ = key.split(":")
+            try:
+                lon = properties[":".join([schema, "longitude"])]
+            except KeyError:
+                continue
+            else:
+                return {"lat": lat, "lon": lon}
+    return {}
+
+
+def reference_extract(properties):
+    # The old code changed lists of properties in place.
+    properties = copy.deepcopy(properties)
+    obj = {}
+    for src, trg in elastic.FIELD_MAP.items():
+        obj[trg] = properties.get(src)
+    obj.update(reference_names(properties))
+    obj.update({
+        "location": reference_location(properties),
+        "timezone": reference_timezone(properties),
+        "population": reference_population(properties)
+        })
+    return obj
+
+
+EDGE_CASES = [
+    {},
+    {"wof:name": "Plain", "geom:latitude": 1.5, "geom:longitude": 2.5},
+    # Other coordinate schemes, in pairs only.
+    {"lbl:latitude": 1, "mps:latitude": 3, "mps:longitude": 4},
+    {"geom:latitude": 1, "lbl:latitude": 5, "lbl:longitude": 6},
+    # Population from the other keys when the main one is no number.
+    {"wof:population": "many", "gn:population": "12", "qs:population": 7},
+    {"gn:population": "x", "qs:population": "7"},
+    # Names: duplicates, nesting, unknown and odd languages.
+    {"wof:name": "Twin", "name:eng_x_preferred": ["Twin", "Twins"],
+     "name:eng_x_variant": ["Twin"], "name:kor_x_preferred": ["Tw"],
+     "name:zzz_x_variant": "Single", "qs:name": [["Nested"], "Twin"],
+     "name:a:b_x_preferred": ["Odd"]},
+    # Timezone of any prefix (the first one), not of nested keys.
+    {"tz:timezone": "Europe/Rome", "wof:timezone": "Etc/UTC",
+     "a:b:timezone": "x"},
+    {"wof:TimeZone": "Asia/Tokyo"},
+    ]
+
+
+@pytest.mark.parametrize("properties", EDGE_CASES)
+def test_edge_cases(properties):
+    assert PropertyExtractor(elastic.FIELD_MAP).extract(properties) == \
+        reference_extract(properties)
+
+
+def test_synthetic_features(generator):
+    extractor = PropertyExtractor(elastic.FIELD_MAP)
+    for feature in generator.features(300):
+        properties = feature["properties"]
+        assert extractor.extract(properties) == \
+            reference_extract(properties)
+        # Memoized roles give the same result.
+        assert elastic.EXTRACTOR.extract(properties) == \
+            reference_extract(properties)
+
+
+def test_population_of_none():
+    # The old code raised TypeError here.
+    extracted = elastic.EXTRACTOR.extract({"wof:population": None,
+                                           "gn:population": 5})
+    assert extracted["population"] == 5
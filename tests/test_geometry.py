@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Simplification and validity of geometries."""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from geoometa.core.geometry import (  # noqa: E402
+    GeometrySimplifier, edges_intersect, polygon_is_valid)
+
+
+SQUARE = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+BOW_TIE = [[0, 0], [10, 10], [10, 0], [0, 10], [0, 0]]
+HOLE = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+# A square with a low peak on top, and a hole under the peak: with
+# a tolerance over 2 the peak is cut off along with the hole.
+PEAK = [[0, 0], [10, 0], [10, 10], [5, 12], [0, 10], [0, 0]]
+UNDER_PEAK = [[4, 10.2], [6, 10.2], [5, 11], [4, 10.2]]
+
+
+def circle(size, x=0., y=0., radius=1., z=None):
+    angles = np.linspace(0, 2 * np.pi, size, endpoint=False)
+    ring = [[x + radius * np.cos(a), y + radius * np.sin(a)]
+            for a in angles]
+    if z is not None:
+        ring = [position + [z + n] for n, position in enumerate(ring)]
+    return ring + [ring[0]]
+
+
+@pytest.mark.parametrize("rings, valid", [
+    ([SQUARE], True),
+    ([BOW_TIE], False),
+    ([SQUARE, HOLE], True),
+    # Hole outside the shell.
+    ([SQUARE, [[x + 20, y] for x, y in HOLE]], False),
+    # Hole touching the shell.
+    ([SQUARE, [[0, 4], [6, 4], [6, 6], [4, 6], [0, 4]]], False),
+    # An edge folding back along the previous one.
+    ([[[0, 0], [10, 0], [5, 0], [5, 5], [0, 0]]], False),
+    ([PEAK, UNDER_PEAK], True),
+    ([], False),
+])
+def test_polygon_is_valid(rings, valid):
+    assert polygon_is_valid(rings) is valid
+
+
+def test_edges_intersect():
+    assert not edges_intersect([circle(500)])
+    assert not edges_intersect([circle(500), circle(50, radius=.5)])
+    assert edges_intersect([circle(500), circle(50, x=1.)])
+    assert edges_intersect([BOW_TIE])
+    # Only the x-overlapping edges are compared: a crossing between
+    # the first and the last ones along x is still found.
+    assert edges_intersect([[[0, 0], [100, 1], [100, 0], [0, 1], [0, 0]]])
+    assert not edges_intersect([])
+
+
+def test_simplify_ring():
+    simplifier = GeometrySimplifier({"locality": .05})
+    ring = circle(1000)
+    geometry, before, after = simplifier.simplify(
+        {"type": "Polygon", "coordinates": [ring]}, "locality")
+    assert before == 1001
+    assert after == len(geometry["coordinates"][0]) < 100
+    assert geometry["coordinates"][0][0] == geometry["coordinates"][0][-1]
+    assert polygon_is_valid(geometry["coordinates"])
+
+    # Placetypes without a tolerance are only quantized.
+    geometry, before, after = GeometrySimplifier(
+        {"locality": .05}, precision=2).simplify(
+        {"type": "Polygon", "coordinates": [ring]}, "region")
+    assert before == 1001 and 100 < after < 1001
+    assert all(round(x, 2) == x for x, _ in geometry["coordinates"][0])
+
+
+def test_simplify_halves_tolerance():
+    polygon = {"type": "Polygon", "coordinates": [PEAK, UNDER_PEAK]}
+    geometry, before, after = GeometrySimplifier(
+        {"default": 3.}).simplify(polygon)
+    # With 3 the peak goes, and the hole ends up outside; with 1.5
+    # the peak stays.
+    assert [5, 12] in geometry["coordinates"][0]
+    assert polygon_is_valid(geometry["coordinates"])
+    assert before == after == 10
+
+    # Without the hole nothing holds the peak.
+    geometry, before, after = GeometrySimplifier(
+        {"default": 3.}).simplify({"type": "Polygon", "coordinates": [PEAK]})
+    assert [5, 12] not in geometry["coordinates"][0]
+    assert (before, after) == (6, 5)
+
+
+def test_simplify_keeps_invalid():
+    # Hole outside the shell: no tolerance helps, the polygon is kept
+    # as is, not even quantized.
+    rings = [circle(200), circle(20, x=5.)]
+    geometry, before, after = GeometrySimplifier(
+        {"default": .05}, precision=2).simplify(
+        {"type": "Polygon", "coordinates": rings})
+    assert geometry["coordinates"] is rings
+    assert before == after == 222
+
+
+def test_simplify_keeps_degenerated():
+    # A tiny hole would lose positions: it is kept, never dropped.
+    hole = circle(6, radius=.01)
+    geometry, before, after = GeometrySimplifier({"default": .5}).simplify(
+        {"type": "Polygon", "coordinates": [circle(100), hole]})
+    shell, kept = geometry["coordinates"]
+    assert kept == hole
+    assert len(shell) < 101
+    assert after == len(shell) + 7 and before == 108
+
+
+def test_simplify_multipolygon():
+    polygons = [[circle(300)], [circle(300, x=5.), circle(30, x=5., radius=.5)]]
+    geometry, before, after = GeometrySimplifier({"default": .05}).simplify(
+        {"type": "MultiPolygon", "coordinates": polygons})
+    assert before == 301 + 301 + 31
+    assert len(geometry["coordinates"]) == 2
+    assert [len(rings) for rings in geometry["coordinates"]] == [1, 2]
+    assert after == sum(len(ring) for rings in geometry["coordinates"]
+                        for ring in rings) < before
+    assert all(polygon_is_valid(rings) for rings in geometry["coordinates"])
+
+
+def test_simplify_3d():
+    simplifier = GeometrySimplifier({"default": .01}, precision=3)
+    geometry, before, after = simplifier.simplify({
+        "type": "LineString",
+        "coordinates": [[0, 0, 5], [1, .001, 6], [2, 0, 7.12345]]})
+    # Distances are along x, y only, the rest is kept (and rounded).
+    assert geometry["coordinates"] == [[0, 0, 5], [2, 0, 7.123]]
+    assert (before, after) == (3, 2)
+
+    ring = circle(500, z=100.)
+    geometry, before, after = simplifier.simplify(
+        {"type": "Polygon", "coordinates": [ring]})
+    assert before == 501 and after < 100
+    assert all(len(position) == 3 for position in geometry["coordinates"][0])
+    assert geometry["coordinates"][0][0] == geometry["coordinates"][0][-1]
+
+
+def test_simplify_other_types():
+    simplifier = GeometrySimplifier({"default": 1.}, precision=1)
+    collection = {"type": "GeometryCollection", "geometries": [
+        {"type": "Point", "coordinates": [1.26, 2.31]},
+        {"type": "MultiPoint", "coordinates": [[0, 0], [0, .01], [5, 5]]},
+        {"type": "Unknown", "coordinates": []}]}
+    geometry, before, after = simplifier.simplify(collection)
+    point, points, unknown = geometry["geometries"]
+    assert point["coordinates"] == [1.3, 2.3]
+    # Points are never simplified, only duplicates after rounding go.
+    assert points["coordinates"] == [[0, 0], [5, 5]]
+    assert unknown is collection["geometries"][2]
+    assert (before, after) == (4, 3)
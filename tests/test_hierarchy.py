@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Materialized hierarchy of places."""
+
+from geoometa.core.hierarchy import HierarchyMaterializer
+from geoometa.schema import elastic
+
+
+PLACES = [
+    # id, name, placetype, parent_id, belongsto
+    (1, "Country", "country", -1, []),
+    (2, "Region", "region", 1, [1]),
+    (3, "City", "locality", 2, [1, 2]),
+    # Parent unknown: ancestors from belongsto.
+    (4, "Hood", "neighbourhood", -1, [3, 1, 2]),
+    # A cycle is cut.
+    (5, "Loop A", "locality", 6, []),
+    (6, "Loop B", "locality", 5, []),
+    # Parent outside the index.
+    (7, "Orphan", "locality", 999, []),
+    ]
+
+
+def index_places(standin):
+    elastic.setup()
+    client = standin.client()
+    for place_id, name, placetype, parent_id, belongsto in PLACES:
+        client.index(index="geoo", id=place_id, body={
+            "name": name, "placetype": placetype,
+            "parent_id": parent_id, "belongsto": belongsto})
+    return client
+
+
+def ancestors(client, place_id):
+    src = client.get(index="geoo", id=place_id)["_source"]
+    return src.get("ancestors"), src.get("ancestor_names"), \
+        src.get("ancestor_placetypes"), src.get("ancestor_path")
+
+
+def test_materialize(standin):
+    client = index_places(standin)
+    stat = HierarchyMaterializer(chunk_size=3).materialize()
+    assert stat.errors == 0
+    assert stat.updated + stat.unchanged == len(PLACES)
+
+    assert ancestors(client, 3) == (
+        ["1", "2"], ["Country", "Region"], ["country", "region"], "1/2")
+    assert ancestors(client, 4) == (
+        ["1", "2", "3"], ["Country", "Region", "City"],
+        ["country", "region", "locality"], "1/2/3")
+    assert ancestors(client, 5)[0] == ["6"]
+    # Without ancestors: nothing to change.
+    assert ancestors(client, 1)[0] is None
+    assert ancestors(client, 7)[0] is None
+    assert stat.updated == 5
+
+    # Nothing changed: nothing is sent.
+    bulk_items = standin.stats["bulk_items"]
+    stat = HierarchyMaterializer().materialize()
+    assert stat.updated == 0 and stat.unchanged == len(PLACES)
+    assert standin.stats["bulk_items"] == bulk_items
+
+
+def test_materialize_after_move(standin):
+    client = index_places(standin)
+    HierarchyMaterializer().materialize()
+    src = client.get(index="geoo", id=2)["_source"]
+    src["parent_id"] = -1
+    src["belongsto"] = []
+    client.index(index="geoo", id=2, body=src)
+
+    stat = HierarchyMaterializer().materialize()
+    # Places below keep the country from their belongsto.
+    assert stat.updated == 1
+    assert ancestors(client, 2) == ([], [], [], "")
+    assert ancestors(client, 3)[0] == ["1", "2"]
+    assert ancestors(client, 4)[0] == ["1", "2", "3"]
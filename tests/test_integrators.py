@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""`GazetteerCollector.process` end to end against the stand-in."""
+
+import json
+from datetime import datetime
+
+import pytest
+
+from geoometa.conf import settings
+from geoometa.core.exceptions import UnsupportedValueError
+from geoometa.core.integrators import GazetteerCollector, SyncState, \
+     UNPACK_MODES, TIMED_STAGES
+from geoometa.schema import elastic
+
+
+def collector(records, **kwargs):
+    kwargs.setdefault("journal", False)
+    kwargs.setdefault("cache_archives", False)
+    kwargs.setdefault("hierarchy", False)
+    kwargs.setdefault("chunk_size", 40)
+    kwargs.setdefault("initial_backoff", 0.001)
+    return GazetteerCollector(None, repos=[dict(r) for r in records],
+                              **kwargs)
+
+
+def count(standin, index=None):
+    return standin.client().count(
+        index=index or elastic.Place._index._name)["count"]
+
+
+@pytest.mark.parametrize("unpack", UNPACK_MODES)
+def test_process(standin, repos, unpack):
+    records = repos(120, 80)
+    gazetteer = collector(records, unpack=unpack)
+    gazetteer.process()
+
+    assert gazetteer.stat.success == 200
+    assert len(gazetteer.stat.errors) == 0
+    assert gazetteer.stat.skipped == 0
+    assert count(standin) == 200
+    assert standin.stats["bulk_items"] == 200
+
+    doc = standin.client().get(index=elastic.Place._index._name, id=150)
+    assert doc["_source"]["github_sha"]
+    assert doc["_source"]["source_url"].startswith(
+        records[1]["html_url"] + "/blob/master/data/")
+
+    summary = gazetteer.metrics.summary()
+    assert summary.stages["index"]["count"] == 200
+    downloads = summary.stages.get("download", {}).get("count", 0)
+    assert downloads == (0 if unpack == "stream" else 2)
+
+    with open(settings.SYNC_STATE_FILE) as fp:
+        state = json.load(fp)["repos"]
+    assert sorted(state) == sorted(r["html_url"] for r in records)
+
+
+def test_process_retries_rejected(standin, repos):
+    standin.item_failure_rate = 0.2
+    gazetteer = collector(repos(150), max_retries=10)
+    gazetteer.process()
+
+    rejected = standin.stats["bulk_items_rejected"]
+    assert rejected > 0
+    assert standin.stats["bulk_items"] == 150 + rejected
+    assert gazetteer.stat.success == 150
+    assert len(gazetteer.stat.errors) == 0
+    assert count(standin) == 150
+
+
+def test_process_out_of_retries(standin, repos):
+    standin.item_failure_rate = 1.
+    records = repos(30)
+    gazetteer = collector(records, max_retries=2)
+    gazetteer.process()
+
+    assert standin.stats["bulk_items"] == 30 * 3
+    assert gazetteer.stat.success == 0
+    assert len(gazetteer.stat.errors) == 30
+    assert gazetteer.stat.errors.by_type == {
+        "es_rejected_execution_exception": 30}
+    assert gazetteer.stat.errors.by_repo == {records[0]["name"]: 30}
+
+    # Not synced: the next run processes the repo again.
+    assert SyncState().repos == {}
+
+
+def test_process_errors_bounded(monkeypatch, tmp_path, standin, repos):
+    standin.item_failure_rate = 1.
+    path = str(tmp_path / "errors.ndjson")
+    monkeypatch.setattr(settings, "ERROR_LOG_FILE", path)
+    records = repos(30, 20)
+    gazetteer = collector(records, max_retries=0, errors_kept=5)
+    gazetteer.process()
+
+    errors = gazetteer.stat.errors
+    assert len(errors) == 50
+    assert len(list(errors)) == 5
+    assert errors.by_type == {"es_rejected_execution_exception": 50}
+    assert errors.by_repo == {records[0]["name"]: 30,
+                              records[1]["name"]: 20}
+    # Every error is in the log file, the file is closed.
+    with open(path) as fp:
+        logged = [json.loads(line) for line in fp]
+    assert len(logged) == 50
+    assert sorted(int(r["id"]) for r in logged) == list(range(1, 51))
+    assert {r["repo"] for r in logged} == {r["name"] for r in records}
+    assert errors.fp is None
+
+
+def test_process_threads(standin, repos):
+    standin.item_failure_rate = 0.1
+    gazetteer = collector(repos(100, 100, 100), threads=3, chunk_size=20)
+    gazetteer.process()
+
+    # Rejected items are not retried with threads.
+    rejected = standin.stats["bulk_items_rejected"]
+    assert rejected > 0
+    assert len(gazetteer.stat.errors) == rejected
+    assert gazetteer.stat.success == 300 - rejected
+    assert count(standin) == 300 - rejected
+    # Production of actions in the sending threads is not "index":
+    # exclusive stages add up to the wall time (those of
+    # `transform_file` are parts of "transform").
+    summary = gazetteer.metrics.summary()
+    exclusive = sum(stage["seconds"] for name, stage
+                    in summary.stages.items() if name not in TIMED_STAGES)
+    assert exclusive <= summary.wall_time * 1.05 + 0.01
+
+
+def test_process_bulk_load(standin, repos):
+    records = repos(50, 30)
+    # Empty index: tuned for the load, restored, merged.
+    gazetteer = collector(records[:1], bulk_load=True, force_merge=1)
+    gazetteer.process()
+    assert "bulk_load" in gazetteer.metrics.summary().stages
+    assert standin.stats["_forcemerge"] == 1
+    assert standin.stats["_refresh"] >= 1
+    resp = standin.client().indices.get_settings(index="geoo",
+                                                 flat_settings=True)
+    ((_, index_settings),) = resp.items()
+    assert index_settings["settings"].get("index.refresh_interval") is None
+
+    # The index serves queries now: not tuned.
+    gazetteer = collector(records[1:], bulk_load=True, force_merge=1)
+    gazetteer.process()
+    assert "bulk_load" not in gazetteer.metrics.summary().stages
+    assert standin.stats["_forcemerge"] == 1
+    assert count(standin) == 80
+
+    # Unless rebuilt into a new version.
+    gazetteer = collector(records, bulk_load=True, force_merge=1,
+                          rebuild=True)
+    gazetteer.process()
+    assert "bulk_load" in gazetteer.metrics.summary().stages
+    assert standin.stats["_forcemerge"] == 2
+    assert count(standin) == 80
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_register_validates(standin, generator, bulk):
+    elastic.setup()
+    features = list(generator.features(5))
+    # Without geometry and without a name: both invalid.
+    del features[1]["geometry"]
+    del features[3]["properties"]["wof:name"]
+    features.append({"type": "FeatureCollection", "id": 99})
+
+    gazetteer = GazetteerCollector(None, repos=[{}], bulk=bulk,
+                                   chunk_size=2)
+    gazetteer.register(iter(features))
+    assert gazetteer.stat.success == 3
+    assert gazetteer.stat.errors.by_type == {"ValidationException": 2,
+                                             "UnsupportedValueError": 1}
+    hits = standin.client().search(index="geoo")["hits"]["hits"]
+    assert sorted(int(hit["_id"]) for hit in hits) == [1, 3, 5]
+
+
+def test_transform_in_processes(generator):
+    files = list(generator.files(40))
+    files.insert(7, ("repo-master/data/bad.geojson", b"{not json"))
+    files.insert(20, ("repo-master/data/list.geojson", b"[1, null]"))
+    broken = generator.feature(1000)
+    del broken["geometry"]
+    files.insert(30, ("repo-master/data/1000.geojson",
+                      json.dumps(broken).encode("utf-8")))
+
+    results = {}
+    for workers in (1, 2):
+        gazetteer = GazetteerCollector(None, repos=[{}], workers=workers,
+                                       files_per_task=3)
+        pool = gazetteer.make_pool()
+        try:
+            actions = list(gazetteer.transform(files, pool=pool, repo="r"))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        results[workers] = [action["_id"] for action in actions]
+
+        # Errors in workers are reported per file or feature.
+        errors = gazetteer.stat.errors
+        assert errors.by_type == {"JSONDecodeError": 1,
+                                  "UnsupportedValueError": 2,
+                                  "ValidationException": 1}
+        assert errors.by_repo == {"r": 4}
+
+    # In the order of files.
+    assert results[2] == results[1] == list(range(1, 41))
+
+
+def test_process_in_processes(standin, repos):
+    gazetteer = collector(repos(70, 50), workers=2, files_per_task=7)
+    gazetteer.process()
+    assert gazetteer.stat.success == 120
+    assert count(standin) == 120
+
+
+def test_process_incremental(standin, repos):
+    records = repos(60, 40)
+    collector(records, incremental=True).process()
+    assert count(standin) == 100
+
+    # Not pushed since: not even downloaded.
+    gazetteer = collector(records, incremental=True)
+    assert gazetteer.repos == []
+
+    # Pushed, but files are the same: documents are not sent.
+    for record in records:
+        record["pushed_at"] = "2021-02-01T00:00:00Z"
+    bulk_items = standin.stats["bulk_items"]
+    gazetteer = collector(records, incremental=True)
+    gazetteer.process()
+    assert gazetteer.stat.skipped == 100
+    assert gazetteer.stat.success == 0
+    assert standin.stats["bulk_items"] == bulk_items
+
+
+def test_process_rebuild(standin, repos):
+    records = repos(50)
+    collector(records).process()
+    gazetteer = collector(records, rebuild=True)
+    gazetteer.process()
+
+    assert gazetteer.params.index == "geoo-v2"
+    assert sorted(standin.client().indices.get_alias(name="geoo")) == \
+        ["geoo-v2"]
+    assert count(standin) == 50
+
+
+def test_pushed_after_requires_timezone():
+    with pytest.raises(UnsupportedValueError):
+        GazetteerCollector(None, repos=[{}], pushed_after=datetime(2021, 1, 1))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""Journal of runs, and resuming interrupted ones."""
+
+import threading
+
+import pytest
+
+from geoometa.core.journal import Journal
+from geoometa.core.integrators import GazetteerCollector
+
+
+URL = "https://github.com/whosonfirst-data/whosonfirst-data-test"
+
+
+class Crash(Exception):
+    pass
+
+
+def actions(names, per_file=2):
+    for name in names:
+        for n in range(per_file):
+            yield {"_id": "{}-{}".format(name, n),
+                   "_source": {"source_url": name}}
+
+
+def files_of(journal):
+    return {name for (name,) in journal.db.execute("SELECT name FROM files")}
+
+
+@pytest.fixture
+def journal(tmp_path):
+    with Journal(str(tmp_path / "journal.sqlite")) as journal:
+        journal.start()
+        yield journal
+
+
+def test_file_done_when_all_acked(journal):
+    progress = journal.repo(URL, version="a", batch_size=100)
+    sent = list(progress.track(actions(["f1", "f2"]),
+                               key=lambda a: a["_source"]["source_url"]))
+    assert len(sent) == 4
+
+    for action in sent[:3]:
+        progress.ack(action["_id"])
+    progress.commit()
+    assert files_of(journal) == {"f1"}
+
+    progress.ack(sent[3]["_id"])
+    progress.finish()
+    assert files_of(journal) == {"f1", "f2"}
+    assert progress.done
+
+
+def test_commit_per_batch(journal):
+    progress = journal.repo(URL, version="a", batch_size=2)
+    for action in progress.track(actions(["f1", "f2", "f3"], per_file=1),
+                                 key=lambda a: a["_source"]["source_url"]):
+        progress.ack(action["_id"])
+    # The last one is not committed yet.
+    assert files_of(journal) == {"f1"}
+    assert journal.db.execute(
+        "SELECT batches, acked FROM repos").fetchone() == (1, 2)
+
+    progress.finish()
+    assert files_of(journal) == {"f1", "f2", "f3"}
+
+
+def test_not_done_with_unacknowledged(journal):
+    progress = journal.repo(URL, version="a")
+    sent = list(progress.track(actions(["f1"]),
+                               key=lambda a: a["_source"]["source_url"]))
+    progress.ack(sent[0]["_id"])
+    progress.finish()
+    assert not progress.done
+    assert files_of(journal) == set()
+
+
+def test_resume(journal):
+    progress = journal.repo(URL, version="a")
+    for action in progress.track(actions(["f1"]),
+                                 key=lambda a: a["_source"]["source_url"]):
+        progress.ack(action["_id"])
+    progress.finish()
+    run_id = journal.run.id
+
+    run = journal.start()
+    assert run.resumed and run.id == run_id
+    progress = journal.repo(URL, version="a")
+    assert progress.done
+    files = [("f1", b""), ("f2", b"")]
+    assert list(progress.skip_done(files, key=lambda n: n)) == [("f2", b"")]
+
+    # Another version of the repo: nothing is done.
+    progress = journal.repo(URL, version="b")
+    assert not progress.done and progress.done_files == set()
+
+    # A finished run is not resumed.
+    journal.finish()
+    assert not journal.start().resumed
+    assert files_of(journal) == set()
+
+
+def test_track_and_ack_in_threads(journal):
+    # As with `threads`: tracked by the sending thread, acknowledged
+    # by the collector's one.
+    progress = journal.repo(URL, version="a", batch_size=7)
+    sent = []
+    cond = threading.Condition()
+
+    def send():
+        for action in progress.track(
+                actions(["f{}".format(n) for n in range(500)]),
+                key=lambda a: a["_source"]["source_url"]):
+            with cond:
+                sent.append(action["_id"])
+                cond.notify()
+        with cond:
+            sent.append(None)
+            cond.notify()
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    acked = 0
+    while True:
+        with cond:
+            cond.wait_for(lambda: len(sent) > acked)
+            doc_id = sent[acked]
+        if doc_id is None:
+            break
+        progress.ack(doc_id)
+        acked += 1
+    thread.join()
+    progress.finish()
+
+    assert progress.done
+    assert len(files_of(journal)) == 500
+
+
+def test_collector_resumes(standin, repos, monkeypatch):
+    records = repos(100, 100, 100)
+
+    def collector(**kwargs):
+        return GazetteerCollector(
+            None, repos=[dict(r) for r in records], journal=True,
+            cache_archives=False, hierarchy=False, chunk_size=25, **kwargs)
+
+    # Crash in the middle of the second repo.
+    index = GazetteerCollector.index
+
+    def crashing(self, actions, repo=None):
+        if repo != records[1]["name"]:
+            return index(self, actions, repo=repo)
+
+        def crash():
+            for n, action in enumerate(actions):
+                if n == 60:
+                    raise Crash()
+                yield action
+        return index(self, crash(), repo=repo)
+
+    monkeypatch.setattr(GazetteerCollector, "index", crashing)
+    gazetteer = collector()
+    with pytest.raises(Crash):
+        gazetteer.process()
+    # Two chunks of the second repo are sent.
+    assert gazetteer.stat.success == 150
+    monkeypatch.setattr(GazetteerCollector, "index", index)
+
+    bulk_items = standin.stats["bulk_items"]
+    gazetteer = collector()
+    gazetteer.process()
+    # The first repo is skipped, the second one is replayed from
+    # the last committed batch.
+    assert 150 <= gazetteer.stat.success < 150 + 25
+    assert standin.stats["bulk_items"] - bulk_items == \
+        gazetteer.stat.success
+    assert standin.client().count(index="geoo")["count"] == 300
+
+    # Finished: the next run starts from scratch.
+    gazetteer = collector()
+    gazetteer.process()
+    assert gazetteer.stat.success == 300
+
+
+def test_journal_ops_off_thread(journal):
+    # Commits of asyncio ingestion run in a thread pool.
+    progress = journal.repo(URL, version="a", autocommit=False)
+    for action in progress.track(actions(["f1"]),
+                                 key=lambda a: a["_source"]["source_url"]):
+        progress.ack(action["_id"])
+    thread = threading.Thread(target=progress.finish)
+    thread.start()
+    thread.join()
+    assert progress.done and files_of(journal) == {"f1"}
+
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Stage accounting and dumps of ingestion metrics, the error log."""
+
+import json
+import threading
+
+import pytest
+
+from geoometa.core import metrics as metrics_module
+from geoometa.core.metrics import Metrics, TimedClient, ErrorLog, \
+     MAX_MESSAGE
+
+
+class Clock:
+    """`time.perf_counter` moved by hand."""
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def tick(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(metrics_module.time, "perf_counter", clock)
+    return clock
+
+
+def produce(clock, count, seconds):
+    for n in range(count):
+        clock.tick(seconds)
+        yield n
+
+
+def test_nested_stages_exclusive(clock):
+    metrics = Metrics()
+    with metrics.run():
+        with metrics.stage("index", repo="repo-a"):
+            clock.tick(1.)
+            with metrics.stage("transform", repo="repo-a"):
+                clock.tick(2.)
+                items = list(metrics.timed(
+                    "unzip", produce(clock, 4, .5), size=lambda n: 10))
+            clock.tick(1.)
+        # Added from elsewhere (e.g. worker processes): not nested.
+        metrics.add("parse", 3., count=4)
+
+    summary = metrics.summary()
+    stages = summary.stages
+    assert items == [0, 1, 2, 3]
+    assert stages["index"]["seconds"] == 2.
+    assert stages["transform"]["seconds"] == 2.
+    assert stages["unzip"] == {"seconds": 2., "count": 4, "bytes": 40,
+                               "per_sec": 2., "bytes_per_sec": 20.}
+    assert stages["parse"]["seconds"] == 3.
+    # Nested stages add up to the wall time.
+    assert summary.wall_time == 6. == sum(
+        stages[name]["seconds"] for name in ("index", "transform", "unzip"))
+    assert set(summary.repos["repo-a"]) == {"index", "transform"}
+
+
+def test_stage_exception(clock):
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.stage("outer"):
+            clock.tick(1.)
+            with metrics.stage("inner"):
+                clock.tick(2.)
+                raise ValueError
+
+    assert metrics.stages["outer"].seconds == 1.
+    assert metrics.stages["inner"].seconds == 2.
+    # Nothing is left on the stack.
+    with metrics.stage("next"):
+        clock.tick(1.)
+    assert metrics.stages["next"].seconds == 1.
+
+
+def test_handoff(clock):
+    metrics = Metrics()
+    consumed = []
+    with metrics.stage("index"):
+        clock.tick(1.)
+        documents = metrics.handoff(metrics.timed(
+            "transform", produce(clock, 3, 1.)))
+        consumer = threading.Thread(
+            target=lambda: consumed.extend(documents))
+        consumer.start()
+        consumer.join()
+
+    assert consumed == [0, 1, 2]
+    # Producing documents in the other thread is nested in "index".
+    assert metrics.stages["index"].seconds == 1.
+    assert metrics.stages["transform"].seconds == 3.
+
+
+def test_dump_json(tmp_path):
+    metrics = Metrics()
+    metrics.add("index", 2., count=10, nbytes=100, repo="repo-a")
+    metrics.histogram("bulk_request_seconds").observe(.2)
+    path = str(tmp_path / "metrics" / "run.json")
+    metrics.dump_json(path)
+
+    with open(path) as fp:
+        dumped = json.load(fp)
+    assert dumped == json.loads(json.dumps(metrics.summary()))
+    assert dumped["stages"]["index"]["per_sec"] == 5.
+    assert dumped["repos"]["repo-a"]["index"]["bytes"] == 100
+    assert dumped["histograms"]["bulk_request_seconds"]["count"] == 1
+    assert not (tmp_path / "metrics" / "run.json.tmp").exists()
+
+
+def test_dump_prometheus(tmp_path, clock):
+    metrics = Metrics()
+    with metrics.run():
+        clock.tick(5.)
+    metrics.add("index", 2., count=10, nbytes=100, repo="repo-a")
+    metrics.add("download", 1., count=1)
+    hist = metrics.histogram("bulk_request_seconds")
+    for value in (.003, .2, .2, 100):
+        hist.observe(value)
+    path = str(tmp_path / "metrics.prom")
+    metrics.dump_prometheus(path, prefix="test")
+
+    with open(path) as fp:
+        lines = fp.read().splitlines()
+    assert lines[:2] == ["# TYPE test_wall_seconds gauge",
+                         "test_wall_seconds 5.0"]
+    for line in (
+            "# TYPE test_stage_seconds gauge",
+            'test_stage_seconds{stage="download"} 1.0',
+            'test_stage_seconds{stage="index"} 2.0',
+            'test_stage_count{stage="index"} 10',
+            'test_stage_count{stage="index",repo="repo-a"} 10',
+            'test_stage_bytes{stage="index",repo="repo-a"} 100',
+            "# TYPE test_bulk_request_seconds histogram",
+            'test_bulk_request_seconds_bucket{le="0.005"} 1',
+            'test_bulk_request_seconds_bucket{le="0.25"} 3',
+            'test_bulk_request_seconds_bucket{le="60"} 3',
+            'test_bulk_request_seconds_bucket{le="+Inf"} 4',
+            "test_bulk_request_seconds_count 4"):
+        assert line in lines
+    # Stages in order, per metric.
+    assert lines.index('test_stage_seconds{stage="download"} 1.0') < \
+        lines.index('test_stage_seconds{stage="index"} 2.0') < \
+        lines.index("# TYPE test_stage_count gauge")
+
+
+def test_timed_client_bytes():
+    class Client:
+        def bulk(self, body):
+            return {"errors": False}
+
+        def info(self):
+            return "info"
+
+    metrics = Metrics()
+    client = TimedClient(Client(), metrics)
+    assert client.bulk('{"name": "Zürich"}\n') == {"errors": False}
+    client.bulk(b'{"name": "Z\xc3\xbcrich"}\n')
+    assert client.info() == "info"
+    # Bytes as sent, not characters.
+    assert metrics.stages["bulk_requests"].bytes == 2 * 20
+    assert metrics.stages["bulk_requests"].count == 2
+    assert metrics.histograms["bulk_request_seconds"].count == 2
+
+
+def test_error_log_bounded():
+    errors = ErrorLog(capacity=3)
+    for n in range(10):
+        errors.add("error {}".format(n), type_="TypeError" if n % 2
+                   else None, repo="repo-{}".format(n % 3) if n else None)
+    errors.add("x" * (MAX_MESSAGE + 10), type_="TypeError")
+
+    # Only the last messages are kept, counters cover all of them.
+    assert len(errors) == 11
+    assert list(errors) == ["error 8", "error 9", "x" * MAX_MESSAGE]
+    summary = errors.summary()
+    assert summary.by_type == {"Error": 5, "TypeError": 6}
+    assert summary.by_repo == {"repo-0": 3, "repo-1": 3, "repo-2": 3}
+    assert summary.examples == {"Error": "error 0", "TypeError": "error 1"}
+    assert summary.recent == list(errors)
+
+
+def test_error_log_spill(tmp_path):
+    path = str(tmp_path / "errors" / "run.ndjson")
+    errors = ErrorLog(capacity=2, path=path)
+    for n in range(5):
+        errors.add("error {}".format(n), type_="ValueError",
+                   repo="repo-a", feature_id=n)
+    errors.close()
+    # Appended to by the next run.
+    errors = ErrorLog(capacity=2, path=path)
+    errors.add("again")
+    errors.close()
+
+    with open(path) as fp:
+        records = [json.loads(line) for line in fp]
+    assert len(errors) == 1
+    assert [r["id"] for r in records] == [0, 1, 2, 3, 4, None]
+    assert records[2]["message"] == "error 2"
+    assert records[2]["type"] == "ValueError"
+    assert records[2]["repo"] == "repo-a"
+    assert records[2]["time"]
+    assert records[-1]["type"] == "Error"
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Name index: building, mapping and lookups."""
+
+import pytest
+
+from geoometa.core.exceptions import MalformedValueError
+from geoometa.core.nameindex import NameIndex, NameIndexBuilder, Match, \
+     fold, normalize
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    builder = NameIndexBuilder()
+    builder.add(1, ["São Paulo", "Sao Paulo"], "locality", 12000000)
+    builder.add(2, ["São Paulo"], "region", 46000000)
+    builder.add(3, ["San Pedro"], "locality", 1000)
+    builder.add(4, ["Saint-Pierre", ""], "locality", None)
+    builder.add_document(5, {"name": "Sankt  Pölten", "names": ["St. Pölten"],
+                             "placetype": "locality", "population": "55000"})
+    builder.add(6, ["Łódź"], "locality", 670000)
+    return builder.write(str(tmp_path / "names" / "names.idx"))
+
+
+def test_normalize_and_fold():
+    assert normalize("  Sankt \t Pölten ") == "Sankt Pölten"
+    assert fold("SÃO  Paulo") == "sao paulo"
+    assert fold("Łódź") == "lodz"
+
+
+def test_lookups(index_path):
+    with NameIndex(index_path) as index:
+        assert len(index) == 6
+        # Best ranked (by population) first.
+        assert index.exact("São Paulo") == [
+            Match(2, "region", 46000000), Match(1, "locality", 12000000)]
+        assert index.exact("são paulo") == []
+        assert [m.id for m in index.folded("SAO PAULO")] == [2, 1]
+        assert [m.id for m in index.lookup("Sao Paulo")] == [1]
+        assert [m.id for m in index.lookup("lodz")] == [6]
+        assert index.exact("Sankt Pölten") == [Match(5, "locality", 55000)]
+        assert index.exact("Saint-Pierre") == [Match(4, "locality", None)]
+        assert index.lookup("Nowhere") == []
+
+
+def test_prefix(index_path):
+    with NameIndex(index_path) as index:
+        assert [m.id for m in index.prefix("sa", limit=None)] == \
+            [2, 1, 5, 3, 4]
+        assert [m.id for m in index.prefix("Sa", limit=2)] == [2, 1]
+        assert [m.id for m in index.prefix("san")] == [5, 3]
+        assert index.prefix("  ") == []
+
+
+def test_malformed(tmp_path, index_path):
+    empty = tmp_path / "empty.idx"
+    empty.write_bytes(b"")
+    garbage = tmp_path / "garbage.idx"
+    garbage.write_bytes(b"x" * 500)
+    truncated = tmp_path / "truncated.idx"
+    with open(index_path, "rb") as fp:
+        truncated.write_bytes(fp.read()[:200])
+
+    for path in (empty, garbage, truncated):
+        with pytest.raises(MalformedValueError):
+            NameIndex(str(path))
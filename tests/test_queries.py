@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Batched lookups with `_msearch` against the stand-in."""
+
+import pytest
+
+from geoometa.core.cache import QueryCache
+from geoometa.schema import elastic, queries
+from geoometa.schema.elastic import Place
+
+
+PLACES = [
+    # id, name, country, placetype, bbox
+    (1, "France", "FR", "country", [-5., 41., 10., 51.]),
+    (2, "Paris", "FR", "locality", [2.2, 48.8, 2.5, 48.9]),
+    (3, "Paris", "US", "locality", [-95.6, 33.6, -95.5, 33.7]),
+    (4, "London", "GB", "locality", [-0.5, 51.3, 0.3, 51.7]),
+    (5, "Ile-de-France", "FR", "region", [1.4, 48.1, 3.6, 49.2]),
+    ]
+
+
+@pytest.fixture
+def places(standin):
+    elastic.setup()
+    client = standin.client()
+    for place_id, name, country, placetype, bbox in PLACES:
+        client.index(index=Place._index._name, id=place_id, body={
+            "name": name, "names": [name], "iso_country": country,
+            "placetype": placetype, "bbox": bbox})
+    return standin
+
+
+def ids(hits):
+    return None if hits is None else sorted(int(hit.meta.id) for hit in hits)
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """Sizes of `_msearch` requests sent."""
+    sizes = []
+    msearch = queries._msearch
+
+    def record(searches):
+        sizes.append(len(searches))
+        return msearch(searches)
+
+    monkeypatch.setattr(queries, "_msearch", record)
+    return sizes
+
+
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_batch_geocode_aligned(places, batches, concurrency):
+    results = queries.batch_geocode(
+        ["Paris", "London", "  paris", {"name": "Paris", "country": "fr"},
+         "Nowhere", "London", ("PARIS",)],
+        batch_size=2, concurrency=concurrency)
+
+    assert [ids(hits) for hits in results] == [
+        [2, 3], [4], [2, 3], [2], [], [4], [2, 3]]
+    # Repeated lookups are searched once: 4 distinct in batches of 2.
+    assert batches == [2, 2]
+    assert places.stats["_msearch"] == 2
+    # Every position gets its own list.
+    results[0].clear()
+    assert ids(results[2]) == [2, 3]
+
+
+def test_batch_reverse_geocode(places, batches):
+    results = queries.batch_reverse_geocode(
+        [(48.85, 2.35), (0., 0.), {"lat": 48.85, "lon": 2.35,
+                                   "placetypes": ["locality"]}],
+        batch_size=10)
+
+    # From the top down.
+    assert [int(hit.meta.id) for hit in results[0]] == [1, 5, 2]
+    assert results[1] == []
+    assert ids(results[2]) == [2]
+    assert batches == [3]
+
+
+def test_cached(places, batches):
+    previous = queries.set_cache(QueryCache(max_size=10, ttl=0))
+    try:
+        first = queries.batch_geocode(["Paris", "London"])
+        # Normalized keys: "paris " is "Paris".
+        second = queries.batch_geocode(["london", "paris ", "Nowhere"])
+        places.failure_rate = 1.
+        third = queries.batch_geocode(["Berlin", "Paris"])
+        fourth = queries.batch_geocode(["Berlin"])
+    finally:
+        queries.set_cache(previous)
+
+    assert [ids(hits) for hits in first] == [[2, 3], [4]]
+    assert [ids(hits) for hits in second] == [[4], [2, 3], []]
+    assert [ids(hits) for hits in third] == [None, [2, 3]]
+    # Failed lookups are not cached.
+    assert fourth == [None]
+    assert batches == [2, 1, 1, 1]
+
+
+def test_execute_many_batches(places, batches):
+    searches = [Place.search().filter("ids", values=[n % 5 + 1])
+                for n in range(7)]
+    responses = queries.execute_many(searches, batch_size=3, concurrency=3)
+
+    assert batches == [3, 3, 1]
+    assert [ids(resp) for resp in responses] == \
+        [[n % 5 + 1] for n in range(7)]
+
+
+def test_failed_search(places, monkeypatch):
+    forward_search = queries.forward_search
+
+    def broken(name, **kwargs):
+        if name == "broken":
+            # Not supported by the stand-in: the item fails.
+            return Place.search().query("fuzzy", name=name)
+        return forward_search(name, **kwargs)
+
+    monkeypatch.setattr(queries, "forward_search", broken)
+    results = queries.batch_geocode(["Paris", "broken", "London", "broken"])
+    assert [ids(hits) for hits in results] == [[2, 3], None, [4], None]
+    # A single lookup too.
+    assert queries.geocode("broken") is None
+
+
+def test_failed_request(places):
+    # The whole request failed: all lookups in it are None.
+    places.failure_rate = 1.
+    assert queries.batch_geocode(["Paris", "London"]) == [None, None]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Local reverse geocoding."""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from geoometa.core.reverse import ReverseGeocoder, ReverseGeocoderBuilder
+
+
+def square(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+@pytest.fixture
+def geocoder():
+    builder = ReverseGeocoderBuilder()
+    # A region with a hole, a locality in it, another one across
+    # grid cells, a point (ignored).
+    builder.add(1, {"type": "Polygon", "coordinates": [
+        square(0, 0, 10, 10), square(4, 4, 6, 6)]}, "region")
+    builder.add(2, {"type": "Polygon", "coordinates": [
+        square(1, 1, 3, 3)]}, "locality")
+    builder.add_document(3, {
+        "geometry": {"type": "multipolygon", "coordinates": [
+            [square(20, 20, 21.5, 21.5)], [square(30, 30, 31, 31)]]},
+        "placetype": "locality"})
+    assert not builder.add(4, {"type": "Point", "coordinates": [1, 1]})
+    return builder.build(cell_size=1.)
+
+
+def test_lookup(geocoder):
+    assert len(geocoder) == 3
+    # lat, lon
+    assert geocoder.lookup(2, 2) == [1, 2]
+    assert geocoder.lookup(5, 5) == []
+    assert geocoder.lookup(8, 8) == [1]
+    assert geocoder.lookup(21.2, 21.2) == [3]
+    assert geocoder.lookup(30.5, 30.5) == [3]
+    assert geocoder.lookup(25, 25) == []
+    assert geocoder.lookup(2, 2, placetypes=["locality"]) == [2]
+
+
+def test_reverse(geocoder):
+    lats = [2, 5, float("nan"), 21.2, 8]
+    lons = [2, 5, 1, 21.2, 8]
+    assert geocoder.reverse(lats, lons) == [[1, 2], [], [], [3], [1]]
+
+    points, ids = geocoder.contains(lats, lons, placetypes=["region"])
+    assert points.tolist() == [0, 4]
+    assert ids.tolist() == [1, 1]
+
+
+def test_save_load(tmp_path, geocoder):
+    path = geocoder.save(str(tmp_path / "reverse" / "places.npz"))
+    loaded = ReverseGeocoder.load(path)
+    lats, lons = [2, 5, 21.2, 8], [2, 5, 21.2, 8]
+    assert loaded.reverse(lats, lons) == geocoder.reverse(lats, lons)
+    assert loaded.placetype_names == geocoder.placetype_names
+
+
+def test_empty():
+    geocoder = ReverseGeocoderBuilder().build()
+    assert len(geocoder) == 0
+    assert geocoder.lookup(1, 1) == []
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""The Elasticsearch stand-in itself."""
+
+import pytest
+from elasticsearch import TransportError
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import bulk, scan
+
+from geoometa.core.standin import StandIn
+
+
+def test_documents_and_search(standin):
+    client = standin.client()
+    client.indices.create(index="places")
+    for n in range(25):
+        client.index(index="places", id=n, body={
+            "name": "place {}".format(n), "placetype": "locality"
+            if n % 2 else "region", "population": n})
+
+    assert client.get(index="places", id=3)["_source"]["name"] == "place 3"
+    with pytest.raises(NotFoundError):
+        client.get(index="places", id=100)
+
+    assert client.count(index="places", body={
+        "query": {"term": {"placetype": "region"}}})["count"] == 13
+    resp = client.search(index="places", body={
+        "query": {"range": {"population": {"gte": 20}}},
+        "sort": [{"population": "desc"}], "size": 2})
+    assert [h["_id"] for h in resp["hits"]["hits"]] == ["24", "23"]
+    # Scrolls go through every hit.
+    assert len(list(scan(client, index="places", size=4))) == 25
+
+
+def test_bulk_rejections_reproducible():
+    rejected = []
+    for _ in range(2):
+        with StandIn(seed=7, item_failure_rate=0.3) as server:
+            ok, errors = bulk(server.client(), (
+                {"_index": "places", "_id": n, "name": str(n)}
+                for n in range(100)), raise_on_error=False)
+            statuses = [e["index"]["status"] for e in errors]
+            assert set(statuses) == {429}
+            assert ok + len(errors) == server.stats["bulk_items"] == 100
+            assert server.stats["bulk_items_rejected"] == len(errors)
+            rejected.append(sorted(e["index"]["_id"] for e in errors))
+
+    assert rejected[0] == rejected[1] and rejected[0]
+
+
+def test_failures_injected():
+    with StandIn(seed=1, failure_rate=1.) as server:
+        client = server.client()
+        with pytest.raises(TransportError) as info:
+            client.indices.create(index="places")
+        assert info.value.status_code == 503
+        # HEAD requests are never failed.
+        assert not client.indices.exists(index="places")
+        assert server.stats["failures_injected"] == 1
+
+
+def test_aliases_are_atomic(standin):
+    client = standin.client()
+    client.indices.create(index="a", body={"aliases": {"places": {}}})
+    client.indices.create(index="b")
+    with pytest.raises(NotFoundError):
+        client.indices.update_aliases(body={"actions": [
+            {"add": {"index": "b", "alias": "places"}},
+            {"remove": {"index": "b", "alias": "places"}}]})
+    assert list(client.indices.get_alias(name="places")) == ["a"]
+
+    client.indices.update_aliases(body={"actions": [
+        {"remove": {"index": "a", "alias": "places"}},
+        {"add": {"index": "b", "alias": "places"}}]})
+    assert list(client.indices.get_alias(name="places")) == ["b"]
+
+    # Not named as an index, unless it goes in the same request.
+    with pytest.raises(TransportError) as info:
+        client.indices.update_aliases(body={"actions": [
+            {"add": {"index": "b", "alias": "a"}}]})
+    assert info.value.status_code == 400
+    assert info.value.error == "invalid_alias_name_exception"
+    client.indices.update_aliases(body={"actions": [
+        {"remove_index": {"index": "a"}},
+        {"add": {"index": "b", "alias": "a"}}]})
+    assert sorted(client.indices.get_alias(index="b")["b"]["aliases"]) == \
+        ["a", "places"]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""Country names, paging helpers."""
+
+import pytest
+
+from geoometa.core.exceptions import MissingDataError, \
+     UnsupportedValueError
+from geoometa.core.utils import COUNTRY_NAMES, country_name, \
+     parse_link_header, iter_chunks
+
+
+def test_country_names_match_pycountry():
+    # The generated table replaces lookups in pycountry.
+    pycountry = pytest.importorskip("pycountry")
+    for country in pycountry.countries:
+        for code in (country.alpha_2, country.alpha_3, country.numeric):
+            assert country_name(code) == country.name
+            assert country_name(code.lower()) == country.name
+        assert country_name(int(country.numeric)) == country.name
+
+    assert len(COUNTRY_NAMES) == 3 * len(pycountry.countries)
+
+
+def test_country_name():
+    assert country_name(" us ") == "United States"
+    assert country_name(4) == country_name("4") == "Afghanistan"
+
+
+@pytest.mark.parametrize("code", [None, ["US"], True, 1.5, {"US": 1}])
+def test_country_name_not_a_code(code):
+    with pytest.raises(UnsupportedValueError):
+        country_name(code)
+
+
+@pytest.mark.parametrize("code", ["XX", "XXX", 999, "-1"])
+def test_country_name_unknown(code):
+    for _ in range(2):
+        # The second time from the negative cache.
+        with pytest.raises(MissingDataError):
+            country_name(code)
+
+
+def test_country_name_wrong_length():
+    for code in ("USAA", "", 1000):
+        with pytest.raises(UnsupportedValueError):
+            country_name(code)
+
+
+def test_parse_link_header():
+    value = '<https://api.github.com/x?page=2>; rel="next", ' \
+            '<https://api.github.com/x?page=5>; rel="last"'
+    assert parse_link_header(value) == {
+        "next": "https://api.github.com/x?page=2",
+        "last": "https://api.github.com/x?page=5"}
+    assert parse_link_header(None) == {}
+
+
+def test_iter_chunks():
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_chunks([], 2)) == []
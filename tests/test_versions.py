@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Versioned indices and rebuilds."""
+
+import pytest
+
+from geoometa.core.exceptions import UnsupportedValueError
+from geoometa.core.integrators import GazetteerCollector
+from geoometa.schema import elastic
+from geoometa.schema.versions import IndexVersions, parse_version, \
+     version_name
+
+
+def names(versions):
+    return [name for _, name in versions.versions()]
+
+
+def collector(records, **kwargs):
+    return GazetteerCollector(
+        None, repos=[dict(r) for r in records], cache_archives=False,
+        hierarchy=False, chunk_size=20, initial_backoff=0.001, **kwargs)
+
+
+def test_names():
+    assert version_name("geoo", 3) == "geoo-v3"
+    assert parse_version("geoo", "geoo-v12") == 12
+    assert parse_version("geoo", "geoo-v12-old") is None
+    assert parse_version("geoo", "other-v1") is None
+
+
+def test_create_swap_cleanup(standin):
+    elastic.setup()
+    versions = IndexVersions()
+    assert versions.current() == ["geoo-v1"]
+
+    for _ in range(3):
+        versions.swap(versions.create())
+    assert versions.current() == ["geoo-v4"]
+    building = versions.create()
+
+    assert versions.cleanup(keep=1) == ["geoo-v1", "geoo-v2"]
+    # Newer than the current one: might be being built.
+    assert names(versions) == ["geoo-v3", "geoo-v4", building]
+    assert versions.cleanup(keep=1, building=[building]) == []
+    assert versions.cleanup(keep=1, building=[]) == [building]
+    assert names(versions) == ["geoo-v3", "geoo-v4"]
+
+
+def test_reindex(standin):
+    elastic.setup()
+    client = standin.client()
+    for n in range(1, 6):
+        client.index(index="geoo", id=n, body={"name": "place {}".format(n),
+                                               "placetype": "locality"})
+    versions = IndexVersions()
+    new = versions.create()
+    result = versions.reindex(new)
+    assert result["created"] == 5
+    versions.swap(new)
+    assert client.count(index="geoo")["count"] == 5
+
+
+def test_migrate(standin):
+    client = standin.client()
+    client.indices.create(index="geoo")
+    client.index(index="geoo", id=1, body={"name": "legacy"})
+    versions = IndexVersions()
+    assert versions.is_legacy()
+
+    assert versions.migrate() == "geoo-v1"
+    assert versions.current() == ["geoo-v1"]
+    assert client.get(index="geoo", id=1)["_source"]["name"] == "legacy"
+    with pytest.raises(UnsupportedValueError):
+        versions.migrate()
+
+
+def test_failed_rebuild_is_not_swapped(standin, repos):
+    records = repos(100)
+    collector(records).process()
+    versions = IndexVersions()
+
+    standin.item_failure_rate = 0.1
+    gazetteer = collector(records, rebuild=True, journal=True, max_retries=0)
+    gazetteer.process()
+    assert len(gazetteer.stat.errors) > 0
+    assert versions.current() == ["geoo-v1"]
+    assert names(versions) == ["geoo-v1", "geoo-v2"]
+
+    # Resumed into the same index, swapped once clean.
+    standin.item_failure_rate = 0.
+    gazetteer = collector(records, rebuild=True, journal=True)
+    gazetteer.process()
+    assert gazetteer.params.index == "geoo-v2"
+    assert 0 < gazetteer.stat.success < 100
+    assert versions.current() == ["geoo-v2"]
+    assert standin.client().count(index="geoo")["count"] == 100
+
+
+def test_abandoned_rebuild_is_deleted(standin, repos):
+    records = repos(50)
+    collector(records).process()
+    versions = IndexVersions()
+
+    standin.item_failure_rate = 0.2
+    collector(records, rebuild=True, journal=False, max_retries=0).process()
+    assert names(versions) == ["geoo-v1", "geoo-v2"]
+
+    standin.item_failure_rate = 0.
+    gazetteer = collector(records, rebuild=True, journal=False)
+    gazetteer.process()
+    assert versions.current() == [gazetteer.params.index]
+    assert names(versions) == ["geoo-v1", gazetteer.params.index]
+
+
+def test_rebuild_legacy(standin, repos):
+    client = standin.client()
+    client.indices.create(index="geoo")
+    client.index(index="geoo", id=1, body={"name": "legacy"})
+    records = repos(30)
+
+    # Refused before anything is loaded.
+    with pytest.raises(UnsupportedValueError):
+        collector(records, rebuild=True).process()
+    assert standin.stats["bulk_items"] == 0
+    assert names(IndexVersions()) == []
+    assert client.get(index="geoo", id=1)["_source"]["name"] == "legacy"
+
+    IndexVersions().migrate()
+    gazetteer = collector(records, rebuild=True)
+    gazetteer.process()
+    assert gazetteer.params.index == "geoo-v2"
+    assert IndexVersions().current() == ["geoo-v2"]
+    assert client.count(index="geoo")["count"] == 30
+
+
+def test_resumed_rebuild_without_index(standin, repos):
+    records = repos(50)
+    collector(records).process()
+    standin.item_failure_rate = 0.2
+    collector(records, rebuild=True, journal=True, max_retries=0).process()
+    standin.client().indices.delete(index="geoo-v2")
+
+    standin.item_failure_rate = 0.
+    gazetteer = collector(records, rebuild=True, journal=True)
+    gazetteer.process()
+    assert gazetteer.stat.success == 50
+    assert IndexVersions().current() == [gazetteer.params.index]